@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Consumer of the items collected by arthur
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import pickle
+
+from arthur.common import Q_STORAGE_ITEMS
+
+logger = logging.getLogger(__name__)
+
+ARTHUR_BATCH_SIZE = 1000  # items popped from redis at once
+
+# Move up to ARGV[1] items from the head of the list KEYS[1] to the
+# list KEYS[2] in an atomic operation, returning them
+POP_ITEMS_SCRIPT = """
+    local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items > 0 then
+        redis.call('LTRIM', KEYS[1], #items, -1)
+        redis.call('RPUSH', KEYS[2], unpack(items))
+    end
+    return items
+"""
+
+
+def tag_queue(tag):
+    """Redis list with the items of a tag read from the arthur queue by other tags"""
+
+    return "%s:%s" % (Q_STORAGE_ITEMS, tag)
+
+
+def processing_queue(tag):
+    """Redis list with the items read by the consumer of a tag not acknowledged yet"""
+
+    return "%s:processing:%s" % (Q_STORAGE_ITEMS, tag)
+
+
+class ArthurQueue:
+    """Streaming consumer of the items of a tag stored by arthur in redis.
+
+    The items are popped in batches of `batch_size` from the list of the
+    tag and from the arthur queue, shared by all the tags. The items of
+    other tags found in the arthur queue are moved to the list of their
+    tags, to be read by their consumers. The items popped are kept in a
+    processing list until `ack` is called once they are stored, and they
+    are moved back to the list of the tag by the next consumer if not.
+    As the raw items are indexed by uuid, reading them again is harmless.
+
+    :param conn: redis connection
+    :param tag: tag of the items to be read
+    :param batch_size: max number of items popped at once
+    """
+
+    def __init__(self, conn, tag, batch_size=ARTHUR_BATCH_SIZE):
+        self.conn = conn
+        self.tag = tag
+        self.batch_size = batch_size
+        self.tag_queue = tag_queue(tag)
+        self.processing_queue = processing_queue(tag)
+        self.__pop_items = conn.register_script(POP_ITEMS_SCRIPT)
+
+    def items(self):
+        """Generator of the items of the tag"""
+
+        self.requeue()
+
+        nitems = 0
+        for queue in [self.tag_queue, Q_STORAGE_ITEMS]:
+            while True:
+                batch = self.__pop_items(keys=[queue, self.processing_queue], args=[self.batch_size])
+                if not batch:
+                    break
+
+                items = []
+                others = {}
+                for data in batch:
+                    item = pickle.loads(data)
+                    if item['tag'] == self.tag:
+                        items.append(item)
+                    else:
+                        others.setdefault(item['tag'], []).append(data)
+
+                if others:
+                    pipe = self.conn.pipeline()
+                    for tag, tag_items in others.items():
+                        pipe.rpush(tag_queue(tag), *tag_items)
+                    pipe.execute()
+
+                nitems += len(items)
+                for item in items:
+                    yield item
+
+        logger.debug("Items read for %s: %i", self.tag, nitems)
+
+    def ack(self):
+        """Remove the items read, once they are stored"""
+
+        self.conn.delete(self.processing_queue)
+
+    def requeue(self):
+        """Move the items read and not acknowledged back to the list of the tag"""
+
+        nitems = 0
+        while self.conn.rpoplpush(self.processing_queue, self.tag_queue) is not None:
+            nitems += 1
+
+        if nitems:
+            logger.info("Items of %s not acknowledged requeued: %i", self.tag, nitems)
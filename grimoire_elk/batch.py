@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Feed several repositories in the same process
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import collections
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
+from urllib.parse import urlparse
+
+from .utils import get_connector_from_name
+
+logger = logging.getLogger(__name__)
+
+
+class FeedJob:
+    """Feeding of a repository, with the params of a p2o run.
+
+    :param backend: name of the backend
+    :param backend_args: list with the params of the perceval backend
+    :param index: raw index
+    :param index_enrich: enriched index
+    :param project: project of the repository
+    """
+
+    def __init__(self, backend, backend_args, index=None, index_enrich=None, project=None):
+        self.backend = backend
+        self.backend_args = backend_args
+        self.index = index
+        self.index_enrich = index_enrich
+        self.project = project
+
+    @property
+    def host(self):
+        """Host of the repository, or the backend name if there is no URL in the params"""
+
+        for arg in self.backend_args:
+            host = urlparse(arg).netloc
+            if host:
+                return host
+
+        return self.backend
+
+    def __str__(self):
+        return "%s %s" % (self.backend, " ".join(self.backend_args))
+
+
+def load_jobs(path, backend=None, index=None, index_enrich=None):
+    """Read the jobs of a batch from a JSON file.
+
+    The file is either a list of jobs, with the fields backend (default
+    `backend`), backend_args, index, index_enrich and project, or a
+    projects.json file, with a job for each repository of `backend` in
+    each project, feeding `index` and `index_enrich`.
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    if isinstance(data, list):
+        return [FeedJob(job.get('backend', backend), job.get('backend_args', []),
+                        job.get('index', index), job.get('index_enrich', index_enrich),
+                        job.get('project')) for job in data]
+
+    ocean = get_connector_from_name(backend)[1]
+
+    jobs = []
+    for project, sections in data.items():
+        for url in sections.get(backend, []):
+            if len(url.split()) > 1:
+                logger.warning("Params of %s in project %s not supported in batches, skipped", url, project)
+                continue
+            jobs.append(FeedJob(backend, ocean.get_perceval_params_from_url(url),
+                                index, index_enrich, project))
+
+    return jobs
+
+
+class BatchScheduler:
+    """Run the jobs of a batch in a pool of threads.
+
+    Up to `workers` jobs run at the same time, and up to `host_workers`
+    for the same host, so the servers of the repositories are not
+    overloaded. The jobs share the objects of the process, like the
+    connections with ElasticSearch and SortingHat.
+
+    :param workers: number of jobs running at the same time
+    :param host_workers: number of jobs of the same host running at the same time
+    """
+
+    def __init__(self, workers=4, host_workers=2):
+        self.workers = workers
+        self.host_workers = max(host_workers, 1)
+
+    def run(self, jobs, run_job):
+        """Call run_job with each job.
+
+        :param jobs: list of FeedJob
+        :param run_job: function running a job, returning False or raising
+            an exception if it failed
+        :returns: the number of jobs failed
+        """
+        pending = list(jobs)
+        running = {}
+        host_running = collections.Counter()
+        failed = 0
+
+        logger.info("Running %i jobs with %i workers", len(pending), self.workers)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            while pending or running:
+                # Start the jobs of the hosts with free workers
+                waiting = []
+                for job in pending:
+                    if len(running) < self.workers and host_running[job.host] < self.host_workers:
+                        running[pool.submit(self.__run_job, run_job, job)] = job
+                        host_running[job.host] += 1
+                    else:
+                        waiting.append(job)
+                pending = waiting
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    host_running[job.host] -= 1
+                    if not future.result():
+                        failed += 1
+
+        logger.info("Finished %i jobs, %i failed", len(jobs), failed)
+
+        return failed
+
+    @staticmethod
+    def __run_job(run_job, job):
+        """Run a job, returning whether it succeeded"""
+
+        task_init = time()
+        logger.info("Running job %s", job)
+
+        try:
+            if run_job(job) is False:
+                logger.error("Job %s failed", job)
+                return False
+        except (Exception, SystemExit) as ex:
+            logger.error("Job %s failed: %s", job, ex)
+            return False
+
+        logger.info("Finished job %s in %.2f min", job, (time() - task_init) / 60)
+
+        return True
@@ -22,16 +22,18 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from dateutil import parser
 import json
 import logging
-import sys
-from time import time
+import os
+import threading
+from time import sleep, time
 
 import requests
 
-from grimoire_elk.errors import ELKError
-from grimoire_elk.enriched.utils import unixtime_to_datetime, grimoire_con
+from grimoire_elk.enriched.utils import unixtime_to_datetime, grimoire_con, json_dumps, json_loads
 
 
 logger = logging.getLogger(__name__)
@@ -45,11 +47,225 @@ class ElasticWriteException(Exception):
     message = "Can't write to ElasticSearch"
 
 
+class BulkWriter():
+    """Stream items to an ElasticSearch bulk endpoint in bounded packs.
+
+    Each document is serialized as a pair of NDJSON lines (action and source)
+    which are appended to a preallocated byte buffer. The buffer is sent to
+    ElasticSearch when it holds `max_items` documents or when adding a new
+    document would go beyond `max_bytes`, whichever comes first.
+
+    If the ElasticSearch object is configured with more than one bulk worker
+    the packs are uploaded in background threads, so the caller can keep
+    producing items while the previous packs are being uploaded.
+
+    :param elastic: ElasticSearch object used to upload the packs
+    :param url: bulk endpoint (default: items type in the elastic index)
+    :param max_items: max number of documents per pack (default: the bulk
+        size of the elastic index, which could be adaptive)
+    :param max_bytes: max size in bytes of a pack
+    """
+
+    def __init__(self, elastic, url=None, max_items=None, max_bytes=None):
+        self.elastic = elastic
+        self.url = url if url else elastic.index_url + '/items/_bulk'
+        self.max_items = max_items
+        self.max_bytes = max_bytes if max_bytes else elastic.max_bytes_bulk
+
+        self.buffer = bytearray(self.max_bytes)
+        self.size = 0  # bytes used in the buffer
+        self.current = 0  # documents in the buffer
+        self.total = 0  # documents inserted in ElasticSearch
+        self.pending = []  # packs being uploaded in background
+
+    def add(self, item, _id, update=False):
+        """Add an item to the current pack, sending it when full.
+
+        :param item: document to be indexed
+        :param _id: id of the document in the index
+        :param update: update only the fields in item of the document
+        """
+        if update:
+            action = b"update"
+            item = {"doc": item}
+        else:
+            action = b"index"
+        # bytes are not formatted with % before Python 3.5
+        data = b''.join([b'{"', action, b'":{"_id":', json_dumps(str(_id)), b'}}\n',
+                         json_dumps(item), b'\n'])
+
+        if self.current > 0 and self.size + len(data) > self.max_bytes:
+            self.flush()
+
+        self.buffer[self.size:self.size + len(data)] = data
+        self.size += len(data)
+        self.current += 1
+
+        max_items = self.max_items if self.max_items else self.elastic.get_bulk_size()
+        if self.current >= max_items:
+            self.flush()
+
+    def flush(self):
+        """Send the current pack to ElasticSearch.
+
+        :returns: the number of documents inserted from this pack
+        """
+        if self.current == 0:
+            return 0
+
+        task_init = time()
+
+        with memoryview(self.buffer) as view, view[:self.size] as bulk_json:
+            if self.elastic.bulk_workers > 1:
+                # The buffer is reused while the pack is uploaded
+                self.pending.append(self.elastic.safe_put_bulk_async(self.url, bulk_json.tobytes()))
+                self.__collect_pending()
+                inserted = 0
+            else:
+                inserted = self.elastic.safe_put_bulk(self.url, bulk_json)
+                self.total += inserted
+
+            logger.debug("bulk packet sent (%.2f sec, %i total, %.2f MB)",
+                         time() - task_init, self.total, self.size / (1024 * 1024))
+
+        if self.size > self.max_bytes:
+            # A single document bigger than the budget grew the buffer
+            self.buffer = bytearray(self.max_bytes)
+        self.size = 0
+        self.current = 0
+
+        return inserted
+
+    def __collect_pending(self, wait=False):
+        """Add to the total the inserted items from the uploaded packs"""
+
+        while self.pending and (wait or self.pending[0].done()):
+            self.total += self.pending.pop(0).result()
+
+    def close(self):
+        """Send the pending documents and wait for all the packs.
+
+        The threads uploading the packs are stopped if no other writer
+        of the index is using them.
+
+        :returns: the total number of documents inserted by this writer
+        """
+        try:
+            self.flush()
+            self.__collect_pending(wait=True)
+        finally:
+            # Packs left by a failed one
+            wait(self.pending)
+            self.elastic.shutdown_bulk_pool()
+        return self.total
+
+
+class ScrollContext():
+    """Track the scroll id of a search, clearing it in ElasticSearch on exit.
+
+    Use it as a context manager around the reading of the pages, so the
+    scroll is cleared when all the pages are read, when an exception is
+    raised and when a generator reading them is closed:
+
+        with elastic.scroll_context() as scroll:
+            page = ...
+            scroll.update(page['_scroll_id'])
+
+    The number of scrolls open by this process is available with
+    ScrollContext.get_open_scrolls().
+
+    :param elastic: ElasticSearch object where the scroll is done
+    """
+
+    open_scrolls = 0  # scrolls not cleared yet in this process
+    open_scrolls_lock = threading.Lock()
+
+    def __init__(self, elastic):
+        self.elastic = elastic
+        self.scroll_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
+
+    @classmethod
+    def get_open_scrolls(cls):
+        """Number of scrolls open by this process"""
+
+        return cls.open_scrolls
+
+    @classmethod
+    def __count_scrolls(cls, delta):
+        with cls.open_scrolls_lock:
+            cls.open_scrolls += delta
+
+    def update(self, scroll_id):
+        """Track the last scroll id returned by ElasticSearch"""
+
+        if not scroll_id:
+            return
+        if not self.scroll_id:
+            self.__count_scrolls(1)
+        self.scroll_id = scroll_id
+
+    def clear(self):
+        """Clear the scroll in ElasticSearch, releasing its resources"""
+
+        if not self.scroll_id:
+            return
+
+        scroll_id = self.scroll_id
+        self.scroll_id = None
+        self.__count_scrolls(-1)
+
+        headers = {"Content-Type": "application/json"}
+        try:
+            res = self.elastic.requests.delete(self.elastic.url + "/_search/scroll",
+                                               data=json.dumps({"scroll_id": [scroll_id]}),
+                                               headers=headers)
+            # 404 means the scroll already expired
+            if res.status_code not in [200, 404]:
+                logger.warning("Can't clear scroll in %s: %s", self.elastic.url, res.text)
+        except requests.exceptions.RequestException as ex:
+            logger.warning("Can't clear scroll in %s: %s", self.elastic.url, ex)
+
+
 class ElasticSearch(object):
 
-    max_items_bulk = 1000
+    max_items_bulk = 1000  # items per bulk request, the initial one if adaptive_bulk
+    max_bytes_bulk = 10 * 1024 * 1024  # max size of a bulk request (10 MB)
+    bulk_workers = 1  # bulk requests in flight, with 1 they are done synchronously
+    max_bulk_queue = 2  # packs ready to be uploaded while all workers are busy
+    max_bulk_retries = 5  # retries for the items rejected by an overloaded ES
+    bulk_retry_backoff = 1  # seconds to wait before the first retry, doubled each time
+    dead_letter_path = None  # dir for the NDJSON files with the failed items
+    gzip_requests = False  # compress with gzip the bodies of the requests
     max_items_clause = 1000  # max items in search clause (refresh identities)
 
+    # Adapt the items per bulk request of each index to the latency and
+    # rejections of ES, within adaptive_bulk_min and adaptive_bulk_max
+    adaptive_bulk = False
+    adaptive_bulk_min = 10
+    adaptive_bulk_max = 10000
+    adaptive_bulk_latency = 2  # target seconds per bulk request
+
+    # Share the HTTP session, the version of the ES instance and the indexes
+    # already set up between the ElasticSearch objects of the process, to
+    # feed several repositories in the same process
+    shared_connections = False
+    pool_size = 10  # HTTP connections kept open with ES
+    shared_lock = threading.Lock()
+    shared_sessions = {}  # HTTP session by insecure and gzip options
+    shared_majors = {}  # major version of the ES instance by url
+    shared_indexes = set()  # indexes created, checked or cleaned, with their mappings
+
+    # Indexing sessions running in the process by index url, with the
+    # refresh interval of the index before the first one started
+    index_sessions = {}
+    index_sessions_lock = threading.Lock()
+
     @classmethod
     def safe_index(cls, unique_id):
         """ Return a valid elastic index generated from unique_id """
@@ -93,7 +309,7 @@ class ElasticSearch(object):
         '''
 
         # Get major version of Elasticsearch instance
-        self.major = self._check_instance(url, insecure)
+        self.major = self.__get_major(url, insecure)
         logger.debug("Found version of ES instance at %s: %s.",
                      url, self.major)
 
@@ -104,7 +320,60 @@ class ElasticSearch(object):
         self.index_url = self.url + "/" + self.index
         self.wait_bulk_seconds = 2  # time to wait to complete a bulk operation
 
-        self.requests = grimoire_con(insecure)
+        self.requests = self.__get_session(insecure)
+
+        self.bulk_pool = None  # thread pool for the concurrent bulk requests
+        self.bulk_slots = None  # bounds the packs in flight or waiting
+        self.bulk_packs = 0  # packs in flight or waiting, the pool is kept while any
+        self.bulk_pool_lock = threading.Lock()
+
+        # Bulk requests force an index refresh except during indexing sessions
+        self.bulk_refresh = True
+        self.sessions = 0  # nested indexing sessions
+
+        self.dead_letter_lock = threading.Lock()
+
+        self.bulk_size = self.max_items_bulk  # current items per bulk request
+        self.bulk_size_lock = threading.Lock()
+
+        if not self.shared_connections:
+            self.__setup_index(mappings, clean, analyzers)
+            return
+
+        # The index is set up, and cleaned if clean, once and not by several
+        # objects at the same time, so the items written by the other
+        # objects sharing it are kept
+        with self.shared_lock:
+            if (self.index_url, mappings) not in self.shared_indexes:
+                self.__setup_index(mappings, clean, analyzers)
+                self.shared_indexes.add((self.index_url, mappings))
+
+    def __get_major(self, url, insecure):
+        """Major version of the ES instance, checked once if connections are shared"""
+
+        if not self.shared_connections:
+            return self._check_instance(url, insecure)
+
+        with self.shared_lock:
+            if url not in self.shared_majors:
+                self.shared_majors[url] = self._check_instance(url, insecure)
+            return self.shared_majors[url]
+
+    def __get_session(self, insecure):
+        """HTTP session with ES, the same one for all the objects if connections are shared"""
+
+        if not self.shared_connections:
+            return grimoire_con(insecure, gzip_requests=self.gzip_requests, pool_size=self.pool_size)
+
+        with self.shared_lock:
+            key = (insecure, self.gzip_requests)
+            if key not in self.shared_sessions:
+                self.shared_sessions[key] = grimoire_con(insecure, gzip_requests=self.gzip_requests,
+                                                         pool_size=self.pool_size)
+            return self.shared_sessions[key]
+
+    def __setup_index(self, mappings, clean, analyzers):
+        """Create the index if it doesn't exist, or again if clean, and its mappings"""
 
         res = self.requests.get(self.index_url)
 
@@ -132,77 +401,465 @@ class ElasticSearch(object):
             self.create_mappings(map_dict)
 
     def safe_put_bulk(self, url, bulk_json):
-        """ Bulk PUT controlling unicode issues """
-
+        """ Bulk PUT controlling unicode issues and failed items
+
+        The bulk (str, bytes or memoryview) must contain the action line
+        of each item followed by its document line, if any (`delete`
+        actions have none). It is compressed by the HTTP session if
+        `gzip_requests` is enabled. Items rejected because ElasticSearch
+        is overloaded (429) are sent again with exponential backoff, up
+        to `max_bulk_retries` times. Items failing for other causes (e.g.,
+        mapping errors) and the ones with no retries left are written to
+        the dead letter file of the index, if `dead_letter_path` is set,
+        so they can be replayed later. A single error is logged for them,
+        with the cause of the first one. With `adaptive_bulk` the latency
+        and rejections of the request are used to adapt the size of the
+        next ones.
+
+        :returns: the number of items inserted
+        """
         headers = {"Content-Type": "application/x-ndjson"}
 
-        try:
-            res = self.requests.put(url + '?refresh=true', data=bulk_json, headers=headers)
-            res.raise_for_status()
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logger.error("Encondig error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1', 'ignore')
+        if isinstance(bulk_json, str):
+            try:
+                bulk_json = bulk_json.encode('utf-8')
+            except UnicodeEncodeError:
+                # Related to surrogates in mbox data
+                logger.error("Encoding error ... removing not valid chars from bulk")
+                bulk_json = bulk_json.encode('utf-8', 'ignore')
+
+        if self.bulk_refresh:
+            url += '?refresh=true'
+
+        inserted_items = 0
+        dead_items = []
+        dead_error = None  # error of the first dead item
+        retries = 0
+        backoff = self.bulk_retry_backoff
+
+        # Stats of the first request to adapt the bulk size
+        bulk_bytes = len(bulk_json)
+        nitems = None
+        latency = None
+        rejected = False
+
+        while bulk_json:
+            task_init = time()
             res = self.requests.put(url, data=bulk_json, headers=headers)
-            res.raise_for_status()
+            if latency is None:
+                latency = time() - task_init
+
+            if res.status_code == 429 and retries < self.max_bulk_retries:
+                rejected = True
+                logger.warning("Bulk rejected by ES, retrying in %.1f sec (%s)", backoff, url)
+            else:
+                res.raise_for_status()
+                result = json_loads(res.content)
+
+                if nitems is None:
+                    nitems = len(result['items'])
+
+                if not result['errors']:
+                    inserted_items += len(result['items'])
+                    break
+
+                bulk_items = self.split_bulk(bulk_json)
+                retry_items = []
+                for item_lines, item in zip(bulk_items, result['items']):
+                    # The action could be index, update or delete
+                    action = list(item.values())[0]
+                    if 'error' not in action:
+                        inserted_items += 1
+                        continue
+                    if self.__is_rejected(action) and retries < self.max_bulk_retries:
+                        rejected = True
+                        retry_items.append(item_lines)
+                    else:
+                        if not dead_items:
+                            dead_error = action['error']
+                        dead_items.append(item_lines)
+
+                if not retry_items:
+                    break
+
+                logger.warning("%i items rejected by ES, retrying in %.1f sec (%s)",
+                               len(retry_items), backoff, url)
+                bulk_json = self.join_bulk(retry_items)
+
+            sleep(backoff)
+            backoff *= 2
+            retries += 1
+
+        if dead_items:
+            logger.error("Failed to insert %i items to ES: %s, %s", len(dead_items), str(dead_error), url)
+            self.__write_dead_letters(dead_items)
+
+        if self.adaptive_bulk and latency is not None:
+            self.__adapt_bulk_size(nitems, bulk_bytes, latency, rejected)
 
-        result = res.json()
-        failed_items = []
-        if result['errors']:
-            # Due to multiple errors that may be thrown when inserting bulk data, only the first error is returned
-            failed_items = [item['index'] for item in result['items'] if 'error' in item['index']]
-            error = str(failed_items[0]['error'])
+        logger.info("%i items uploaded to ES (%s)", inserted_items, url)
+        return inserted_items
+
+    def get_bulk_size(self):
+        """Number of items to send in the next bulk request"""
 
-            logger.error("Failed to insert data to ES: %s, %s", error, url)
+        return self.bulk_size if self.adaptive_bulk else self.max_items_bulk
+
+    def __adapt_bulk_size(self, nitems, nbytes, latency, rejected):
+        """Adapt the items per bulk request to the last request sent.
+
+        The size is halved when ES rejects items. Otherwise it is scaled
+        by the ratio between the target and the observed latency, growing
+        only after full packs. It never asks for packs beyond the bytes
+        budget, estimated from the size of the items sent.
+        """
+        with self.bulk_size_lock:
+            size = self.bulk_size
+
+            if rejected:
+                size //= 2
+            else:
+                factor = self.adaptive_bulk_latency / max(latency, 0.001)
+                factor = min(max(factor, 0.5), 1.25)
+                if factor < 1 or (nitems and nitems >= size):
+                    size = int(size * factor)
+
+            if nitems and nbytes:
+                size = min(size, int(self.max_bytes_bulk * nitems / nbytes))
+
+            size = min(max(size, self.adaptive_bulk_min), self.adaptive_bulk_max)
+
+            if size != self.bulk_size:
+                logger.debug("Bulk size for %s changed from %i to %i items (%.2f sec)",
+                             self.index_url, self.bulk_size, size, latency)
+            self.bulk_size = size
+
+    @staticmethod
+    def __is_rejected(action):
+        """Check whether a bulk action failed because ES was overloaded"""
+
+        error = action['error']
+        error_type = error.get('type', None) if isinstance(error, dict) else None
+
+        return action.get('status', None) == 429 or error_type == 'es_rejected_execution_exception'
+
+    @staticmethod
+    def split_bulk(bulk_json):
+        """Split a bulk body in the lines of each item.
 
-        inserted_items = len(result['items']) - len(failed_items)
+        Each item has an action line followed by its source line, but
+        for `delete` actions, which have no source.
+
+        :returns: a list with the list of lines of each item
+        """
+        items = []
+        lines = iter(bytes(bulk_json).splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            item_lines = [line]
+            if 'delete' not in json_loads(line):
+                item_lines.append(next(lines, b''))
+            items.append(item_lines)
+
+        return items
+
+    @staticmethod
+    def join_bulk(items):
+        """Build a bulk body with the lines of the items"""
+
+        return b''.join(line + b'\n' for item_lines in items for line in item_lines)
+
+    def get_dead_letter_file(self):
+        """Path of the NDJSON file with the items which failed in this index"""
+
+        if not self.dead_letter_path:
+            return None
+
+        return os.path.join(self.dead_letter_path, self.index + '.ndjson')
+
+    def __write_dead_letters(self, items):
+        """Append the lines of failed bulk items to the dead letter file"""
+
+        dead_letter_file = self.get_dead_letter_file()
+        if not dead_letter_file:
+            logger.error("%i items lost, dead letter path not set", len(items))
+            return
+
+        with self.dead_letter_lock:
+            os.makedirs(self.dead_letter_path, exist_ok=True)
+            with open(dead_letter_file, 'ab') as fd:
+                fd.write(self.join_bulk(items))
+
+        logger.warning("%i failed items written to %s", len(items), dead_letter_file)
+
+    def replay_dead_letters(self):
+        """Send again to the index the items in its dead letter file.
+
+        The file is renamed before replaying it, so the items failing
+        again are written to a new dead letter file.
+
+        :returns: the number of items inserted
+        """
+        dead_letter_file = self.get_dead_letter_file()
+        if not dead_letter_file or not os.path.exists(dead_letter_file):
+            return 0
+
+        replay_file = dead_letter_file + '.replay'
+        os.rename(dead_letter_file, replay_file)
+
+        url = self.index_url + '/items/_bulk'
+        inserted = 0
+        with open(replay_file, 'rb') as fd:
+            items = self.split_bulk(fd.read())
+        for pos in range(0, len(items), self.max_items_bulk):
+            inserted += self.safe_put_bulk(url, self.join_bulk(items[pos:pos + self.max_items_bulk]))
+
+        os.remove(replay_file)
+        logger.info("%i items replayed from %s", inserted, dead_letter_file)
+
+        return inserted
+
+    def scroll_context(self):
+        """Return a ScrollContext to clear the scroll of a search on exit"""
+
+        return ScrollContext(self)
+
+    def get_bulk_writer(self, url=None):
+        """Return a BulkWriter to upload items to this index"""
+
+        return BulkWriter(self, url)
+
+    def safe_put_bulk_async(self, url, bulk_json):
+        """Upload a bulk pack in a background thread.
+
+        At most `bulk_workers` packs are uploaded at the same time and
+        `max_bulk_queue` packs wait for a free worker. Beyond that, the
+        caller is blocked until a pack is done. The threads are started
+        with the first pack and stopped by `shutdown_bulk_pool`.
+
+        :returns: a future with the number of inserted items
+        """
+        with self.bulk_pool_lock:
+            if not self.bulk_pool:
+                self.bulk_pool = ThreadPoolExecutor(max_workers=self.bulk_workers)
+                self.bulk_slots = threading.BoundedSemaphore(self.bulk_workers + self.max_bulk_queue)
+            pool = self.bulk_pool
+            slots = self.bulk_slots
+            self.bulk_packs += 1
 
-        # The exception is currently not thrown to avoid stopping ocean uploading processes
         try:
-            if failed_items:
-                raise ELKError(cause=error)
-        except ELKError:
-            pass
+            slots.acquire()
+            try:
+                return pool.submit(self.__put_bulk_pack, slots, url, bulk_json)
+            except Exception:
+                slots.release()
+                raise
+        except Exception:
+            self.__end_bulk_pack()
+            raise
 
-        logger.info("%i items uploaded to ES (%s)", inserted_items, url)
-        return inserted_items
+    def __put_bulk_pack(self, slots, url, bulk_json):
+        """Upload a pack in a thread of the pool, freeing its slot when done"""
 
-    def bulk_upload(self, items, field_id):
-        """Upload in controlled packs items to ES using bulk API"""
+        try:
+            return self.safe_put_bulk(url, bulk_json)
+        finally:
+            slots.release()
+            self.__end_bulk_pack()
+
+    def __end_bulk_pack(self):
+        """Count a pack as uploaded, or failed"""
+
+        with self.bulk_pool_lock:
+            self.bulk_packs -= 1
+
+    def shutdown_bulk_pool(self):
+        """Stop the threads uploading bulk packs, if there are no packs left.
+
+        The pool is started again if more packs are uploaded.
+        """
+        with self.bulk_pool_lock:
+            if not self.bulk_pool or self.bulk_packs > 0:
+                return
+            pool = self.bulk_pool
+            self.bulk_pool = None
+            self.bulk_slots = None
 
-        current = 0
-        new_items = 0  # total items added with bulk
-        bulk_json = ""
+        pool.shutdown()
+
+    def bulk_upload(self, items, field_id, update=False):
+        """Upload in controlled packs items to ES using bulk API. With update
+        only the fields in the items are changed in the existing documents"""
 
         if not items:
-            return new_items
+            return 0
 
-        url = self.index_url + '/items/_bulk'
+        writer = self.get_bulk_writer()
 
-        logger.debug("Adding items to %s (in %i packs)" % (url, self.max_items_bulk))
-        task_init = time()
+        logger.debug("Adding items to %s (in %i packs)" % (writer.url, self.max_items_bulk))
 
         for item in items:
-            if current >= self.max_items_bulk:
-                task_init = time()
-                new_items += self.safe_put_bulk(url, bulk_json)
-                current = 0
-                json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                logger.debug("bulk packet sent (%.2f sec, %i total, %.2f MB)"
-                             % (time() - task_init, new_items, json_size))
-                bulk_json = ""
-            data_json = json.dumps(item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (item[field_id])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-
-        if current > 0:
-            new_items += self.safe_put_bulk(url, bulk_json)
-            json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-            logger.debug("bulk packet sent (%.2f sec prev, %i total, %.2f MB)"
-                         % (time() - task_init, new_items, json_size))
-
-        return new_items
+            writer.add(item, item[field_id], update)
+
+        return writer.close()
+
+    def refresh(self):
+        """Refresh the index so all the items written are visible to searches.
+
+        Use it when items must be read just after being written, for
+        instance during an indexing session.
+        """
+        res = self.requests.post(self.index_url + '/_refresh')
+        res.raise_for_status()
+
+    def __set_refresh_interval(self, refresh_interval):
+
+        headers = {"Content-Type": "application/json"}
+
+        settings = {"index": {"refresh_interval": refresh_interval}}
+        res = self.requests.put(self.index_url + '/_settings', data=json.dumps(settings),
+                                headers=headers)
+        res.raise_for_status()
+
+    def start_indexing_session(self):
+        """Start a bulk indexing session in the index.
+
+        The refresh of the index is disabled and bulk requests are sent
+        without forcing a refresh, until the session is ended. Sessions
+        can be nested and run at the same time in several objects of the
+        process, only the first one changes the index settings.
+        """
+        if self.sessions > 0:
+            self.sessions += 1
+            return
+
+        with self.index_sessions_lock:
+            session = self.index_sessions.get(self.index_url, None)
+            if session:
+                session['count'] += 1
+            else:
+                self.__start_index_session()
+
+        self.sessions = 1
+        self.bulk_refresh = False
+
+    def __start_index_session(self):
+        """Disable the refresh of the index, saving its refresh interval"""
+
+        res = self.requests.get(self.index_url + '/_settings')
+        res.raise_for_status()
+        # The index could be an alias so the name of the real index is not known
+        index_settings = list(res.json().values())[0]['settings']['index']
+        refresh_interval = index_settings.get('refresh_interval', None)
+        if refresh_interval == '-1':
+            # Left by a session which was not ended, use the default value
+            logger.warning("Refresh disabled in %s, it will be enabled after indexing", self.index_url)
+            refresh_interval = None
+
+        self.__set_refresh_interval('-1')
+        self.index_sessions[self.index_url] = {'count': 1, 'refresh_interval': refresh_interval}
+        logger.debug("Indexing session started in %s", self.index_url)
+
+    def end_indexing_session(self):
+        """End a bulk indexing session in the index.
+
+        The index refresh interval is restored by the last session of the
+        process, and the index is refreshed, so the items written during
+        the session are visible to searches.
+        """
+        if self.sessions == 0:
+            return
+        self.sessions -= 1
+        if self.sessions > 0:
+            return
+
+        self.bulk_refresh = True
+
+        with self.index_sessions_lock:
+            session = self.index_sessions[self.index_url]
+            session['count'] -= 1
+            if session['count'] == 0:
+                del self.index_sessions[self.index_url]
+                self.__set_refresh_interval(session['refresh_interval'])
+                logger.debug("Indexing session ended in %s", self.index_url)
+
+        self.refresh()
+
+    @contextmanager
+    def indexing_session(self):
+        """Context manager for bulk indexing sessions"""
+
+        self.start_indexing_session()
+        try:
+            yield self
+        finally:
+            self.end_indexing_session()
+
+    def update_by_query(self, query, script, params):
+        """Update in Elasticsearch the items matching a query with a painless script.
+
+        The items modified meanwhile (version conflicts) are not updated.
+
+        :param query: query of the items to update
+        :param script: source of the painless script
+        :param params: params of the script
+        :returns: number of items updated
+        """
+        url = self.index_url + '/_update_by_query?conflicts=proceed'
+        if self.bulk_refresh:
+            url += '&refresh=true'
+
+        data = {
+            "query": query,
+            "script": {
+                "source": script,
+                "lang": "painless",
+                "params": params
+            }
+        }
+
+        headers = {"Content-Type": "application/json"}
+        res = self.requests.post(url, data=json_dumps(data), headers=headers)
+        res.raise_for_status()
+
+        result = json_loads(res.content)
+        for failure in result.get('failures', []):
+            logger.error("Failed to update item in %s: %s", self.index_url, failure)
+        if result.get('version_conflicts', 0):
+            logger.warning("%i items modified while being updated in %s",
+                           result['version_conflicts'], self.index_url)
+
+        return result.get('updated', 0)
+
+    def get_metadata(self, _type='items'):
+        """Get the metadata stored in the mapping (`_meta` field) of the index"""
+
+        res = self.requests.get(self.index_url + '/_mapping')
+        res.raise_for_status()
+
+        # The index could be an alias so the name of the real index is not known
+        mappings = list(json_loads(res.content).values())[0]['mappings']
+        if int(self.major) < 7:
+            mappings = mappings.get(_type, {})
+
+        return mappings.get('_meta', {})
+
+    def set_metadata(self, metadata, _type='items'):
+        """Add some fields to the metadata stored in the mapping of the index.
+
+        :param metadata: dict with the fields to add or update
+        """
+        index_metadata = self.get_metadata(_type)
+        index_metadata.update(metadata)
+
+        url_map = self.index_url + '/_mapping'
+        if int(self.major) < 7:
+            url_map = self.index_url + '/' + _type + '/_mapping'
+
+        headers = {"Content-Type": "application/json"}
+        res = self.requests.put(url_map, data=json.dumps({"_meta": index_metadata}), headers=headers)
+        res.raise_for_status()
 
     def create_mappings(self, mappings):
 
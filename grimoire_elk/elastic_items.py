@@ -24,10 +24,11 @@
 """Generates items from ElasticSearch based on filters """
 
 
+import heapq
 import json
 import logging
 
-from .enriched.utils import get_repository_filter, grimoire_con
+from .enriched.utils import get_repository_filter, grimoire_con, json_loads, prefetch
 from .elastic_mapping import Mapping
 
 logger = logging.getLogger(__name__)
@@ -41,6 +42,20 @@ class ElasticItems():
     # Change it from p2o command line or mordred config
     scroll_size = 100
 
+    gzip_requests = False  # compress with gzip the bodies of the requests
+
+    # Read the items with search_after instead of scroll
+    # Change it from p2o command line
+    use_search_after = False
+    pit_keep_alive = "10m"  # time to keep the point in time between pages
+
+    # Number of slices of the scroll read in parallel, 1 disables slicing
+    scroll_slices = 1
+
+    # Pages read in a background thread while the current one is processed,
+    # 0 disables it. Slices are always read in advance.
+    prefetch_pages = 0
+
     def __init__(self, perceval_backend, from_date=None, insecure=True, offset=None):
 
         self.perceval_backend = perceval_backend
@@ -49,8 +64,10 @@ class ElasticItems():
         self.offset = offset  # fetch from offset
         self.filter_raw = None  # to filter raw items from Ocean
         self.filter_raw_should = None  # to filter raw items from Ocean
+        self.cursor = None  # sort values of the last item read with search_after
+        self.resume_cursor = None  # sort values of the item to start each search_after reading after
 
-        self.requests = grimoire_con(insecure)
+        self.requests = grimoire_con(insecure, gzip_requests=self.gzip_requests)
         self.elastic = None
         self.elastic_url = None
 
@@ -84,42 +101,308 @@ class ElasticItems():
         return get_connector_name(type(self))
 
     # Items generator
-    def fetch(self, _filter=None):
+    def fetch(self, _filter=None, _source=None):
         """ Fetch the items from raw or enriched index. An optional _filter
-        could be provided to filter the data collected """
+        could be provided to filter the data collected (the items with any
+        of its values in its field, or in any of its list of fields), and the fields read
+        from each item could be limited with the _source list. The next
+        pages are read in advance if prefetch_pages is set """
 
         logger.debug("Creating a elastic items generator.")
 
-        scroll_id = None
-        page = self.get_elastic_items(scroll_id, _filter=_filter)
+        if self.use_search_after:
+            yield from self.fetch_search_after(_filter, _source)
+            return
+
+        if self.scroll_slices > 1:
+            yield from self.fetch_sliced(_filter, _source)
+            return
+
+        for hits in prefetch(self.__scroll_pages(_filter, _source=_source), self.prefetch_pages):
+            for hit in hits:
+                yield hit['_source']
+
+        logger.debug("Fetching from %s: done receiving", self.elastic.index_url)
+
+    def __scroll_pages(self, _filter=None, _slice=None, _source=None):
+        """ Generator of the hits of each page of the scroll. The scroll
+        is cleared when the generator ends or it is closed """
+
+        with self.elastic.scroll_context() as scroll:
+            page = self.get_elastic_items(None, _filter=_filter, _slice=_slice, _source=_source)
+
+            if not page:
+                return
+
+            scroll.update(page.get('_scroll_id'))
+
+            if not page['hits']['hits'] and not _slice:
+                logger.warning("No results found from %s", self.elastic.index_url)
+                return
+
+            while page and page['hits']['hits']:
+                logger.debug("Fetching from %s: %d received", self.elastic.index_url, len(page['hits']['hits']))
+                yield page['hits']['hits']
+
+                page = self.get_elastic_items(page['_scroll_id'], _filter=_filter)
+                if page:
+                    scroll.update(page.get('_scroll_id'))
+
+    def fetch_sliced(self, _filter=None, _source=None):
+        """ Fetch the items from raw or enriched index reading the slices of
+        the scroll in parallel.
+
+        Each slice is scrolled in its own thread. The items of the slices
+        are sorted by the incremental date, and they are merged keeping
+        that order, so the incremental enrichment can be resumed as with
+        a single scroll.
+        """
+        nslices = self.scroll_slices
+        depth = max(self.prefetch_pages, 1)
+
+        slices_pages = [prefetch(self.__scroll_pages(_filter, (slice_id, nslices), _source), depth)
+                        for slice_id in range(nslices)]
+        slices_hits = [(hit for hits in pages for hit in hits) for pages in slices_pages]
+
+        try:
+            heads = []
+            for slice_id, hits in enumerate(slices_hits):
+                hit = next(hits, None)
+                if hit:
+                    heapq.heappush(heads, (self.__hit_sort_key(hit), slice_id, hit))
+
+            if not heads:
+                logger.warning("No results found from %s", self.elastic.index_url)
+
+            while heads:
+                _, slice_id, hit = heapq.heappop(heads)
+                yield hit['_source']
+
+                hit = next(slices_hits[slice_id], None)
+                if hit:
+                    heapq.heappush(heads, (self.__hit_sort_key(hit), slice_id, hit))
+        finally:
+            for pages in slices_pages:
+                pages.close()
+
+        logger.debug("Fetching from %s: done receiving", self.elastic.index_url)
+
+    @staticmethod
+    def __hit_sort_key(hit):
+        """ Key to merge the hits by their sort value, 0 if the items are
+        not sorted. Hits with no value go last, as ElasticSearch sorts them """
+
+        value = hit['sort'][0] if 'sort' in hit else 0
+        return (value is None, value if value is not None else 0)
+
+    def set_cursor(self, cursor):
+        """ Resume reading with search_after just after the item with the
+        sort values in cursor, as exposed in self.cursor. All the following
+        readings start after that item. """
+        self.resume_cursor = cursor
+
+    def fetch_search_after(self, _filter=None, _source=None):
+        """ Fetch the items from raw or enriched index using search_after.
+
+        Items are sorted by the incremental date and the uuid, so the
+        reading can be resumed exactly after the last item read, which
+        is available in self.cursor. Every reading starts from the cursor
+        set with set_cursor, or from the first item. A point in time is
+        used if the ElasticSearch version supports it.
+        """
+        self.cursor = self.resume_cursor
+
+        for hits in prefetch(self.__search_after_pages(_filter, _source), self.prefetch_pages):
+            for hit in hits:
+                # The point in time adds a tie breaker not valid across runs
+                self.cursor = hit['sort'][:2]
+                yield hit['_source']
+
+        logger.debug("Fetching from %s: done receiving", self.elastic.index_url)
+
+    def __search_after_pages(self, _filter=None, _source=None):
+        """ Generator of the hits of each page read with search_after """
 
-        if not page:
-            return []
+        pit_id = self.__open_pit()
+        search_after = None
+        received = 0
 
-        scroll_id = page["_scroll_id"]
-        scroll_size = page['hits']['total']
+        try:
+            while True:
+                page = self.get_elastic_items_search_after(search_after, pit_id, _filter=_filter,
+                                                           _source=_source)
+                if not page or not page['hits']['hits']:
+                    break
+
+                pit_id = page.get('pit_id', pit_id)
+                hits = page['hits']['hits']
+                received += len(hits)
+                logger.debug("Fetching from %s: %d received", self.elastic.index_url, received)
+
+                yield hits
 
-        if scroll_size == 0:
+                search_after = hits[-1]['sort']
+        finally:
+            self.__close_pit(pit_id)
+
+        if received == 0:
             logger.warning("No results found from %s", self.elastic.index_url)
+
+    def __open_pit(self):
+        """ Open a point in time in the index. Returns None if it is not supported """
+
+        if not self.elastic or int(self.elastic.major) < 7:
+            return None
+
+        res = self.requests.post(self.elastic.index_url + "/_pit?keep_alive=" + self.pit_keep_alive)
+        if res.status_code != 200:
+            # Point in time is available since ES 7.10
+            logger.debug("Point in time not available in %s", self.elastic.url)
+            return None
+
+        return res.json()['id']
+
+    def __close_pit(self, pit_id):
+
+        if not pit_id:
             return
 
-        while scroll_size > 0:
+        headers = {"Content-Type": "application/json"}
+        res = self.requests.delete(self.elastic.url + "/_pit", data=json.dumps({"id": pit_id}),
+                                   headers=headers)
+        if res.status_code != 200:
+            logger.warning("Can't close point in time in %s", self.elastic.url)
 
-            logger.debug("Fetching from %s: %d received", self.elastic.index_url, len(page['hits']['hits']))
-            for item in page['hits']['hits']:
-                eitem = item['_source']
-                yield eitem
+    def get_elastic_items_search_after(self, search_after=None, pit_id=None, _filter=None, _source=None):
+        """ Get a page of items sorted by incremental date and uuid, starting
+        after the search_after sort values or after self.resume_cursor. Only the
+        fields in _source are returned if it is provided """
 
-            page = self.get_elastic_items(scroll_id, _filter=_filter)
-            scroll_size = len(page['hits']['hits'])
+        headers = {"Content-Type": "application/json",
+                   "Accept-Encoding": "gzip"}
 
-        logger.debug("Fetching from %s: done receiving", self.elastic.index_url)
+        if not self.elastic:
+            return None
+
+        date_field = self.get_incremental_date()
+
+        filters = self.get_elastic_filters(_filter)
+        filters = json.loads("[" + filters + "]")
+        if self.resume_cursor and not search_after:
+            # Resume after the item in the cursor
+            filters.append({"bool": {"should": [
+                {"range": {date_field: {"gt": self.resume_cursor[0]}}},
+                {"bool": {"must": [
+                    {"term": {date_field: self.resume_cursor[0]}},
+                    {"range": {"uuid": {"gt": self.resume_cursor[1]}}}
+                ]}}
+            ]}})
+
+        query = {
+            "size": self.scroll_size,
+            "sort": [
+                {date_field: {"order": "asc"}},
+                {"uuid": {"order": "asc", "unmapped_type": "keyword"}}
+            ]
+        }
+        # Avoid empty list of filters, ES 6.x doesn't like it
+        if filters:
+            query["query"] = {"bool": {"must": filters}}
+        if search_after:
+            query["search_after"] = search_after
+        if _source:
+            query["_source"] = _source
+
+        if pit_id:
+            # The index is part of the point in time
+            url = self.elastic.url + "/_search"
+            query["pit"] = {"id": pit_id, "keep_alive": self.pit_keep_alive}
+        else:
+            url = self.elastic.index_url + "/_search"
 
-    def get_elastic_items(self, elastic_scroll_id=None, _filter=None):
+        rjson = None
+        res = self.requests.post(url, data=json.dumps(query), headers=headers)
+        try:
+            res.raise_for_status()
+            rjson = json_loads(res.content)
+        except Exception:
+            # The index could not exists yet or it could be empty
+            logger.warning("No JSON found in %s" % (res.text))
+            logger.warning("No results found from %s" % (url))
+
+        return rjson
+
+    def get_elastic_filters(self, _filter=None):
+        """ Get the filters for the query of the items as a string with
+        the JSON filters separated by commas """
+
+        # If using a perceval backends always filter by repository
+        # to support multi repository indexes
+        # We need the filter dict as a string to join with the rest
+        filters_dict = self.get_repository_filter_raw(term=True)
+        if filters_dict:
+            filters = json.dumps(filters_dict)
+        else:
+            filters = ''
+
+        if self.filter_raw:
+            filters += '''
+                , {"term":
+                    { "%s":"%s"  }
+                }
+            ''' % (self.filter_raw['name'], self.filter_raw['value'])
+
+        if _filter and isinstance(_filter['name'], list):
+            # Items with any of the values in any of the fields
+            terms = [{"terms": {name: _filter['value']}} for name in _filter['name']]
+            filters += ", " + json.dumps({"bool": {"should": terms, "minimum_should_match": 1}})
+        elif _filter:
+            filter_str = '''
+                , {"terms":
+                    { "%s": %s }
+                }
+            ''' % (_filter['name'], _filter['value'])
+            # List to string conversion uses ' that are not allowed in JSON
+            filter_str = filter_str.replace("'", "\"")
+            filters += filter_str
+
+        if self.from_date:
+            date_field = self.get_incremental_date()
+            from_date = self.from_date.isoformat()
+
+            filters += '''
+                , {"range":
+                    {"%s": {"gte": "%s"}}
+                }
+            ''' % (date_field, from_date)
+        elif self.offset:
+            filters += '''
+                , {"range":
+                    {"offset": {"gte": %i}}
+                }
+            ''' % (self.offset)
+
+        if self.filter_raw_should:
+            filters_should = json.dumps(self.filter_raw_should)[1:-1]
+            # We need to add a bool should query to the outer must query
+            query_should = '{"bool": {%s}}' % filters_should
+            filters += ", " + query_should
+
+        # Fix the filters string if it starts with "," (empty first filter)
+        if filters.lstrip().startswith(','):
+            filters = filters.lstrip()[1:]
+
+        return filters
+
+    def get_elastic_items(self, elastic_scroll_id=None, _filter=None, _slice=None, _source=None):
         """ Get the items from the index related to the backend applying and
-        optional _filter if provided"""
+        optional _filter if provided. The scroll could be limited to one
+        of its slices with _slice, a tuple with the slice id and the number
+        of slices, and the fields returned to the ones in the _source list """
 
-        headers = {"Content-Type": "application/json"}
+        # Pages are big and very redundant, so ask for them compressed
+        headers = {"Content-Type": "application/json",
+                   "Accept-Encoding": "gzip"}
 
         if not self.elastic:
             return None
@@ -141,47 +424,7 @@ class ElasticItems():
             }
             query_data = json.dumps(scroll_data)
         else:
-            # If using a perceval backends always filter by repository
-            # to support multi repository indexes
-            # We need the filter dict as a string to join with the rest
-            filters_dict = self.get_repository_filter_raw(term=True)
-            if filters_dict:
-                filters = json.dumps(filters_dict)
-            else:
-                filters = ''
-
-            if self.filter_raw:
-                filters += '''
-                    , {"term":
-                        { "%s":"%s"  }
-                    }
-                ''' % (self.filter_raw['name'], self.filter_raw['value'])
-
-            if _filter:
-                filter_str = '''
-                    , {"terms":
-                        { "%s": %s }
-                    }
-                ''' % (_filter['name'], _filter['value'])
-                # List to string conversion uses ' that are not allowed in JSON
-                filter_str = filter_str.replace("'", "\"")
-                filters += filter_str
-
-            if self.from_date:
-                date_field = self.get_incremental_date()
-                from_date = self.from_date.isoformat()
-
-                filters += '''
-                    , {"range":
-                        {"%s": {"gte": "%s"}}
-                    }
-                ''' % (date_field, from_date)
-            elif self.offset:
-                filters += '''
-                    , {"range":
-                        {"offset": {"gte": %i}}
-                    }
-                ''' % (self.offset)
+            filters = self.get_elastic_filters(_filter)
 
             # Order the raw items from the old ones to the new so if the
             # enrich process fails, it could be resume incrementally
@@ -192,17 +435,6 @@ class ElasticItems():
             if order_field is not None:
                 order_query = ', "sort": { "%s": { "order": "asc" }} ' % order_field
 
-            filters_should = ''
-            if self.filter_raw_should:
-                filters_should = json.dumps(self.filter_raw_should)[1:-1]
-                # We need to add a bool should query to the outer must query
-                query_should = '{"bool": {%s}}' % filters_should
-                filters += ", " + query_should
-
-            # Fix the filters string if it starts with "," (empty first filter)
-            if filters.lstrip().startswith(','):
-                filters = filters.lstrip()[1:]
-
             filters_dict = json.loads("[" + filters + "]")
             if len(filters_dict) == 0:
                 # Avoid empty list of filters, ES 6.x doesn't like it
@@ -225,6 +457,14 @@ class ElasticItems():
                 }
                 """ % (filters, order_query)
 
+            if _slice or _source:
+                query_dict = json.loads(query)
+                if _slice:
+                    query_dict['slice'] = {"id": _slice[0], "max": _slice[1]}
+                if _source:
+                    query_dict['_source'] = _source
+                query = json.dumps(query_dict)
+
             logger.debug("Raw query to %s\n%s", url, json.dumps(json.loads(query), indent=4))
             query_data = query
 
@@ -233,7 +473,7 @@ class ElasticItems():
         try:
             res = self.requests.post(url, data=query_data, headers=headers)
             res.raise_for_status()
-            rjson = res.json()
+            rjson = json_loads(res.content)
         except Exception:
             # The index could not exists yet or it could be empty
             logger.warning("No JSON found in %s" % (res.text))
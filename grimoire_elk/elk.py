@@ -22,9 +22,9 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import calendar
 import inspect
 import logging
-import pickle
 import traceback
 
 import redis
@@ -32,57 +32,83 @@ import redis
 from datetime import datetime
 from dateutil import parser
 
-from arthur.common import Q_STORAGE_ITEMS
 from perceval.backend import find_signature_parameters, Archive
 
+from .arthur_queue import ArthurQueue
 from .utils import get_elastic
 from .utils import get_connectors, get_connector_from_name
-from .enriched.sortinghat_gelk import SortingHat
-from .enriched.utils import get_last_enrich, grimoire_con
+from .enriched.sortinghat_gelk import BULK_CHUNK_SIZE, SortingHat
+from .enriched.utils import chunks, get_last_enrich, grimoire_con
 
 
 logger = logging.getLogger(__name__)
 
 requests_ses = grimoire_con()
 
-arthur_items = {}  # Hash with tag list with all items collected from arthur queue
-
-
-def feed_arthur():
-    """ Feed Ocean with backend data collected from arthur redis queue"""
-
-    logger.info("Collecting items from redis queue")
-
-    db_url = 'redis://localhost/8'
-
-    conn = redis.StrictRedis.from_url(db_url)
-    logger.debug("Redis connection stablished with %s.", db_url)
-
-    # Get and remove queued items in an atomic transaction
-    pipe = conn.pipeline()
-    pipe.lrange(Q_STORAGE_ITEMS, 0, -1)
-    pipe.ltrim(Q_STORAGE_ITEMS, 1, 0)
-    items = pipe.execute()[0]
-
-    for item in items:
-        arthur_item = pickle.loads(item)
-        if arthur_item['tag'] not in arthur_items:
-            arthur_items[arthur_item['tag']] = []
-        arthur_items[arthur_item['tag']].append(arthur_item)
-
-    for tag in arthur_items:
-        logger.debug("Items for %s: %i", tag, len(arthur_items[tag]))
+ARTHUR_REDIS_URL = 'redis://localhost/8'
+
+SH_REFRESH_CHECKPOINT = 'sortinghat_refresh_checkpoint'  # index metadata with the last SH modification refreshed
+
+UPDATE_BY_QUERY_UUIDS = 500  # uuids refreshed by each update_by_query
+
+# Set the SH fields of the roles of an item with one of the unique identities
+# in the params, with the organization of the enrollment including the item date
+# (epoch millis, or an ISO date with or without time and offset)
+REFRESH_IDENTITIES_SCRIPT = """
+    boolean hasDate = false;
+    long date = 0L;
+    def value = ctx._source[params.date_field];
+    if (value instanceof Number) {
+        date = value.longValue();
+        hasDate = true;
+    } else if (value != null) {
+        String dateStr = value.toString();
+        try {
+            date = ZonedDateTime.parse(dateStr).toInstant().toEpochMilli();
+            hasDate = true;
+        } catch (Exception e1) {
+            try {
+                date = LocalDateTime.parse(dateStr).toInstant(ZoneOffset.UTC).toEpochMilli();
+                hasDate = true;
+            } catch (Exception e2) {
+                try {
+                    date = LocalDate.parse(dateStr).atStartOfDay(ZoneOffset.UTC).toInstant().toEpochMilli();
+                    hasDate = true;
+                } catch (Exception e3) {
+                    // Not a date, the item is refreshed as the ones without date
+                }
+            }
+        }
+    }
+    for (String rol : params.roles) {
+        def uuid = ctx._source[rol + '_uuid'];
+        def id = ctx._source[rol + '_id'];
+        if (id != null && params.ids.containsKey(id)) {
+            uuid = params.ids[id];
+        }
+        if (uuid == null || !params.identities.containsKey(uuid)) {
+            continue;
+        }
+        def identity = params.identities[uuid];
+        ctx._source[rol + '_uuid'] = uuid;
+        for (def field : identity.fields.entrySet()) {
+            ctx._source[rol + field.getKey()] = field.getValue();
+        }
+        String org = params.unaffiliated;
+        for (def enrollment : identity.enrollments) {
+            if (!hasDate || (date >= enrollment[0] && date <= enrollment[1])) {
+                org = enrollment[2];
+                break;
+            }
+        }
+        ctx._source[rol + '_org_name'] = org;
+    }
+"""
 
 
 def feed_backend_arthur(backend_name, backend_params):
-    """ Feed Ocean with backend data collected from arthur redis queue"""
-
-    # Always get pending items from arthur for all data sources
-    feed_arthur()
+    """ Consumer of the backend data collected in arthur redis queue """
 
-    logger.debug("Items available for %s", arthur_items.keys())
-
-    # Get only the items for the backend
     if not get_connector_from_name(backend_name):
         raise RuntimeError("Unknown backend %s" % backend_name)
     connector = get_connector_from_name(backend_name)
@@ -93,17 +119,19 @@ def feed_backend_arthur(backend_name, backend_params):
     tag = backend_cmd.backend.tag
     logger.debug("Getting items for %s.", tag)
 
-    if tag in arthur_items:
-        logger.debug("Found items for %s.", tag)
-        for item in arthur_items[tag]:
-            yield item
+    conn = redis.StrictRedis.from_url(ARTHUR_REDIS_URL)
+    logger.debug("Redis connection stablished with %s.", ARTHUR_REDIS_URL)
+
+    return ArthurQueue(conn, tag)
 
 
 def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
                  es_index=None, es_index_enrich=None, project=None, arthur=False):
-    """ Feed Ocean with backend data """
+    """ Feed Ocean with backend data. The error feeding it, if any, is
+    logged and returned """
 
     backend = None
+    error = None
     repo = {'backend_name': backend_name, 'backend_params': backend_params}  # repository data to be stored in conf
 
     if es_index:
@@ -181,32 +209,37 @@ def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
                 latest_items = backend_cmd.parsed_args.latest_items
 
         # fetch params support
-        if arthur:
-            # If using arthur just provide the items generator to be used
-            # to collect the items and upload to Elasticsearch
-            aitems = feed_backend_arthur(backend_name, backend_params)
-            ocean_backend.feed(arthur_items=aitems)
-        elif latest_items:
-            if category:
-                ocean_backend.feed(latest_items=latest_items, category=category)
-            else:
-                ocean_backend.feed(latest_items=latest_items)
-        elif offset:
-            if category:
-                ocean_backend.feed(from_offset=offset, category=category)
-            else:
-                ocean_backend.feed(from_offset=offset)
-        elif from_date and from_date.replace(tzinfo=None) != parser.parse("1970-01-01"):
-            if category:
-                ocean_backend.feed(from_date, category=category)
+        # Index refresh is disabled while feeding and done once at the end
+        with elastic_ocean.indexing_session():
+            if arthur:
+                # If using arthur just provide the items generator to be used
+                # to collect the items and upload to Elasticsearch. They are
+                # removed from the queue once uploaded.
+                arthur_queue = feed_backend_arthur(backend_name, backend_params)
+                ocean_backend.feed(arthur_items=arthur_queue.items())
+                arthur_queue.ack()
+            elif latest_items:
+                if category:
+                    ocean_backend.feed(latest_items=latest_items, category=category)
+                else:
+                    ocean_backend.feed(latest_items=latest_items)
+            elif offset:
+                if category:
+                    ocean_backend.feed(from_offset=offset, category=category)
+                else:
+                    ocean_backend.feed(from_offset=offset)
+            elif from_date and from_date.replace(tzinfo=None) != parser.parse("1970-01-01"):
+                if category:
+                    ocean_backend.feed(from_date, category=category)
+                else:
+                    ocean_backend.feed(from_date)
+            elif category:
+                ocean_backend.feed(category=category)
             else:
-                ocean_backend.feed(from_date)
-        elif category:
-            ocean_backend.feed(category=category)
-        else:
-            ocean_backend.feed()
+                ocean_backend.feed()
 
     except Exception as ex:
+        error = ex
         if backend:
             logger.error("Error feeding ocean from %s (%s): %s", backend_name, backend.origin, ex)
             # this print makes blackbird fails
@@ -217,6 +250,8 @@ def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
 
     logger.info("Done %s " % (backend_name))
 
+    return error
+
 
 def get_items_from_uuid(uuid, enrich_backend, ocean_backend):
     """ Get all items that include uuid """
@@ -291,7 +326,7 @@ def refresh_projects(enrich_backend):
     logger.debug("Refreshing project field in %s", enrich_backend.elastic.index_url)
     total = 0
 
-    eitems = enrich_backend.fetch()
+    eitems = enrich_backend.fetch(_source=enrich_backend.get_project_fields())
     for eitem in eitems:
         new_project = enrich_backend.get_item_project(eitem)
         eitem.update(new_project)
@@ -309,24 +344,30 @@ def refresh_identities(enrich_backend, filter_author=None):
     SortingHat database.
 
     Instead of the whole index, only items matching the filter_author
-    filter are fitered, if that parameters is not None.
+    filter are fitered, if that parameters is not None. Its name can be
+    a list of fields, to match the items with the values in any of them.
 
     :param enrich_backend: enriched backend to update
     :param  filter_author: filter to use to match items
     """
 
+    roles = None
+    try:
+        roles = enrich_backend.roles
+    except AttributeError:
+        pass
+    fields = enrich_backend.get_identities_fields(roles)
+
     def update_items(new_filter_author):
 
-        for eitem in enrich_backend.fetch(new_filter_author):
-            # logger.info(eitem)
-            roles = None
-            try:
-                roles = enrich_backend.roles
-            except AttributeError:
-                pass
-            new_identities = enrich_backend.get_item_sh_from_id(eitem, roles)
-            eitem.update(new_identities)
-            yield eitem
+        eitems = enrich_backend.fetch(new_filter_author, _source=fields)
+        for eitems_chunk in chunks(eitems, enrich_backend.enrich_chunk_size):
+            enrich_backend.resolve_sh_ids(eitems_chunk, roles)
+            for eitem in eitems_chunk:
+                # logger.info(eitem)
+                new_identities = enrich_backend.get_item_sh_from_id(eitem, roles)
+                eitem.update(new_identities)
+                yield eitem
 
     logger.debug("Refreshing identities fields from %s", enrich_backend.elastic.index_url)
 
@@ -358,11 +399,166 @@ def refresh_identities(enrich_backend, filter_author=None):
     logger.info("Total eitems refreshed for identities fields %i", total)
 
 
+def get_modified_identities(enrich_backend):
+    """Get the identities modified in SortingHat since the last refresh.
+
+    The identities and unique identities modified since the checkpoint
+    stored in the enriched index metadata are read from SortingHat, along
+    with the checkpoint to store once their items are refreshed.
+
+    :param enrich_backend: enriched backend to update
+    :returns: a tuple with the SH ids and the uuids modified (None to
+        refresh all the items, as there is no checkpoint yet) and the new
+        checkpoint
+    """
+    metadata = enrich_backend.elastic.get_metadata(enrich_backend.type_name)
+    since = metadata.get(SH_REFRESH_CHECKPOINT, None)
+    if since:
+        since = parser.parse(since)
+
+    sh_ids, uuids, last_modified = SortingHat.get_modified_identities(enrich_backend.sh_db, since)
+    checkpoint = last_modified.isoformat() if last_modified else None
+
+    if not since:
+        logger.info("No identities refresh checkpoint in %s, refreshing all the items",
+                    enrich_backend.elastic.index_url)
+        return None, None, checkpoint
+
+    logger.info("Identities modified in SortingHat since %s: %i ids, %i uuids",
+                since.isoformat(), len(sh_ids), len(uuids))
+
+    return sh_ids, uuids, checkpoint
+
+
+def get_identities_filters(enrich_backend, sh_ids=None, uuids=None):
+    """Get the filters for the items with some SH ids or uuids in any role"""
+
+    uuid_fields = [field for field in enrich_backend.get_fields_uuid() if field.endswith('_uuid')]
+    id_fields = [field[:-len('_uuid')] + '_id' for field in uuid_fields]
+
+    # Up to max_items_clause values in each filter
+    size = enrich_backend.elastic.max_items_clause
+
+    filters = []
+    for uuids_chunk in chunks(uuids or [], size):
+        filters.append({"name": uuid_fields, "value": uuids_chunk})
+    for sh_ids_chunk in chunks(sh_ids or [], size):
+        filters.append({"name": id_fields, "value": sh_ids_chunk})
+
+    return filters
+
+
+def refresh_modified_identities(enrich_backend, by_query=False):
+    """Refresh the identities modified in SortingHat since the last refresh,
+    and store the new refresh checkpoint in the enriched index metadata.
+
+    :param enrich_backend: enriched backend to update
+    :param by_query: refresh the items in Elasticsearch with update_by_query
+    """
+    sh_ids, uuids, checkpoint = get_modified_identities(enrich_backend)
+
+    if sh_ids is None:
+        filters = [None]
+    elif by_query:
+        filters = []
+        with enrich_backend.elastic.indexing_session():
+            refresh_identities_by_query(enrich_backend, sh_ids, uuids)
+    else:
+        filters = get_identities_filters(enrich_backend, sh_ids, uuids)
+
+    field_id = enrich_backend.get_field_unique_id()
+    with enrich_backend.elastic.indexing_session():
+        for filter_author in filters:
+            eitems = refresh_identities(enrich_backend, filter_author)
+            enrich_backend.elastic.bulk_upload(eitems, field_id, update=True)
+
+    if checkpoint:
+        enrich_backend.elastic.set_metadata({SH_REFRESH_CHECKPOINT: checkpoint},
+                                            enrich_backend.type_name)
+
+
+def refresh_identities_by_query(enrich_backend, sh_ids=None, uuids=None):
+    """Refresh identities in the enriched index without reading the items.
+
+    The SH fields of each unique identity, which are the same in all its
+    items, are read once from SortingHat, in chunks of ids and of uuids
+    of BULK_CHUNK_SIZE. They are written to the items in
+    Elasticsearch with a painless script, which also picks the organization
+    of the enrollment including the date of each item. The items are
+    updated in groups of uuids, each group with one update_by_query.
+
+    The items of the SH ids get the current uuid of the ids too, so the
+    ids moved to another unique identity are refreshed. The ids and uuids
+    not found in SortingHat are not refreshed.
+
+    :param enrich_backend: enriched backend to update
+    :param sh_ids: SH ids whose items are refreshed
+    :param uuids: uuids whose items are refreshed
+    :returns: number of items updated
+    """
+    author_field = enrich_backend.get_field_author()
+    roles = set(getattr(enrich_backend, 'roles', None) or [author_field])
+    roles.add('author')
+
+    total = 0
+    refreshed = set()  # uuids already refreshed
+
+    # SortingHat is read in chunks of ids and uuids, not all of them at once
+    batches = [(sh_ids_chunk, []) for sh_ids_chunk in chunks(sh_ids or [], BULK_CHUNK_SIZE)]
+    batches += [([], uuids_chunk) for uuids_chunk in chunks(uuids or [], BULK_CHUNK_SIZE)]
+
+    for sh_ids_chunk, uuids_chunk in batches:
+        uuids_chunk = [uuid for uuid in uuids_chunk if uuid not in refreshed]
+        if not sh_ids_chunk and not uuids_chunk:
+            continue
+
+        id_uuids, uuids_fields, enrollments = enrich_backend.get_uuids_sh_fields(sh_ids_chunk, uuids_chunk)
+        refreshed.update(uuids_fields)
+
+        logger.debug("Refreshing by query identities fields of %i uuids in %s",
+                     len(uuids_fields), enrich_backend.elastic.index_url)
+
+        for query_uuids in chunks(uuids_fields, UPDATE_BY_QUERY_UUIDS):
+            identities = {}
+            for uuid in query_uuids:
+                uenrollments = [[datetime_to_millis(enrollment.start), datetime_to_millis(enrollment.end),
+                                 enrollment.organization.name] for enrollment in enrollments.get(uuid, [])]
+                identities[uuid] = {"fields": uuids_fields[uuid], "enrollments": uenrollments}
+
+            ids = {sh_id: uuid for sh_id, uuid in id_uuids.items() if uuid in identities}
+
+            should = [{"terms": {rol + "_uuid": query_uuids}} for rol in sorted(roles)]
+            if ids:
+                should += [{"terms": {rol + "_id": list(ids)}} for rol in sorted(roles)]
+            query = {"bool": {"should": should, "minimum_should_match": 1}}
+
+            params = {
+                "roles": sorted(roles),
+                "date_field": enrich_backend.get_field_date(),
+                "unaffiliated": enrich_backend.unaffiliated_group,
+                "identities": identities,
+                "ids": ids
+            }
+
+            total += enrich_backend.elastic.update_by_query(query, REFRESH_IDENTITIES_SCRIPT, params)
+
+    logger.info("Total eitems refreshed by query for identities fields %i", total)
+
+    return total
+
+
+def datetime_to_millis(date):
+    """Milliseconds since the epoch of a naive UTC datetime"""
+
+    return calendar.timegm(date.timetuple()) * 1000
+
+
 def load_identities(ocean_backend, enrich_backend):
     # First we add all new identities to SH
     items_count = 0
     identities_count = 0
     new_identities = []
+    seen_identities = set()  # hashable form of the identities already found
 
     # Support that ocean_backend is a list of items (old API)
     if isinstance(ocean_backend, list):
@@ -379,10 +575,12 @@ def load_identities(ocean_backend, enrich_backend):
             continue
 
         for identity in identities:
-            if identity not in new_identities:
+            identity_key = tuple(sorted(identity.items()))
+            if identity_key not in seen_identities:
+                seen_identities.add(identity_key)
                 new_identities.append(identity)
 
-            if len(new_identities) > 100:
+            if len(new_identities) >= BULK_CHUNK_SIZE:
                 inserted_identities = load_bulk_identities(items_count,
                                                            new_identities,
                                                            enrich_backend.sh_db,
@@ -503,16 +701,19 @@ def enrich_backend(url, clean, backend_name, backend_params,
                    filters_raw_prefix=None, jenkins_rename_file=None,
                    unaffiliated_group=None, pair_programming=False,
                    node_regex=False,
-                   studies_args=None):
-    """ Enrich Ocean index """
+                   studies_args=None, refresh_identities_incremental=False,
+                   identities_by_query=False):
+    """ Enrich Ocean index. The error enriching it, if any, is logged
+    and returned """
 
     backend = None
     enrich_index = None
+    error = None
 
     if ocean_index or ocean_index_enrich:
         clean = False  # don't remove index, it could be shared
 
-    if do_refresh_projects or do_refresh_identities:
+    if do_refresh_projects or do_refresh_identities or refresh_identities_incremental:
         clean = False  # refresh works over the existing enriched items
 
     if not get_connector_from_name(backend_name):
@@ -586,7 +787,15 @@ def enrich_backend(url, clean, backend_name, backend_params,
             logger.info("Refreshing project field in %s", enrich_backend.elastic.index_url)
             field_id = enrich_backend.get_field_unique_id()
             eitems = refresh_projects(enrich_backend)
-            enrich_backend.elastic.bulk_upload(eitems, field_id)
+            with enrich_backend.elastic.indexing_session():
+                enrich_backend.elastic.bulk_upload(eitems, field_id, update=True)
+        elif refresh_identities_incremental:
+            logger.info("Refreshing identities modified in SortingHat in %s", enrich_backend.elastic.index_url)
+            refresh_modified_identities(enrich_backend, identities_by_query)
+        elif do_refresh_identities and identities_by_query and (author_id or author_uuid):
+            logger.info("Refreshing by query identities fields in %s", enrich_backend.elastic.index_url)
+            with enrich_backend.elastic.indexing_session():
+                refresh_identities_by_query(enrich_backend, author_id, author_uuid)
         elif do_refresh_identities:
 
             filter_author = None
@@ -601,7 +810,8 @@ def enrich_backend(url, clean, backend_name, backend_params,
 
             field_id = enrich_backend.get_field_unique_id()
             eitems = refresh_identities(enrich_backend, filter_author)
-            enrich_backend.elastic.bulk_upload(eitems, field_id)
+            with enrich_backend.elastic.indexing_session():
+                enrich_backend.elastic.bulk_upload(eitems, field_id, update=True)
         else:
             clean = False  # Don't remove ocean index when enrich
             elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
@@ -619,18 +829,21 @@ def enrich_backend(url, clean, backend_name, backend_params,
 
             else:
                 # Enrichment for the new items once SH update is finished
-                if not events_enrich:
-                    enrich_count = enrich_items(ocean_backend, enrich_backend)
-                    if enrich_count is not None:
-                        logger.info("Total items enriched %i ", enrich_count)
-                else:
-                    enrich_count = enrich_items(ocean_backend, enrich_backend, events=True)
-                    if enrich_count is not None:
-                        logger.info("Total events enriched %i ", enrich_count)
+                # The enriched index is refreshed before running the studies
+                with enrich_backend.elastic.indexing_session():
+                    if not events_enrich:
+                        enrich_count = enrich_items(ocean_backend, enrich_backend)
+                        if enrich_count is not None:
+                            logger.info("Total items enriched %i ", enrich_count)
+                    else:
+                        enrich_count = enrich_items(ocean_backend, enrich_backend, events=True)
+                        if enrich_count is not None:
+                            logger.info("Total events enriched %i ", enrich_count)
                 if studies:
                     do_studies(ocean_backend, enrich_backend, studies_args)
 
     except Exception as ex:
+        error = ex
         logger.error("%s", traceback.format_exc())
         if backend:
             logger.error("Error enriching ocean from %s (%s): %s",
@@ -640,6 +853,8 @@ def enrich_backend(url, clean, backend_name, backend_params,
 
     logger.info("Done %s ", backend_name)
 
+    return error
+
 
 def init_backend(backend_cmd):
     """Init backend within the backend_cmd"""
@@ -39,6 +39,7 @@ logger = logging.getLogger(__name__)
 class BugzillaEnrich(Enrich):
 
     roles = ['assigned_to', 'reporter', 'qa_contact']
+    project_repository_fields = ['product']
 
     def get_field_author(self):
         return "reporter"
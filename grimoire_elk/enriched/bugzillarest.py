@@ -37,6 +37,7 @@ logger = logging.getLogger(__name__)
 class BugzillaRESTEnrich(Enrich):
 
     roles = ['assigned_to_detail', 'qa_contact_detail', 'creator_detail']
+    project_repository_fields = ['component', 'product']
 
     def get_field_author(self):
         return 'creator_detail'
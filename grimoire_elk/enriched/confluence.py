@@ -55,6 +55,7 @@ class Mapping(BaseMapping):
 class ConfluenceEnrich(Enrich):
 
     mapping = Mapping
+    project_repository_fields = ['space']
 
     def get_field_author(self):
         return 'by'
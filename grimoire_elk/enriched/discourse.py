@@ -35,6 +35,8 @@ logger = logging.getLogger(__name__)
 
 class DiscourseEnrich(Enrich):
 
+    project_repository_fields = ['category_id']
+
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host=''):
         super().__init__(db_sortinghat, db_projects_map, json_projects_map,
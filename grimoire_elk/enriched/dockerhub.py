@@ -21,9 +21,7 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
-import sys
 
 from .enrich import Enrich, metadata
 from ..elastic_mapping import Mapping as BaseMapping
@@ -128,31 +126,17 @@ class DockerHubEnrich(Enrich):
         must be created """
 
         max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
+        writer = self.elastic.get_bulk_writer()
 
         items = ocean_backend.fetch()
         images_items = {}
 
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)", url, max_items)
+        logger.debug("Adding items to %s (in %i packs)", writer.url, max_items)
 
         for item in items:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                logger.debug("Added %i items to %s (%0.2f MB)", total, url, json_size)
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            # The rich item could be changed below to be used as image item
+            writer.add(rich_item, item[self.get_field_unique_id()])
 
             if rich_item['id'] not in images_items:
                 # Let's transform the rich_event in a rich_image
@@ -167,8 +151,7 @@ class DockerHubEnrich(Enrich):
                     rich_item['is_event'] = 0
                     images_items[rich_item['id']] = rich_item
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        total = writer.close()
 
         if total == 0:
             # No items enriched, nothing to upload to ES
@@ -179,10 +162,6 @@ class DockerHubEnrich(Enrich):
         # data can be upload in one query
         for image in images_items:
             data = images_items[image]
-            data_json = json.dumps(data)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (data['id'] + "_image")
-            bulk_json += data_json + "\n"  # Bulk document
+            writer.add(data, data['id'] + "_image")
 
-        total += self.elastic.safe_put_bulk(url, bulk_json)
-        return total
+        return writer.close()
@@ -22,17 +22,21 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import collections
 import json
 import functools
+import inspect
 import logging
+import multiprocessing
 import requests
-import sys
+import threading
+import time
 
 from datetime import datetime as dt, timedelta
 
 import pkg_resources
-from dateutil import parser
 from functools import lru_cache
+from uuid import uuid4
 
 from elasticsearch import Elasticsearch
 
@@ -42,7 +46,7 @@ from grimoirelab_toolkit import datetime as gl_dt
 from ..elastic_items import ElasticItems
 from .study_ceres_onion import ESOnionConnector, onion_study
 
-from .utils import grimoire_con
+from .utils import chunks, grimoire_con, parse_date
 from .. import __version__
 
 logger = logging.getLogger(__name__)
@@ -59,6 +63,7 @@ try:
     from sortinghat import api, utils
     from sortinghat.exceptions import NotFoundError, InvalidValueError
 
+    from .identities_cache import EnrollmentsIndex, IdentitiesCache
     from .sortinghat_gelk import SortingHat
 
     SORTINGHAT_LIBS = True
@@ -72,10 +77,42 @@ DEFAULT_DB_USER = 'root'
 CUSTOM_META_PREFIX = 'cm'
 
 SH_UNKNOWN_VALUE = 'Unknown'
+ENROLLMENTS_INDEX_SIZE = 10000  # uuids with their enrollments index kept in memory
 DEMOGRAPHICS_ALIAS = 'demographics'
 
 HEADER_JSON = {"Content-Type": "application/json"}
 
+worker_enricher = None  # enricher inherited by the enrichment worker processes
+
+
+def init_enrich_worker():
+    """Prepare the enricher inherited by a new worker process.
+
+    The connections of the parent process can't be shared with the
+    worker, so new ones are opened on demand.
+    """
+    worker_enricher.requests = grimoire_con(gzip_requests=worker_enricher.gzip_requests)
+
+    engine = getattr(Enrich.sh_db, '_engine', None)
+    if engine:
+        engine.dispose()
+
+
+def enrich_chunk(method, items):
+    """Run an enricher method over a chunk of raw items in a worker process"""
+
+    func = getattr(worker_enricher, method)
+    worker_enricher.resolve_sh_identities(items)
+
+    results = []
+    for item in items:
+        result = func(item)
+        if inspect.isgenerator(result):
+            result = list(result)
+        results.append(result)
+
+    return results
+
 
 def metadata(func):
     """Add metadata to an item.
@@ -87,12 +124,7 @@ def metadata(func):
     @functools.wraps(func)
     def decorator(self, *args, **kwargs):
         eitem = func(self, *args, **kwargs)
-        metadata = {
-            'metadata__gelk_version': self.gelk_version,
-            'metadata__gelk_backend_name': self.__class__.__name__,
-            'metadata__enriched_on': dt.utcnow().isoformat()
-        }
-        eitem.update(metadata)
+        eitem.update(self.get_enrich_metadata())
         return eitem
     return decorator
 
@@ -107,6 +139,19 @@ class Enrich(ElasticItems):
 
     ONION_INTERVAL = seconds = 3600 * 24 * 7
 
+    # Fields of the enriched items used to find their project, besides the origin
+    project_repository_fields = []
+
+    enrich_workers = 1  # processes enriching the raw items, 1 enriches them in this one
+    enrich_chunk_size = 100  # raw items sent at once to a worker process
+
+    run_id = None  # id of the enrichment run, added to the enriched items
+    enriched_on_interval = 1  # seconds the enrichment date of the items is reused, 0 to get it for each one
+
+    sh_cache = None  # identities cache shared by the runs
+    sh_cache_path = None  # SQLite file of the identities cache, None to disable it
+    sh_cache_size = 100000  # max uuids and max ids stored in the identities cache
+
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host='', insecure=True):
 
@@ -123,8 +168,13 @@ class Enrich(ElasticItems):
             if not Enrich.sh_db:
                 Enrich.sh_db = Database(db_user, db_password, db_sortinghat, db_host)
             self.sortinghat = True
+            if self.sh_cache_path and not Enrich.sh_cache:
+                Enrich.sh_cache = IdentitiesCache(self.sh_cache_path, self.sh_cache_size)
+                Enrich.sh_cache.sync(Enrich.sh_db)
 
         self.prjs_map = None  # mapping beetween repositories and projects
+        self.prjs_origins = {}  # project found for each (data source, origin) not in prjs_map
+        self.prjs_origins_map = None  # prjs_map the projects of the origins were found in
         self.json_projects = None
 
         if json_projects_map:
@@ -147,13 +197,19 @@ class Enrich(ElasticItems):
 
         self.studies = []
 
-        self.requests = grimoire_con()
+        self.requests = grimoire_con(gzip_requests=self.gzip_requests)
         self.elastic = None
         self.type_name = "items"  # type inside the index to store items enriched
 
         # To add the gelk version to enriched items
         self.gelk_version = __version__
 
+        # All the enrichers of the process are in the same run
+        if not Enrich.run_id:
+            Enrich.run_id = uuid4().hex
+        self.enrich_metadata = None  # metadata fields added to the enriched items
+        self.enrich_metadata_time = 0
+
         # params used to configure the backend
         # in perceval backends managed directly inside the backend
         # in twitter and others managed in arthur logic
@@ -163,6 +219,29 @@ class Enrich(ElasticItems):
         # Label used during enrichment for identities with no gender info
         self.unknown_gender = 'Unknown'
 
+        # SortingHat data resolved in batch for the items being enriched
+        self.sh_batch_ids = {}  # (identity tuple, backend name) -> SH id and uuid
+        self.sh_batch_uuids = {}  # SH id -> uuid
+        self.sh_batch_uidentities = {}  # uuid -> unique identity
+        self.sh_batch_enrollments = {}  # uuid -> enrollments
+
+    def get_enrich_metadata(self):
+        """ Get the metadata fields added to the enriched items. They are
+        the same for all of them, but the date of the enrichment which is
+        updated every enriched_on_interval seconds """
+
+        now = time.time()
+        if not self.enrich_metadata or now - self.enrich_metadata_time >= self.enriched_on_interval:
+            self.enrich_metadata = {
+                'metadata__gelk_version': self.gelk_version,
+                'metadata__gelk_backend_name': self.__class__.__name__,
+                'metadata__enriched_on': dt.utcnow().isoformat(),
+                'metadata__enrich_run_id': self.run_id
+            }
+            self.enrich_metadata_time = now
+
+        return self.enrich_metadata
+
     def set_elastic_url(self, url):
         """ Elastic URL """
         self.elastic_url = url
@@ -338,56 +417,81 @@ class Enrich(ElasticItems):
         """
 
         max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
+        writer = self.elastic.get_bulk_writer()
 
         items = ocean_backend.fetch()
 
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)", url, max_items)
+        logger.debug("Adding items to %s (in %i packs)", writer.url, max_items)
 
         if events:
             logger.debug("Adding events items")
 
-        for item in items:
-            if current >= max_items:
-                try:
-                    total += self.elastic.safe_put_bulk(url, bulk_json)
-                    json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                    logger.debug("Added %i items to %s (%0.2f MB)", total, url, json_size)
-                except UnicodeEncodeError:
-                    # Why is requests encoding the POST data as ascii?
-                    logger.error("Unicode error in enriched items")
-                    logger.debug(bulk_json)
-                    safe_json = str(bulk_json.encode('ascii', 'ignore'), 'ascii')
-                    total += self.elastic.safe_put_bulk(url, safe_json)
-                bulk_json = ""
-                current = 0
-
-            if not events:
-                rich_item = self.get_rich_item(item)
-                data_json = json.dumps(rich_item)
-                bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                    (item[self.get_field_unique_id()])
-                bulk_json += data_json + "\n"  # Bulk document
-                current += 1
-            else:
-                rich_events = self.get_rich_events(item)
+        if not events:
+            for item, rich_item in self.map_raw_items('get_rich_item', items):
+                writer.add(rich_item, item[self.get_field_unique_id()])
+        else:
+            for item, rich_events in self.map_raw_items('get_rich_events', items):
                 for rich_event in rich_events:
-                    data_json = json.dumps(rich_event)
-                    bulk_json += '{"index" : {"_id" : "%s_%s" } }\n' % \
-                        (item[self.get_field_unique_id()],
-                         rich_event[self.get_field_event_unique_id()])
-                    bulk_json += data_json + "\n"  # Bulk document
-                    current += 1
+                    writer.add(rich_event, "%s_%s" % (item[self.get_field_unique_id()],
+                                                      rich_event[self.get_field_event_unique_id()]))
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        total = writer.close()
 
         return total
 
+    def map_raw_items(self, method, items):
+        """Generator of the pairs (item, result) of calling the enricher
+        method (its name) with each raw item, keeping the order of items.
+
+        Items are processed in chunks of enrich_chunk_size items, resolving
+        their SortingHat identities in batch before the method is called.
+        With enrich_workers > 1 the method is run in a pool of worker
+        processes, which receive the chunks. The
+        workers are forked from this process, so they start with the same
+        enricher: projects map and SortingHat caches included. Generators
+        returned by the method are converted to lists.
+
+        A process with other threads running, like the ones uploading items
+        or the jobs of a batch, is not forked, as a worker could inherit a
+        lock held by one of them and hang. The items are enriched in this
+        process then.
+        """
+        workers = self.enrich_workers
+        if workers > 1 and threading.active_count() > 1:
+            logger.warning("Other threads running, enriching in this process instead of in %i workers",
+                           workers)
+            workers = 1
+
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            func = getattr(self, method)
+            for chunk in chunks(items, self.enrich_chunk_size):
+                self.resolve_sh_identities(chunk)
+                for item in chunk:
+                    yield item, func(item)
+            return
+
+        global worker_enricher
+        worker_enricher = self
+
+        # Fork the workers before the threads reading and writing items start
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=init_enrich_worker)
+        try:
+            pending = collections.deque()
+            for chunk in chunks(items, self.enrich_chunk_size):
+                pending.append((chunk, pool.apply_async(enrich_chunk, (method, chunk))))
+                # Bound the chunks in memory, keeping all the workers busy
+                if len(pending) > 2 * workers:
+                    chunk, results = pending.popleft()
+                    yield from zip(chunk, results.get())
+
+            while pending:
+                chunk, results = pending.popleft()
+                yield from zip(chunk, results.get())
+        finally:
+            pool.terminate()
+            pool.join()
+            worker_enricher = None
+
     def get_connector_name(self):
         """ Find the name for the current connector """
         from ..utils import get_connector_name
@@ -482,7 +586,7 @@ class Enrich(ElasticItems):
 
         grimoire_date = None
         try:
-            grimoire_date = parser.parse(creation_date).isoformat()
+            grimoire_date = parse_date(creation_date).isoformat()
         except Exception as ex:
             pass
 
@@ -535,16 +639,35 @@ class Enrich(ElasticItems):
             # logger.warning("Project not found for repository %s (data source: %s)", repository, ds_name)
             project = None
             # Try to use always the origin in any case
-            if 'origin' in eitem:
-                if ds_name in self.prjs_map and eitem['origin'] in self.prjs_map[ds_name]:
-                    project = self.prjs_map[ds_name][eitem['origin']]
-                elif ds_name in self.prjs_map:
-                    # Try to find origin as part of the keys
-                    for ds_repo in self.prjs_map[ds_name]:
-                        ds_repo = str(ds_repo)  # discourse has category_id ints
-                        if eitem['origin'] in ds_repo:
-                            project = self.prjs_map[ds_name][ds_repo]
-                            break
+            if 'origin' in eitem and ds_name in self.prjs_map:
+                project = self.__find_origin_project(ds_name, eitem['origin'])
+
+        return project
+
+    def __find_origin_project(self, ds_name, origin):
+        """ Find the project of an origin, which could be a repository of the
+        data source or part of one. The items of an origin share the project,
+        so the repositories are searched once per origin """
+
+        if self.prjs_origins_map is not self.prjs_map:
+            self.prjs_origins = {}
+            self.prjs_origins_map = self.prjs_map
+
+        if (ds_name, origin) in self.prjs_origins:
+            return self.prjs_origins[(ds_name, origin)]
+
+        project = None
+        if origin in self.prjs_map[ds_name]:
+            project = self.prjs_map[ds_name][origin]
+        else:
+            # Try to find origin as part of the keys
+            for ds_repo in self.prjs_map[ds_name]:
+                ds_repo = str(ds_repo)  # discourse has category_id ints
+                if origin in ds_repo:
+                    project = self.prjs_map[ds_name][ds_repo]
+                    break
+
+        self.prjs_origins[(ds_name, origin)] = project
 
         return project
 
@@ -555,8 +678,9 @@ class Enrich(ElasticItems):
         :return: a dictionary with the project data
         """
         eitem_project = {}
-        project = self.find_item_project(eitem)
+        item_project = self.find_item_project(eitem)
 
+        project = item_project
         if project is None:
             project = DEFAULT_PROJECT
 
@@ -565,10 +689,15 @@ class Enrich(ElasticItems):
         eitem_project.update(self.add_project_levels(project))
 
         # And now time to add the metadata
-        eitem_project.update(self.get_item_metadata(eitem))
+        eitem_project.update(self.__get_project_metadata(item_project))
 
         return eitem_project
 
+    def get_project_fields(self):
+        """ Fields of the enriched items needed to refresh their project """
+
+        return [self.get_field_unique_id(), "origin"] + self.project_repository_fields
+
     def get_item_metadata(self, eitem):
         """
         In the projects.json file, inside each project, there is a field called "meta" which has a
@@ -582,11 +711,16 @@ class Enrich(ElasticItems):
         :return: a dictionary with the metadata fields
         """
 
-        eitem_metadata = {}
-
         # Get the project entry for the item, which includes the metadata
         project = self.find_item_project(eitem)
 
+        return self.__get_project_metadata(project)
+
+    def __get_project_metadata(self, project):
+        """ Get the custom metadata fields of a project """
+
+        eitem_metadata = {}
+
         if project and 'meta' in self.json_projects[project]:
             meta_fields = self.json_projects[project]['meta']
             if isinstance(meta_fields, dict):
@@ -626,16 +760,9 @@ class Enrich(ElasticItems):
         if item_date and item_date.tzinfo:
             item_date = (item_date - item_date.utcoffset()).replace(tzinfo=None)
 
-        enrollments = self.get_enrollments(uuid)
-        enroll = self.unaffiliated_group
-        if enrollments:
-            for enrollment in enrollments:
-                if not item_date:
-                    enroll = enrollment.organization.name
-                    break
-                elif item_date >= enrollment.start and item_date <= enrollment.end:
-                    enroll = enrollment.organization.name
-                    break
+        enroll = self.get_enrollments_index(uuid).find(item_date)
+        if enroll is None:
+            enroll = self.unaffiliated_group
         return enroll
 
     def __get_item_sh_fields_empty(self, rol, undefined=False):
@@ -705,6 +832,46 @@ class Enrich(ElasticItems):
         eitem_sh[rol + "_bot"] = self.is_bot(eitem_sh[rol + '_uuid'])
         return eitem_sh
 
+    def get_uuids_sh_fields(self, sh_ids=None, uuids=None):
+        """ Get the SH fields which are the same in all the items of some
+        unique identities, reading them from SortingHat.
+
+        The fields have the values get_item_sh_fields sets from a SH id,
+        and they are keyed by the suffix added to the role.
+
+        :param sh_ids: SH ids whose unique identities are included
+        :param uuids: uuids of the unique identities included
+        :returns: a tuple with the uuid of each SH id found, and the fields and
+            the enrollments (sorted as SortingHat does) of each unique identity found
+        """
+        id_uuids, uidentities, enrollments = SortingHat.get_identities_batch(self.sh_db, list(sh_ids or []),
+                                                                             extra_uuids=list(uuids or []))
+
+        uuids_fields = {}
+        for uuid, uidentity in uidentities.items():
+            fields = {
+                "_name": '',
+                "_user_name": '',
+                "_domain": '',
+                "_gender": self.unknown_gender,
+                "_gender_acc": 0,
+                "_bot": False
+            }
+
+            profile = uidentity.profile
+            if profile:
+                fields['_name'] = profile.name
+                if profile.email:
+                    fields['_domain'] = self.get_email_domain(profile.email)
+                if profile.gender:
+                    fields['_gender'] = profile.gender
+                    fields['_gender_acc'] = profile.gender_acc
+                fields['_bot'] = profile.is_bot
+
+            uuids_fields[uuid] = fields
+
+        return id_uuids, uuids_fields, enrollments
+
     def get_profile_sh(self, uuid):
         profile = {}
 
@@ -717,6 +884,18 @@ class Enrich(ElasticItems):
 
         return profile
 
+    def get_identities_fields(self, roles=None):
+        """ Fields of the enriched items needed to refresh their identities """
+
+        author_field = self.get_field_author()
+        if not roles:
+            roles = [author_field]
+
+        fields = [self.get_field_unique_id(), self.get_field_date(), author_field + "_id"]
+        fields += [rol + "_id" for rol in roles if rol != author_field]
+
+        return fields
+
     def get_item_sh_from_id(self, eitem, roles=None):
         # Get the SH fields from the data in the enriched item
 
@@ -730,7 +909,7 @@ class Enrich(ElasticItems):
         if not roles:
             roles = [author_field]
 
-        date = parser.parse(eitem[self.get_field_date()])
+        date = parse_date(eitem[self.get_field_date()])
 
         for rol in roles:
             if rol + "_id" not in eitem:
@@ -779,9 +958,9 @@ class Enrich(ElasticItems):
             roles = [author_field]
 
         if not date_field:
-            item_date = parser.parse(item[self.get_field_date()])
+            item_date = parse_date(item[self.get_field_date()])
         else:
-            item_date = parser.parse(item[date_field])
+            item_date = parse_date(item[date_field])
 
         users_data = self.get_users_data(item)
 
@@ -816,17 +995,134 @@ class Enrich(ElasticItems):
 
         return eitem_sh
 
+    def resolve_sh_identities(self, items):
+        """ Resolve the SortingHat data of the identities in the raw items
+        with a few queries, so the lookups done while enriching each item
+        don't need a query per identity """
+
+        if not self.sortinghat:
+            return
+
+        author_field = self.get_field_author()
+        roles = set(getattr(self, 'roles', None) or [])
+        roles.add(author_field)
+        backend_name = self.get_connector_name()
+
+        identities = {}
+        for item in items:
+            users_data = self.get_users_data(item)
+            for rol in roles:
+                if rol not in users_data:
+                    continue
+                try:
+                    identity = self.get_sh_identity(item, rol)
+                except (AttributeError, IndexError, KeyError, TypeError):
+                    # The identity will be looked up, and the error reported, in the enrichment
+                    continue
+                if not identity:
+                    continue
+                if not identity.get('name', None) and not identity.get('email', None) \
+                        and not identity.get('username', None):
+                    # Reported in the enrichment, as with the identities not resolved
+                    continue
+                try:
+                    sh_id = utils.uuid(backend_name, email=identity.get('email', None),
+                                       name=identity.get('name', None),
+                                       username=identity.get('username', None))
+                except (InvalidValueError, ValueError, UnicodeEncodeError):
+                    continue
+                identities[(tuple(identity.items()), backend_name)] = sh_id
+
+        self.__resolve_sh_batch(identities)
+
+    def resolve_sh_ids(self, eitems, roles=None):
+        """ Resolve the SortingHat data of the identities ids in the
+        enriched items with a few queries, to refresh them """
+
+        if not self.sortinghat:
+            return
+
+        author_field = self.get_field_author()
+        roles = set(roles) if roles else set()
+        roles.add(author_field)
+
+        sh_ids = set()
+        for eitem in eitems:
+            for rol in roles:
+                if eitem.get(rol + "_id", None):
+                    sh_ids.add(eitem[rol + "_id"])
+
+        self.__resolve_sh_batch({sh_id: sh_id for sh_id in sh_ids})
+
+    def __resolve_sh_batch(self, identities):
+        """ Set the SortingHat data of the identities (key -> SH id) as the
+        data resolved in batch, replacing the data of the previous batch """
+
+        uuids, uidentities, enrollments = self.__get_sh_identities(set(identities.values()))
+
+        self.sh_batch_ids = {key: {"id": sh_id, "uuid": uuids[sh_id]}
+                             for key, sh_id in identities.items() if sh_id in uuids}
+        self.sh_batch_uuids = uuids
+        self.sh_batch_uidentities = uidentities
+        self.sh_batch_enrollments = enrollments
+
+    def __get_sh_identities(self, sh_ids):
+        """ Get the uuids, unique identities and enrollments of some SH ids,
+        from the identities cache if enabled and from SortingHat the rest """
+
+        uuids = {}
+        uidentities = {}
+        enrollments = {}
+
+        if self.sh_cache:
+            uuids = self.sh_cache.get_uuids(sh_ids)
+            uidentities, enrollments = self.sh_cache.get_uidentities(set(uuids.values()))
+            uuids = {sh_id: uuid for sh_id, uuid in uuids.items() if uuid in uidentities}
+
+        missing = [sh_id for sh_id in sh_ids if sh_id not in uuids]
+        if missing:
+            sh_data = SortingHat.get_identities_batch(self.sh_db, missing)
+            if self.sh_cache:
+                self.sh_cache.add(*sh_data)
+            uuids.update(sh_data[0])
+            uidentities.update(sh_data[1])
+            enrollments.update(sh_data[2])
+
+        return uuids, uidentities, enrollments
+
     @lru_cache()
     def get_enrollments(self, uuid):
+        if uuid in self.sh_batch_enrollments:
+            return self.sh_batch_enrollments[uuid]
+        if self.sh_cache:
+            _, enrollments = self.sh_cache.get_uidentities([uuid])
+            if uuid in enrollments:
+                return enrollments[uuid]
         return api.enrollments(self.sh_db, uuid)
 
+    @lru_cache(maxsize=ENROLLMENTS_INDEX_SIZE)
+    def get_enrollments_index(self, uuid):
+        """ Get the index by date of the enrollments of an uuid """
+        return EnrollmentsIndex(self.get_enrollments(uuid))
+
     @lru_cache()
     def get_unique_identity(self, uuid):
+        if uuid in self.sh_batch_uidentities:
+            return self.sh_batch_uidentities[uuid]
+        if self.sh_cache:
+            uidentities, _ = self.sh_cache.get_uidentities([uuid])
+            if uuid in uidentities:
+                return uidentities[uuid]
         return api.unique_identities(self.sh_db, uuid)[0]
 
     @lru_cache()
     def get_uuid_from_id(self, sh_id):
         """ Get the SH identity uuid from the id """
+        if sh_id in self.sh_batch_uuids:
+            return self.sh_batch_uuids[sh_id]
+        if self.sh_cache:
+            uuids, _, _ = self.__get_sh_identities([sh_id])
+            return uuids.get(sh_id, None)
         return SortingHat.get_uuid_from_id(self.sh_db, sh_id)
 
     def get_sh_ids(self, identity, backend_name):
@@ -839,6 +1135,9 @@ class Enrich(ElasticItems):
     @lru_cache()
     def __get_sh_ids_cache(self, identity_tuple, backend_name):
 
+        if (identity_tuple, backend_name) in self.sh_batch_ids:
+            return dict(self.sh_batch_ids[(identity_tuple, backend_name)])
+
         # Convert tuple to the original dict
         identity = dict((x, y) for x, y in identity_tuple)
 
@@ -861,6 +1160,10 @@ class Enrich(ElasticItems):
             # Find the uuid for a given id.
             id = utils.uuid(backend_name, email=iden['email'],
                             name=iden['name'], username=iden['username'])
+            if self.sh_cache:
+                uuids = self.sh_cache.get_uuids([id])
+                if id in uuids:
+                    return {"id": id, "uuid": uuids[id]}
             with self.sh_db.connect() as session:
                 identity_found = api.find_identity(session, id)
                 sh_ids['id'] = identity_found.id
@@ -23,11 +23,11 @@
 #
 
 from datetime import datetime
-from dateutil import parser
 import logging
 import time
 
 from .enrich import Enrich, metadata
+from .utils import parse_date
 from ..elastic_mapping import Mapping as BaseMapping
 
 
@@ -63,6 +63,7 @@ class Mapping(BaseMapping):
 class GerritEnrich(Enrich):
 
     mapping = Mapping
+    project_repository_fields = ['repository']
 
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host=''):
@@ -210,10 +211,10 @@ class GerritEnrich(Enrich):
                 comment['message'] = comment['message'][:self.KEYWORD_MAX_SIZE]
 
         # Time to add the time diffs
-        createdOn_date = parser.parse(review['createdOn'])
+        createdOn_date = parse_date(review['createdOn'])
         if len(review["patchSets"]) > 0:
-            createdOn_date = parser.parse(review["patchSets"][0]['createdOn'])
-        lastUpdated_date = parser.parse(review['lastUpdated'])
+            createdOn_date = parse_date(review["patchSets"][0]['createdOn'])
+        lastUpdated_date = parse_date(review['lastUpdated'])
         seconds_day = float(60 * 60 * 24)
         if eitem['status'] in ['MERGED', 'ABANDONED']:
             timeopen = \
@@ -21,10 +21,8 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 import re
-import sys
 import time
 
 import pkg_resources
@@ -479,108 +477,24 @@ class GitEnrich(Enrich):
         """ Implementation supporting signed-off and multiauthor/committer commits.
         """
 
-        headers = {"Content-Type": "application/json"}
-
         max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
+        writer = self.elastic.get_bulk_writer()
 
         total_signed_off = 0
         total_multi_author = 0
 
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)", url, max_items)
+        logger.debug("Adding items to %s (in %i packs)", writer.url, max_items)
 
         items = ocean_backend.fetch()
 
-        for item in items:
-            if self.pair_programming:
-                # First we need to add the authors field to all commits
-                # Check multi author
-                m = self.AUTHOR_P2P_REGEX.match(item['data']['Author'])
-                n = self.AUTHOR_P2P_NEW_REGEX.match(item['data']['Author'])
-                if m or n:
-                    logger.debug("Multiauthor detected. Creating one commit "
-                                 "per author: %s", item['data']['Author'])
-                    item['data']['authors'] = self.__get_authors(item['data']['Author'])
-                    item['data']['Author'] = item['data']['authors'][0]
-                m = self.AUTHOR_P2P_REGEX.match(item['data']['Commit'])
-                n = self.AUTHOR_P2P_NEW_REGEX.match(item['data']['Author'])
-                if m or n:
-                    logger.debug("Multicommitter detected: using just the first committer")
-                    item['data']['committers'] = self.__get_authors(item['data']['Commit'])
-                    item['data']['Commit'] = item['data']['committers'][0]
-                # Add the authors list using the original Author and the Signed-off list
-                if 'Signed-off-by' in item['data']:
-                    authors_all = item['data']['Signed-off-by'] + [item['data']['Author']]
-                    item['data']['authors_signed_off'] = list(set(authors_all))
-
-            if current >= max_items:
-                try:
-                    total += self.elastic.safe_put_bulk(url, bulk_json)
-                    json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                    logger.debug("Added %i items to %s (%0.2f MB)", total, url, json_size)
-                except UnicodeEncodeError:
-                    # Why is requests encoding the POST data as ascii?
-                    logger.error("Unicode error in enriched items")
-                    logger.debug(bulk_json)
-                    safe_json = str(bulk_json.encode('ascii', 'ignore'), 'ascii')
-                    total += self.elastic.safe_put_bulk(url, safe_json)
-                bulk_json = ""
-                current = 0
-
-            rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            unique_field = self.get_field_unique_id()
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (rich_item[unique_field])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-
-            if self.pair_programming:
-                # Multi author support
-                if 'authors' in item['data']:
-                    # First author already added in the above commit
-                    authors = item['data']['authors']
-                    for i in range(1, len(authors)):
-                        # logger.debug('Adding a new commit for %s', authors[i])
-                        item['data']['Author'] = authors[i]
-                        item['data']['is_git_commit_multi_author'] = 1
-                        rich_item = self.get_rich_item(item)
-                        item['data']['is_git_commit_multi_author'] = 1
-                        data_json = json.dumps(rich_item)
-                        commit_id = item["uuid"] + "_" + str(i - 1)
-                        rich_item['git_uuid'] = commit_id
-                        bulk_json += '{"index" : {"_id" : "%s" } }\n' % rich_item['git_uuid']
-                        bulk_json += data_json + "\n"  # Bulk document
-                        current += 1
-                        total_multi_author += 1
-
-                if rich_item['Signed-off-by_number'] > 0:
-                    nsg = 0
-                    # Remove duplicates and the already added Author if exists
-                    authors = list(set(item['data']['Signed-off-by']))
-                    if item['data']['Author'] in authors:
-                        authors.remove(item['data']['Author'])
-                    for author in authors:
-                        # logger.debug('Adding a new commit for %s', author)
-                        # Change the Author in the original commit and generate
-                        # a new enriched item with it
-                        item['data']['Author'] = author
-                        item['data']['is_git_commit_signed_off'] = 1
-                        rich_item = self.get_rich_item(item)
-                        commit_id = item["uuid"] + "_" + str(nsg)
-                        rich_item['git_uuid'] = commit_id
-                        data_json = json.dumps(rich_item)
-                        bulk_json += '{"index" : {"_id" : "%s" } }\n' % rich_item['git_uuid']
-                        bulk_json += data_json + "\n"  # Bulk document
-                        current += 1
-                        total_signed_off += 1
-                        nsg += 1
-
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        for item, commits in self.map_raw_items('get_rich_commits', items):
+            rich_items, multi_author, signed_off = commits
+            for rich_item, commit_id in rich_items:
+                writer.add(rich_item, commit_id)
+            total_multi_author += multi_author
+            total_signed_off += signed_off
+
+        total = writer.close()
 
         if total == 0:
             # No items enriched, nothing to upload to ES
@@ -592,6 +506,80 @@ class GitEnrich(Enrich):
 
         return total
 
+    def get_rich_commits(self, item):
+        """ Get the rich items of a commit with their ids. In pair programming
+        commits, one per author and one per signed-off author are added.
+
+        :returns: a tuple with the list of (rich item, id) pairs and the
+            number of multi author and signed-off rich items added
+        """
+        rich_items = []
+        multi_author = 0
+        signed_off = 0
+
+        if self.pair_programming:
+            # First we need to add the authors field to all commits
+            # Check multi author
+            m = self.AUTHOR_P2P_REGEX.match(item['data']['Author'])
+            n = self.AUTHOR_P2P_NEW_REGEX.match(item['data']['Author'])
+            if m or n:
+                logger.debug("Multiauthor detected. Creating one commit "
+                             "per author: %s", item['data']['Author'])
+                item['data']['authors'] = self.__get_authors(item['data']['Author'])
+                item['data']['Author'] = item['data']['authors'][0]
+            m = self.AUTHOR_P2P_REGEX.match(item['data']['Commit'])
+            n = self.AUTHOR_P2P_NEW_REGEX.match(item['data']['Author'])
+            if m or n:
+                logger.debug("Multicommitter detected: using just the first committer")
+                item['data']['committers'] = self.__get_authors(item['data']['Commit'])
+                item['data']['Commit'] = item['data']['committers'][0]
+            # Add the authors list using the original Author and the Signed-off list
+            if 'Signed-off-by' in item['data']:
+                authors_all = item['data']['Signed-off-by'] + [item['data']['Author']]
+                item['data']['authors_signed_off'] = list(set(authors_all))
+
+        rich_item = self.get_rich_item(item)
+        unique_field = self.get_field_unique_id()
+        rich_items.append((rich_item, rich_item[unique_field]))
+
+        if self.pair_programming:
+            # Multi author support
+            if 'authors' in item['data']:
+                # First author already added in the above commit
+                authors = item['data']['authors']
+                for i in range(1, len(authors)):
+                    # logger.debug('Adding a new commit for %s', authors[i])
+                    item['data']['Author'] = authors[i]
+                    item['data']['is_git_commit_multi_author'] = 1
+                    rich_item = self.get_rich_item(item)
+                    item['data']['is_git_commit_multi_author'] = 1
+                    commit_id = item["uuid"] + "_" + str(i - 1)
+                    # The id is not added to the document uploaded
+                    rich_items.append((dict(rich_item), commit_id))
+                    rich_item['git_uuid'] = commit_id
+                    multi_author += 1
+
+            if rich_item['Signed-off-by_number'] > 0:
+                nsg = 0
+                # Remove duplicates and the already added Author if exists
+                authors = list(set(item['data']['Signed-off-by']))
+                if item['data']['Author'] in authors:
+                    authors.remove(item['data']['Author'])
+                for author in authors:
+                    # logger.debug('Adding a new commit for %s', author)
+                    # Change the Author in the original commit and generate
+                    # a new enriched item with it
+                    item['data']['Author'] = author
+                    item['data']['is_git_commit_signed_off'] = 1
+                    rich_item = self.get_rich_item(item)
+                    commit_id = item["uuid"] + "_" + str(nsg)
+                    rich_item['git_uuid'] = commit_id
+                    rich_items.append((rich_item, rich_item['git_uuid']))
+                    signed_off += 1
+                    nsg += 1
+
+        return rich_items, multi_author, signed_off
+
     def enrich_demography(self, ocean_backend, enrich_backend, date_field="grimoire_creation_date",
                           author_field="author_uuid"):
 
@@ -22,10 +22,8 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 import re
-import time
 
 import requests
 from datetime import datetime
@@ -222,35 +220,22 @@ class GitHubEnrich(Enrich):
 
     def geo_locations_to_es(self):
         max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
         url = self.elastic.url + GEOLOCATION_INDEX + "geolocations/_bulk"
+        writer = self.elastic.get_bulk_writer(url)
 
         logger.debug("Adding geoloc to %s (in %i packs)" % (url, max_items))
 
         for loc in self.geolocations:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                bulk_json = ""
-                current = 0
-
             geopoint = self.geolocations[loc]
             location = geopoint.copy()
             location["location"] = loc
-            # First upload the raw issue data to ES
-            data_json = json.dumps(location)
             # Don't include in URL non ascii codes
             safe_loc = str(loc.encode('ascii', 'ignore'), 'ascii')
             geo_id = str("%s-%s-%s" % (location["lat"], location["lon"],
                                        safe_loc))
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (geo_id)
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            writer.add(location, geo_id)
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        total = writer.close()
 
         logger.debug("Adding geoloc to ES Done")
 
@@ -383,7 +368,8 @@ class GitHubEnrich(Enrich):
         enrich_index_search_url = self.elastic.index_url + "/_search"
 
         logger.info("Doing enrich_pull_request study for index {}".format(self.elastic.index_url))
-        time.sleep(1)  # HACK: Wait until git enrich index has been written
+        # Ensure the enriched items just written are visible to searches
+        self.elastic.refresh()
 
         def make_request(url, error_msg, data=None, req_type="GET"):
             """
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent cache of SortingHat identities
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import bisect
+import collections
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Read-only copies of the SortingHat data used in the enrichment
+CachedProfile = collections.namedtuple('CachedProfile', ['name', 'email', 'gender', 'gender_acc', 'is_bot'])
+CachedUniqueIdentity = collections.namedtuple('CachedUniqueIdentity', ['uuid', 'profile'])
+CachedOrganization = collections.namedtuple('CachedOrganization', ['name'])
+CachedEnrollment = collections.namedtuple('CachedEnrollment', ['start', 'end', 'organization'])
+
+SQLITE_MAX_VARS = 500  # keys per query, below the SQLite limit of variables
+
+
+class EnrollmentsIndex:
+    """Index of the enrollments of a unique identity by date.
+
+    `find` returns the organization of the first enrollment, in the order
+    given by SortingHat, including the date. The enrollments starting
+    before the date are found with a binary search on the starts, and
+    the first of them that could end after it with another one on the
+    max end of the enrollments up to each one. The first in the original
+    order of the ones left ending after the date is returned.
+
+    :param enrollments: enrollments of the unique identity, sorted as
+        SortingHat does
+    """
+
+    __slots__ = ['starts', 'ends', 'max_ends', 'positions', 'names']
+
+    def __init__(self, enrollments):
+        enrollments = list(enrollments)
+        self.names = [enrollment.organization.name for enrollment in enrollments]
+
+        # Positions of the enrollments in the original order, sorted by start
+        self.positions = sorted(range(len(enrollments)), key=lambda pos: enrollments[pos].start)
+        self.starts = [enrollments[pos].start for pos in self.positions]
+        self.ends = [enrollments[pos].end for pos in self.positions]
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(self.max_ends[-1], end) if self.max_ends else end)
+
+    def find(self, date=None):
+        """Get the organization the identity was enrolled in on a date,
+        or in the first enrollment if there is no date"""
+
+        if not self.names:
+            return None
+        if not date:
+            return self.names[0]
+
+        nstarted = bisect.bisect_right(self.starts, date)
+        first = bisect.bisect_left(self.max_ends, date)
+        matches = [self.positions[i] for i in range(first, nstarted) if self.ends[i] >= date]
+        if matches:
+            return self.names[min(matches)]
+
+        return None
+
+
+class IdentitiesCache:
+    """SortingHat identities stored in a SQLite file shared by several runs.
+
+    It stores the uuid of each identity id (the hash of the backend and
+    the identity data) and the profile and enrollments of each uuid. The
+    entries of the identities and unique identities modified in SortingHat
+    since the last run are removed by `sync`, and the least recently used
+    ones when there are more than `max_entries`.
+
+    :param path: path of the SQLite file
+    :param max_entries: max number of uuids and of ids stored
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.__local = threading.local()
+
+        with self.__connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS ids "
+                         "(id TEXT PRIMARY KEY, uuid TEXT, last_access REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS uidentities "
+                         "(uuid TEXT PRIMARY KEY, data BLOB, last_access REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sync (last_modified TIMESTAMP)")
+
+    def __connect(self):
+        """Connection to the SQLite file of this process and thread.
+
+        Connections can't be shared with the forked worker processes nor
+        with other threads, so each one opens its own one.
+        """
+        local = self.__local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=60,
+                                         detect_types=sqlite3.PARSE_DECLTYPES)
+            local.conn.execute("PRAGMA journal_mode=WAL")
+            local.pid = os.getpid()
+
+        return local.conn
+
+    def sync(self, db):
+        """Remove the entries modified in SortingHat since the last sync.
+
+        :param db: SortingHat database
+        """
+        from .sortinghat_gelk import SortingHat
+
+        conn = self.__connect()
+        row = conn.execute("SELECT last_modified FROM sync").fetchone()
+        since = row[0] if row else None
+
+        sh_ids, uuids, last_modified = SortingHat.get_modified_identities(db, since)
+
+        with conn:
+            if since is None:
+                # Nothing is known about the entries stored
+                conn.execute("DELETE FROM ids")
+                conn.execute("DELETE FROM uidentities")
+            else:
+                self.__delete('ids', 'id', sh_ids)
+                self.__delete('ids', 'uuid', uuids)
+                self.__delete('uidentities', 'uuid', uuids)
+            conn.execute("DELETE FROM sync")
+            conn.execute("INSERT INTO sync VALUES (?)", (last_modified,))
+
+        logger.debug("[identities cache] %s ids and %s uuids modified since %s in SortingHat",
+                     len(sh_ids), len(uuids), since)
+
+    def get_uuids(self, sh_ids):
+        """Get the uuid of the identities ids stored"""
+
+        return dict(self.__select('ids', 'id', 'uuid', sh_ids))
+
+    def get_uidentities(self, uuids):
+        """Get the unique identity and the enrollments of the uuids stored"""
+
+        uidentities = {}
+        enrollments = {}
+
+        for uuid, data in self.__select('uidentities', 'uuid', 'data', uuids):
+            profile, uenrollments = pickle.loads(data)
+            profile = CachedProfile(*profile) if profile else None
+            uidentities[uuid] = CachedUniqueIdentity(uuid, profile)
+            enrollments[uuid] = [CachedEnrollment(start, end, CachedOrganization(name))
+                                 for start, end, name in uenrollments]
+
+        return uidentities, enrollments
+
+    def add(self, uuids, uidentities, enrollments):
+        """Store the data of some identities read from SortingHat.
+
+        :param uuids: dict with the uuid of each identity id
+        :param uidentities: dict with the unique identity of each uuid
+        :param enrollments: dict with the enrollments of each uuid
+        """
+        now = time.time()
+
+        rows = []
+        for uuid, uidentity in uidentities.items():
+            profile = uidentity.profile
+            if profile:
+                profile = (profile.name, profile.email, profile.gender, profile.gender_acc, profile.is_bot)
+            uenrollments = [(enrollment.start, enrollment.end, enrollment.organization.name)
+                            for enrollment in enrollments.get(uuid, [])]
+            rows.append((uuid, pickle.dumps((profile, uenrollments)), now))
+
+        # Only the ids of the uuids stored, so both are removed together
+        ids = [(sh_id, uuid, now) for sh_id, uuid in uuids.items() if uuid in uidentities]
+
+        conn = self.__connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO uidentities VALUES (?, ?, ?)", rows)
+            conn.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?)", ids)
+            self.__evict('uidentities')
+            self.__evict('ids')
+
+    def __select(self, table, key, value, keys):
+        """Get the (key, value) rows of the keys found, updating their last access"""
+
+        conn = self.__connect()
+        keys = list(keys)
+        rows = []
+
+        with conn:
+            for i in range(0, len(keys), SQLITE_MAX_VARS):
+                chunk = keys[i:i + SQLITE_MAX_VARS]
+                marks = ",".join("?" * len(chunk))
+                rows += conn.execute("SELECT %s, %s FROM %s WHERE %s IN (%s)" % (key, value, table, key, marks),
+                                     chunk).fetchall()
+                conn.execute("UPDATE %s SET last_access = ? WHERE %s IN (%s)" % (table, key, marks),
+                             [time.time()] + chunk)
+
+        return rows
+
+    def __delete(self, table, key, keys):
+        conn = self.__connect()
+        keys = list(keys)
+
+        for i in range(0, len(keys), SQLITE_MAX_VARS):
+            chunk = keys[i:i + SQLITE_MAX_VARS]
+            conn.execute("DELETE FROM %s WHERE %s IN (%s)" % (table, key, ",".join("?" * len(chunk))), chunk)
+
+    def __evict(self, table):
+        """Remove the least recently used entries over the max number of entries"""
+
+        conn = self.__connect()
+        nentries = conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+        if nentries > self.max_entries:
+            conn.execute("DELETE FROM %s WHERE rowid IN "
+                         "(SELECT rowid FROM %s ORDER BY last_access LIMIT ?)" % (table, table),
+                         (nentries - self.max_entries,))
@@ -37,6 +37,7 @@ logger = logging.getLogger(__name__)
 class JiraEnrich(Enrich):
 
     roles = ["assignee", "reporter", "creator"]
+    project_repository_fields = ['project_key']
 
     def get_fields_uuid(self):
         return ["assignee_uuid", "reporter_uuid"]
@@ -21,7 +21,6 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from dateutil import parser
@@ -211,27 +210,14 @@ class KitsuneEnrich(Enrich):
 
     def enrich_items(self, ocean_backend):
         max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-        total = 0
+        writer = self.elastic.get_bulk_writer()
 
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)", url, max_items)
+        logger.debug("Adding items to %s (in %i packs)", writer.url, max_items)
 
         items = ocean_backend.fetch()
         for item in items:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            writer.add(rich_item, item[self.get_field_unique_id()])
             # Time to enrich also de answers
             if 'answers_data' in item['data']:
                 for answer in item['data']['answers_data']:
@@ -241,14 +227,7 @@ class KitsuneEnrich(Enrich):
                     if answer['id'] == item['data']['solution']:
                         answer['solution'] = 1
                     rich_answer = self.get_rich_item(answer, kind='answer')
-                    data_json = json.dumps(rich_answer)
-                    bulk_json += '{"index" : {"_id" : "%s_%i" } }\n' % \
-                        (item[self.get_field_unique_id()],
-                         rich_answer['answer_id'])
-                    bulk_json += data_json + "\n"  # Bulk document
-                    current += 1
-
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+                    writer.add(rich_answer, "%s_%i" % (item[self.get_field_unique_id()],
+                                                       rich_answer['answer_id']))
 
-        return total
+        return writer.close()
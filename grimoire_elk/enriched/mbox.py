@@ -21,16 +21,15 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from requests.structures import CaseInsensitiveDict
-from dateutil import parser
 import email.utils
 
 from .enrich import Enrich, metadata
 from ..elastic_mapping import Mapping as BaseMapping
 from .mbox_study_kip import kafka_kip, MAX_LINES_FOR_VOTE
+from .utils import parse_date
 
 
 logger = logging.getLogger(__name__)
@@ -152,7 +151,7 @@ class MBoxEnrich(Enrich):
                 eitem[map_fields[fn]] = None
 
         # Enrich dates
-        eitem["email_date"] = parser.parse(item["metadata__updated_on"]).isoformat()
+        eitem["email_date"] = parse_date(item["metadata__updated_on"]).isoformat()
         eitem["list"] = item["origin"]
 
         if 'Subject' in message and message['Subject']:
@@ -174,7 +173,7 @@ class MBoxEnrich(Enrich):
 
         # Time zone
         try:
-            message_date = parser.parse(message['Date'])
+            message_date = parse_date(message['Date'])
             eitem["tz"] = int(message_date.strftime("%z")[0:3])
         except Exception:
             eitem["tz"] = None
@@ -205,40 +204,15 @@ class MBoxEnrich(Enrich):
 
     def enrich_items_old(self, items):
         max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url + '/items/_bulk'
+        writer = self.elastic.get_bulk_writer()
 
-        logger.debug("Adding items to %s (in %i packs)" % (url, max_items))
+        logger.debug("Adding items to %s (in %i packs)" % (writer.url, max_items))
 
         for item in items:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (rich_item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            writer.add(rich_item, rich_item[self.get_field_unique_id()])
 
-        if current == 0:
-            return total
-
-        try:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logger.error("Encoding error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1', 'ignore')
-
-            total += self.elastic.safe_put_bulk(url, bulk_json)
-
-        return total
+        return writer.close()
 
     def kafka_kip(self, ocean_backend, enrich_backend, no_incremental=False):
         # KIP study is not incremental
@@ -21,7 +21,6 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from dateutil import parser
@@ -237,29 +236,14 @@ class MediaWikiEnrich(Enrich):
 
     def enrich_events(self, ocean_backend):
         max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-        total = 0
+        writer = self.elastic.get_bulk_writer()
 
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)" % (url, max_items))
+        logger.debug("Adding items to %s (in %i packs)" % (writer.url, max_items))
 
         items = ocean_backend.fetch()
         for item in items:
             rich_item_reviews = self.get_rich_item_reviews(item)
             for enrich_review in rich_item_reviews:
-                if current >= max_items:
-                    total += self.elastic.safe_put_bulk(url, bulk_json)
-                    bulk_json = ""
-                    current = 0
-                data_json = json.dumps(enrich_review)
-                bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                    (enrich_review[self.get_field_unique_id()])
-                bulk_json += data_json + "\n"  # Bulk document
-                current += 1
-
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
-
-        return total
+                writer.add(enrich_review, enrich_review[self.get_field_unique_id()])
+
+        return writer.close()
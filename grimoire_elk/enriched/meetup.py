@@ -72,6 +72,7 @@ class Mapping(BaseMapping):
 class MeetupEnrich(Enrich):
 
     mapping = Mapping
+    project_repository_fields = ['tag']
 
     def get_field_author(self):
         return "author"
@@ -26,13 +26,23 @@ from datetime import datetime
 import logging
 import traceback
 
-from sortinghat import api
-from sortinghat.db.model import Identity
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
+
+from sortinghat import api, utils
+from sortinghat.db.model import Enrollment, Identity, Organization, Profile, UniqueIdentity
 from sortinghat.exceptions import AlreadyExistsError, InvalidValueError
 
+from .utils import chunks
+
 
 logger = logging.getLogger(__name__)
 
+BULK_CHUNK_SIZE = 1000  # identities per query and per insert when adding them in bulk
+ENROLLMENT_START = datetime(1900, 1, 1)
+ENROLLMENT_END = datetime(2100, 1, 1)
+
 
 class SortingHat(object):
 
@@ -48,6 +58,85 @@ class SortingHat(object):
                 uuid = identities[0].uuid
         return uuid
 
+    @classmethod
+    def get_identities_batch(cls, db, sh_ids, extra_uuids=None):
+        """ Get the SortingHat data of several identities with a query per table.
+
+        :param db: SortingHat database
+        :param sh_ids: ids of the identities
+        :param extra_uuids: uuids to get besides the ones of the identities
+        :returns: a tuple with dicts of the uuid of each id found, the unique
+            identity (with its profile) of each uuid and the enrollments (with
+            their organization, sorted as api.enrollments does) of each uuid
+        """
+        uuids = {}
+        uidentities = {}
+        enrollments = {}
+
+        if not sh_ids and not extra_uuids:
+            return uuids, uidentities, enrollments
+
+        with db.connect() as session:
+            for chunk in chunks(sh_ids or [], BULK_CHUNK_SIZE):
+                query = session.query(Identity.id, Identity.uuid).\
+                    filter(Identity.id.in_(chunk))
+                for sh_id, uuid in query:
+                    uuids[sh_id] = uuid
+
+            for chunk in chunks(set(uuids.values()) | set(extra_uuids or []), BULK_CHUNK_SIZE):
+                query = session.query(UniqueIdentity).\
+                    options(joinedload(UniqueIdentity.profile)).\
+                    filter(UniqueIdentity.uuid.in_(chunk))
+                for uidentity in query:
+                    uidentities[uidentity.uuid] = uidentity
+                    enrollments[uidentity.uuid] = []
+
+            # Sorted as api.enrollments does, the order decides the organization
+            # of an item when several enrollments include its date
+            for chunk in chunks(list(uidentities), BULK_CHUNK_SIZE):
+                query = session.query(Enrollment).\
+                    join(Enrollment.organization).\
+                    options(contains_eager(Enrollment.organization)).\
+                    filter(Enrollment.uuid.in_(chunk)).\
+                    order_by(Enrollment.uuid, Organization.name, Enrollment.start, Enrollment.end)
+                for enrollment in query:
+                    enrollments[enrollment.uuid].append(enrollment)
+
+            # Objects are used once the session is closed
+            session.expunge_all()
+
+        return uuids, uidentities, enrollments
+
+    @classmethod
+    def get_modified_identities(cls, db, since=None):
+        """ Get the identities modified in SortingHat since a date.
+
+        :param db: SortingHat database
+        :param since: date of the last modification already known, if None
+            only the date of the last modification is returned
+        :returns: a tuple with the ids and the uuids modified since the date
+            (included) and the date of the last modification
+        """
+        sh_ids = []
+        uuids = []
+
+        with db.connect() as session:
+            dates = [session.query(func.max(Identity.last_modified)).scalar(),
+                     session.query(func.max(UniqueIdentity.last_modified)).scalar(),
+                     since]
+            last_modified = max([date for date in dates if date], default=None)
+
+            if since:
+                query = session.query(Identity.id).\
+                    filter(Identity.last_modified >= since)
+                sh_ids = [row[0] for row in query]
+
+                query = session.query(UniqueIdentity.uuid).\
+                    filter(UniqueIdentity.last_modified >= since)
+                uuids = [row[0] for row in query]
+
+        return sh_ids, uuids, last_modified
+
     @classmethod
     def get_github_commit_username(cls, db, identity, source):
         user = None
@@ -98,8 +187,7 @@ class SortingHat(object):
             try:
                 api.add_organization(db, identity['company'])
                 api.add_enrollment(db, uuid, identity['company'],
-                                   datetime(1900, 1, 1),
-                                   datetime(2100, 1, 1))
+                                   ENROLLMENT_START, ENROLLMENT_END)
             except AlreadyExistsError:
                 pass
 
@@ -113,12 +201,130 @@ class SortingHat(object):
 
         total = 0
 
-        for identity in identities:
+        for chunk in chunks(cls.__get_identities_ids(identities, backend).items(), BULK_CHUNK_SIZE):
             try:
-                cls.add_identity(db, identity, backend)
-                total += 1
-            except Exception as e:
-                logger.error("Unexcepted error when adding identities: %s" % e)
+                total += cls.add_identities_bulk(db, dict(chunk), backend)
                 continue
+            except IntegrityError as e:
+                # Likely added meanwhile by another process
+                logger.debug("Identities not added in bulk to SH, adding them one by one: %s", e)
+            except Exception as e:
+                logger.warning("Identities not added in bulk to SH, adding them one by one: %s", e)
+
+            for _, identity in chunk:
+                try:
+                    cls.add_identity(db, identity, backend)
+                    total += 1
+                except Exception as e:
+                    logger.error("Unexcepted error when adding identities: %s" % e)
+                    continue
 
         logger.info("Total identities added to SH: %i", total)
+
+    @classmethod
+    def __get_identities_ids(cls, identities, backend):
+        """ Get the SH id of each different identity """
+
+        identities_ids = {}
+
+        for identity in identities:
+            try:
+                sh_id = utils.uuid(backend, email=identity['email'],
+                                   name=identity['name'], username=identity['username'])
+            except (InvalidValueError, ValueError):
+                logger.warning("Trying to add a None identity. Ignoring it.")
+                continue
+            except UnicodeEncodeError:
+                logger.warning("UnicodeEncodeError. Ignoring it. %s %s %s",
+                               identity['email'], identity['name'],
+                               identity['username'])
+                continue
+
+            # The company of the first one is used, as add_identity does
+            if sh_id not in identities_ids:
+                identities_ids[sh_id] = identity
+
+        return identities_ids
+
+    @classmethod
+    def add_identities_bulk(cls, db, identities, backend):
+        """ Add the identities not found in SortingHat, with their profiles
+        and enrollments, in a single transaction.
+
+        :param db: SortingHat database
+        :param identities: dict with the identity of each SH id
+        :param backend: source of the identities
+        :returns: number of identities added
+        """
+        now = datetime.utcnow()
+
+        with db.connect() as session:
+            query = session.query(Identity.id, Identity.uuid).\
+                filter(Identity.id.in_(list(identities)))
+            uuids = dict(query.all())
+
+            new_ids = [sh_id for sh_id in identities if sh_id not in uuids]
+
+            # Each new identity is its own unique identity
+            uidentities_rows = []
+            identities_rows = []
+            profiles_rows = []
+            for sh_id in new_ids:
+                identity = identities[sh_id]
+                uidentities_rows.append({"uuid": sh_id, "last_modified": now})
+                identities_rows.append({"id": sh_id, "uuid": sh_id, "source": backend,
+                                        "name": identity['name'], "email": identity['email'],
+                                        "username": identity['username'], "last_modified": now})
+                # Empty values are stored as None, as api.edit_profile does
+                profiles_rows.append({"uuid": sh_id, "email": identity['email'] or None, "is_bot": False,
+                                      "name": identity['name'] or identity['username'] or None})
+                uuids[sh_id] = sh_id
+
+            if new_ids:
+                session.execute(UniqueIdentity.__table__.insert(), uidentities_rows)
+                session.execute(Identity.__table__.insert(), identities_rows)
+                session.execute(Profile.__table__.insert(), profiles_rows)
+
+            cls.__add_enrollments_bulk(session, identities, uuids)
+
+        logger.debug("%i identities added in bulk to SH, %i already there",
+                     len(new_ids), len(identities) - len(new_ids))
+
+        return len(new_ids)
+
+    @classmethod
+    def __add_enrollments_bulk(cls, session, identities, uuids):
+        """ Add the organizations and the enrollments of the identities with
+        a company not found in SortingHat """
+
+        companies = {uuids[sh_id]: identity['company'] for sh_id, identity in identities.items()
+                     if identity.get('company', None)}
+        if not companies:
+            return
+
+        # Organization names are compared ignoring the case, as the SH database does
+        names = {name.lower(): name for name in companies.values()}
+        query = session.query(Organization.name, Organization.id).\
+            filter(Organization.name.in_(list(names.values())))
+        orgs = {name.lower(): org_id for name, org_id in query}
+
+        new_names = [name for key, name in names.items() if key not in orgs]
+        if new_names:
+            session.execute(Organization.__table__.insert(), [{"name": name} for name in new_names])
+            query = session.query(Organization.name, Organization.id).\
+                filter(Organization.name.in_(new_names))
+            orgs.update((name.lower(), org_id) for name, org_id in query)
+
+        companies = {uuid: orgs[name.lower()] for uuid, name in companies.items()}
+
+        query = session.query(Enrollment.uuid, Enrollment.organization_id).\
+            filter(Enrollment.uuid.in_(list(companies)),
+                   Enrollment.start == ENROLLMENT_START,
+                   Enrollment.end == ENROLLMENT_END)
+        enrolled = set(query.all())
+
+        enrollments_rows = [{"uuid": uuid, "organization_id": org_id,
+                             "start": ENROLLMENT_START, "end": ENROLLMENT_END}
+                            for uuid, org_id in companies.items() if (uuid, org_id) not in enrolled]
+        if enrollments_rows:
+            session.execute(Enrollment.__table__.insert(), enrollments_rows)
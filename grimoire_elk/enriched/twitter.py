@@ -61,6 +61,7 @@ class Mapping(BaseMapping):
 class TwitterEnrich(Enrich):
 
     mapping = Mapping
+    project_repository_fields = ['hashtags_analyzed']
 
     def get_field_author(self):
         return "user"
@@ -23,9 +23,16 @@
 #
 
 import datetime
+import functools
 import inspect
 import json
 import logging
+import math
+import queue
+import re
+import threading
+import time
+import zlib
 
 import requests
 
@@ -34,9 +41,32 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 from dateutil import parser, tz
 
+try:
+    import orjson
+    ORJSON_LIBS = True
+except ImportError:
+    ORJSON_LIBS = False
+
+try:
+    import ujson
+    UJSON_LIBS = True
+except ImportError:
+    UJSON_LIBS = False
 
 logger = logging.getLogger(__name__)
 
+GZIP_MIN_SIZE = 1024  # request bodies smaller than this are not compressed
+GZIP_CHUNK_SIZE = 1024 * 1024  # bytes of the body compressed in each step
+GZIP_LEVEL = 3  # fast compression, bulk bodies are very redundant anyway
+
+PREFETCH_POLL = 1  # seconds between checks of a stopped prefetch
+
+PARSE_DATE_CACHE_SIZE = 10000  # date strings parsed kept in memory
+
+ISO_DATE_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})"
+                              r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?"
+                              r"(Z|[+-]\d{2}:?\d{2})?)?$")
+
 
 def get_repository_filter(perceval_backend, perceval_backend_name,
                           term=False):
@@ -82,6 +112,49 @@ def get_repository_filter(perceval_backend, perceval_backend_name,
     return filter_
 
 
+def parse_date(date):
+    """ Parse a date string as dateutil's parser would do.
+
+    ISO 8601 dates, the most common ones in the items, are parsed with a
+    regular expression and the rest (e.g., RFC 2822 dates in emails) with
+    dateutil. The dates parsed last are cached, so the ones repeated in
+    the items are parsed once.
+
+    :param date: date string, or datetime which is returned as is
+    :returns: a datetime
+    """
+    if isinstance(date, datetime.datetime):
+        return date
+
+    return _parse_date_str(date)
+
+
+@functools.lru_cache(maxsize=PARSE_DATE_CACHE_SIZE)
+def _parse_date_str(date):
+
+    match = ISO_DATE_PATTERN.match(date)
+    if match:
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+        try:
+            tzinfo = None
+            if offset == 'Z':
+                tzinfo = tz.tzutc()
+            elif offset:
+                seconds = int(offset[1:3]) * 3600 + int(offset[-2:]) * 60
+                seconds = -seconds if offset[0] == '-' else seconds
+                tzinfo = tz.tzutc() if seconds == 0 else tz.tzoffset(None, seconds)
+
+            return datetime.datetime(int(year), int(month), int(day),
+                                     int(hour or 0), int(minute or 0), int(second or 0),
+                                     int(fraction.ljust(6, '0')) if fraction else 0,
+                                     tzinfo=tzinfo)
+        except ValueError:
+            # Out of range values, let dateutil deal with them
+            pass
+
+    return parser.parse(date)
+
+
 def get_time_diff_days(start, end):
     ''' Number of days between two dates in UTC format  '''
 
@@ -89,9 +162,9 @@ def get_time_diff_days(start, end):
         return None
 
     if type(start) is not datetime.datetime:
-        start = parser.parse(start).replace(tzinfo=None)
+        start = parse_date(start).replace(tzinfo=None)
     if type(end) is not datetime.datetime:
-        end = parser.parse(end).replace(tzinfo=None)
+        end = parse_date(end).replace(tzinfo=None)
 
     seconds_day = float(60 * 60 * 24)
     diff_days = (end - start).total_seconds() / seconds_day
@@ -116,15 +189,158 @@ def unixtime_to_datetime(ut):
     return dt
 
 
-def grimoire_con(insecure=True, conn_retries=21, total=21):
-    conn = requests.Session()
+# All the libraries encode the dates and the floats not valid in JSON
+# (NaN and infinite) as orjson does: ISO 8601 strings and null
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def _finite_floats(obj):
+    """ Copy of obj with NaN and infinite floats replaced by None """
+
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite_floats(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite_floats(value) for value in obj]
+    return obj
+
+
+def _stdlib_dumps(obj):
+    try:
+        return json.dumps(obj, default=_json_default, allow_nan=False).encode('utf-8')
+    except ValueError:
+        return json.dumps(_finite_floats(obj), default=_json_default).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Recent versions of ujson encode NaN as is, unless told not to
+UJSON_KWARGS = {'ensure_ascii': False}
+if UJSON_LIBS:
+    try:
+        ujson.dumps(0, allow_nan=False)
+        UJSON_KWARGS['allow_nan'] = False
+    except TypeError:
+        pass
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, **UJSON_KWARGS).encode('utf-8')
+
+
+JSON_BACKENDS = {
+    'json': (_stdlib_dumps, json.loads),
+    'orjson': (_orjson_dumps, orjson.loads) if ORJSON_LIBS else None,
+    'ujson': (_ujson_dumps, ujson.loads) if UJSON_LIBS else None
+}
+
+json_backend = None  # name of the library used by json_dumps and json_loads
+_dumps, _loads = JSON_BACKENDS['json']
+
+
+def set_json_backend(name=None):
+    """ Select the library used to encode and decode JSON: orjson, ujson
+    or json. By default the fastest one installed is used """
+
+    global json_backend, _dumps, _loads
+
+    if not name:
+        name = 'orjson' if ORJSON_LIBS else 'ujson' if UJSON_LIBS else 'json'
+
+    if name not in JSON_BACKENDS:
+        raise ValueError("Unknown JSON library %s" % name)
+    if not JSON_BACKENDS[name]:
+        raise ValueError("JSON library %s is not installed" % name)
+
+    json_backend = name
+    _dumps, _loads = JSON_BACKENDS[name]
+    logger.debug("Using %s to encode and decode JSON", name)
+
+
+def json_dumps(obj):
+    """ Encode obj to JSON as UTF-8 bytes. Objects not supported by the
+    selected library (e.g., big ints, lone surrogates) are encoded with
+    the json module. Dates are encoded as ISO 8601 strings, and NaN and
+    infinite floats as null, whatever the library """
+
+    try:
+        return _dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        return _stdlib_dumps(obj)
+
+
+def json_loads(data):
+    """ Decode the JSON document in data (str or bytes) """
+
+    try:
+        return _loads(data)
+    except ValueError:
+        return json.loads(data)
+
+
+set_json_backend()
+
+
+def gzip_body(data):
+    """Compress a request body with gzip.
+
+    The body is compressed by slices read through a memoryview, so the
+    uncompressed data is not copied.
+
+    :param data: body to compress (str, bytes or memoryview)
+    :returns: the compressed body as bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    chunks = []
+    with memoryview(data) as view:
+        for pos in range(0, len(view), GZIP_CHUNK_SIZE):
+            chunks.append(compressor.compress(view[pos:pos + GZIP_CHUNK_SIZE]))
+    chunks.append(compressor.flush())
+
+    return b''.join(chunks)
+
+
+class GrimoireSession(requests.Session):
+    """HTTP session which can compress with gzip the request bodies"""
+
+    def __init__(self, gzip_requests=False):
+        super().__init__()
+        self.gzip_requests = gzip_requests
+
+    def request(self, method, url, *args, **kwargs):
+        data = kwargs.get('data', None)
+
+        if isinstance(data, (str, bytes, memoryview)):
+            if self.gzip_requests and len(data) >= GZIP_MIN_SIZE:
+                kwargs['data'] = gzip_body(data)
+                headers = dict(kwargs.get('headers', None) or {})
+                headers['Content-Encoding'] = 'gzip'
+                kwargs['headers'] = headers
+            elif isinstance(data, memoryview):
+                kwargs['data'] = data.tobytes()
+
+        return super().request(method, url, *args, **kwargs)
+
+
+def grimoire_con(insecure=True, conn_retries=21, total=21, gzip_requests=False, pool_size=10):
+    conn = GrimoireSession(gzip_requests)
     # {backoff factor} * (2 ^ ({number of total retries} - 1))
     # conn_retries = 21  # 209715.2 = 2.4d
     # total covers issues like 'ProtocolError('Connection aborted.')
     # Retry when there are errors in HTTP connections
     retries = Retry(total=total, connect=conn_retries, read=8, redirect=5, backoff_factor=0.2,
                     method_whitelist=False)
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+    # pool_size connections are kept open for each host
+    adapter = requests.adapters.HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
     conn.mount('http://', adapter)
     conn.mount('https://', adapter)
 
@@ -135,6 +351,83 @@ def grimoire_con(insecure=True, conn_retries=21, total=21):
     return conn
 
 
+def prefetch(iterable, depth=1, deadline=None):
+    """ Iterate over iterable in a background thread, reading up to depth
+    values in advance, so producing the next values overlaps with the
+    processing of the current one. Exceptions raised by iterable are
+    raised again in the consumer. With depth 0 iterable is just returned.
+
+    If deadline (as returned by time.time) is set, TimeoutError is raised
+    when waiting for a value beyond it. The thread producing the values
+    is left blocked in iterable, if it is.
+    """
+
+    if depth < 1:
+        return iter(iterable)
+
+    values = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                values.put(value, timeout=PREFETCH_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for value in iterator:
+                if not put((True, value)):
+                    break
+            else:
+                put((False, None))
+        except Exception as ex:
+            put((False, ex))
+        finally:
+            # Generators must be closed from the thread running them
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def consume():
+        try:
+            while True:
+                try:
+                    timeout = max(deadline - time.time(), 0) if deadline else None
+                    more, value = values.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError("Timeout waiting for the next value")
+                if not more:
+                    if value is not None:
+                        raise value
+                    return
+                yield value
+        finally:
+            stop.set()
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    return consume()
+
+
+def chunks(items, size):
+    """ Generator of lists with up to size items from the iterable items """
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_last_enrich(backend_cmd, enrich_backend):
     last_enrich = None
 
@@ -41,3 +41,9 @@ class ELKError(BaseError):
     """Generic error for elk error"""
 
     message = "%(cause)s"
+
+
+class FeedTimeoutError(BaseError):
+    """Feeding of a data source stopped after its timeout"""
+
+    message = "Timeout of %(timeout)s seconds feeding %(origin)s"
@@ -29,9 +29,11 @@ import inspect
 import logging
 
 from datetime import datetime
-from ..enriched.utils import unixtime_to_datetime, get_repository_filter
+from time import time
+from ..enriched.utils import unixtime_to_datetime, get_repository_filter, prefetch
 from ..elastic_items import ElasticItems
 from ..elastic_mapping import Mapping
+from ..errors import FeedTimeoutError
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +41,8 @@ logger = logging.getLogger(__name__)
 class ElasticOcean(ElasticItems):
 
     mapping = Mapping
+    feed_queue_size = 0  # items queued between the fetch, fix and upload stages
+    feed_timeout = None  # max seconds feeding the items
 
     @classmethod
     def add_params(cls, cmdline_parser):
@@ -202,61 +206,87 @@ class ElasticOcean(ElasticItems):
         self.feed_items(items)
 
     def feed_items(self, items):
+        """Fix the items and upload them to ElasticSearch.
+
+        If feed_queue_size is set, fetching the items from the data source,
+        fixing them and uploading them run as a pipeline of stages joined by
+        queues of that size, so the backend keeps fetching items while the
+        previous ones are fixed and uploaded.
+
+        If feed_timeout is set, the feeding is stopped with an error after
+        that number of seconds, once the items read are uploaded. The items
+        are fetched in a background thread then, so the timeout is detected
+        also while waiting for a data source not sending them.
+        """
         task_init = datetime.now()
+        deadline = time() + self.feed_timeout if self.feed_timeout else None
 
-        items_pack = []  # to feed item in packs
-        drop = 0
+        # Items are sent in packs, in background if the writer is concurrent
+        writer = self.elastic.get_bulk_writer()
+        field_id = self.get_field_unique_id()
+        first_item = None
+        stats = {'drop': 0}
         added = 0
+        timeout = False
 
-        for item in items:
-            # print("%s %s" % (item['url'], item['lastUpdated_date']))
-            # Add date field for incremental analysis if needed
-            self.add_update_date(item)
-            self._fix_item(item)
-            if self.project:
-                item['project'] = self.project
-            if len(items_pack) >= self.elastic.max_items_bulk:
-                self._items_to_es(items_pack)
-                items_pack = []
-            if not self.drop_item(item):
-                items_pack.append(item)
+        if deadline:
+            items = prefetch(items, max(self.feed_queue_size, 1), deadline)
+        else:
+            items = prefetch(items, self.feed_queue_size)
+        items = prefetch(self.__fix_items(items, stats), self.feed_queue_size)
+
+        try:
+            for item in items:
+                if deadline and time() > deadline:
+                    timeout = True
+                    break
+                if not first_item:
+                    first_item = item
+                writer.add(item, item[field_id])
                 added += 1
-            else:
-                drop += 1
-        self._items_to_es(items_pack)
+        except TimeoutError:
+            timeout = True
+        finally:
+            # Stop the stages running in background if the upload fails
+            items.close()
+
+        inserted = writer.close()
+        if added != inserted:
+            self._log_missing_items(first_item, added - inserted, added)
 
         total_time_min = (datetime.now() - task_init).total_seconds() / 60
 
         logger.debug("Added %i items to index %s", added, self.elastic.index)
-        logger.debug("Dropped %i items using drop_item filter" % (drop))
+        logger.debug("Dropped %i items using drop_item filter" % (stats['drop']))
         logger.info("Finished in %.2f min" % (total_time_min))
 
-        return self
-
-    def _items_to_es(self, json_items):
-        """ Append items JSON to ES (data source state) """
+        if timeout:
+            raise FeedTimeoutError(timeout=self.feed_timeout, origin=self.perceval_backend.origin)
 
-        if len(json_items) == 0:
-            return
-
-        logger.info("Adding items to Ocean for %s (%i items)" %
-                    (self, len(json_items)))
-
-        field_id = self.get_field_unique_id()
+        return self
 
-        inserted = self.elastic.bulk_upload(json_items, field_id)
+    def __fix_items(self, items, stats):
+        """Generator of the items to be uploaded, counting the dropped ones in stats"""
 
-        if len(json_items) != inserted:
-            missing = len(json_items) - inserted
-            info = json_items[0]
+        for item in items:
+            # Add date field for incremental analysis if needed
+            self.add_update_date(item)
+            self._fix_item(item)
+            if self.project:
+                item['project'] = self.project
+            if not self.drop_item(item):
+                yield item
+            else:
+                stats['drop'] += 1
 
-            name = info['backend_name']
-            version = info['backend_version']
-            origin = info['origin']
+    def _log_missing_items(self, info, missing, total):
+        """ Warn about items not inserted in ES, using info to identify the backend """
 
-            logger.warning("%s/%s missing JSON items for backend %s [ver. %s], origin %s",
-                           str(missing),
-                           str(len(json_items)),
-                           name, version, origin)
+        name = info['backend_name']
+        version = info['backend_version']
+        origin = info['origin']
 
-        return inserted
+        logger.warning("%s/%s missing JSON items for backend %s [ver. %s], origin %s",
+                       str(missing),
+                       str(total),
+                       name, version, origin)
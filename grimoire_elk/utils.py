@@ -345,8 +345,17 @@ def get_params_parser():
     parser.add_argument('--project', help="Project for the repository (origin)")
     parser.add_argument('--refresh-projects', action='store_true', help="Refresh projects in enriched items")
     parser.add_argument('--db-sortinghat', help="SortingHat DB")
+    parser.add_argument('--sh-cache', help="SQLite file to cache SortingHat identities between runs")
+    parser.add_argument('--sh-cache-size', type=int,
+                        help="Max identities stored in the SortingHat identities cache (default 100000).")
     parser.add_argument('--only-identities', action='store_true', help="Only add identities to SortingHat DB")
     parser.add_argument('--refresh-identities', action='store_true', help="Refresh identities in enriched items")
+    parser.add_argument('--refresh-identities-incremental', action='store_true',
+                        help="Refresh identities in the enriched items of the identities "
+                             "modified in SortingHat since the last incremental refresh")
+    parser.add_argument('--refresh-identities-by-query', action='store_true',
+                        help="Refresh identities of some authors or modified in SortingHat with update by query "
+                             "scripts in Elasticsearch, without reading the enriched items")
     parser.add_argument('--author_id', nargs='*', help="Field author_ids to be refreshed")
     parser.add_argument('--author_uuid', nargs='*', help="Field author_uuids to be refreshed")
     parser.add_argument('--github-token', help="If provided, github usernames will be retrieved in git enrich.")
@@ -355,8 +364,49 @@ def get_params_parser():
     parser.add_argument('--only-studies', action='store_true', help="Execute only studies.")
     parser.add_argument('--bulk-size', default=1000, type=int,
                         help="Number of items per bulk request to Elasticsearch.")
+    parser.add_argument('--bulk-adaptive', action='store_true',
+                        help="Adapt the items per bulk request of each index to the Elasticsearch latency.")
+    parser.add_argument('--bulk-size-min', type=int,
+                        help="Min number of items per bulk request with --bulk-adaptive (default 10).")
+    parser.add_argument('--bulk-size-max', type=int,
+                        help="Max number of items per bulk request with --bulk-adaptive (default 10000).")
+    parser.add_argument('--bulk-bytes', type=int,
+                        help="Max size in bytes of a bulk request to Elasticsearch (default 10 MB).")
+    parser.add_argument('--bulk-workers', type=int,
+                        help="Number of bulk requests in flight to Elasticsearch (default 1, synchronous).")
+    parser.add_argument('--bulk-dead-letter',
+                        help="Directory to store the items failed in bulk requests to Elasticsearch.")
+    parser.add_argument('--bulk-replay-dead-letters', action='store_true',
+                        help="Send again the items of the dead letter files once the indexes are fed.")
+    parser.add_argument('--gzip-requests', action='store_true',
+                        help="Compress with gzip the bodies of the requests to Elasticsearch.")
     parser.add_argument('--scroll-size', default=100, type=int,
                         help="Number of items to get from Elasticsearch when scrolling.")
+    parser.add_argument('--enrich-workers', type=int,
+                        help="Number of processes enriching the raw items (default 1, "
+                             "not used with --batch).")
+    parser.add_argument('--enrich-run-id',
+                        help="Id of the enrichment run added to the enriched items (default: a random one).")
+    parser.add_argument('--json-library', choices=['orjson', 'ujson', 'json'],
+                        help="Library to encode and decode JSON (default: the fastest installed).")
+    parser.add_argument('--scroll-slices', type=int,
+                        help="Number of slices of the scroll read in parallel from Elasticsearch.")
+    parser.add_argument('--prefetch-pages', type=int,
+                        help="Pages read in advance from Elasticsearch while the current one is processed.")
+    parser.add_argument('--feed-queue-size', type=int,
+                        help="Items queued between fetching, fixing and uploading the raw items (default 0, sequential).")
+    parser.add_argument('--feed-timeout', type=int,
+                        help="Max seconds feeding the items of a repository.")
+    parser.add_argument('--batch',
+                        help="JSON file with the repositories to feed in this process: a list of jobs "
+                             "with backend, backend_args, index, index_enrich and project, or a projects.json "
+                             "file, feeding the repositories of backend in --index and --index-enrich.")
+    parser.add_argument('--batch-workers', type=int, default=4,
+                        help="Repositories of the batch fed at the same time (default 4).")
+    parser.add_argument('--batch-host-workers', type=int, default=2,
+                        help="Repositories of the same host of the batch fed at the same time (default 2).")
+    parser.add_argument('--search-after', action='store_true',
+                        help="Read items from Elasticsearch with search_after instead of scroll.")
     parser.add_argument('--arthur', action='store_true', help="Read items from arthur redis queue")
     parser.add_argument('--pair-programming', action='store_true', help="Do pair programming in git enrich")
     parser.add_argument('--studies-list', nargs='*', help="List of studies to be executed")
@@ -79,15 +79,8 @@ def data2es(items, ocean):
 
         return item
 
-    items_pack = []  # to feed item in packs
-
-    for item in items:
-        item = ocean_item(item)
-        if len(items_pack) >= ocean.elastic.max_items_bulk:
-            ocean._items_to_es(items_pack)
-            items_pack = []
-        items_pack.append(item)
-    inserted = ocean._items_to_es(items_pack)
+    items = [ocean_item(item) for item in items]
+    inserted = ocean.elastic.bulk_upload(items, ocean.get_field_unique_id())
 
     return inserted
 
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import collections
+import logging
+import pickle
+import sys
+import unittest
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from arthur.common import Q_STORAGE_ITEMS
+
+from grimoire_elk.arthur_queue import ArthurQueue, processing_queue, tag_queue
+
+
+class MockRedis:
+    """In memory redis lists with the commands used by ArthurQueue"""
+
+    def __init__(self):
+        self.lists = collections.defaultdict(list)
+
+    def register_script(self, script):
+        def pop_items(keys, args):
+            items = self.lists[keys[0]][:args[0]]
+            del self.lists[keys[0]][:args[0]]
+            self.lists[keys[1]].extend(items)
+            return items
+        return pop_items
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+    def rpush(self, key, *values):
+        self.lists[key].extend(values)
+
+    def rpoplpush(self, src, dst):
+        if not self.lists[src]:
+            return None
+        value = self.lists[src].pop()
+        self.lists[dst].insert(0, value)
+        return value
+
+    def delete(self, key):
+        self.lists.pop(key, None)
+
+
+def arthur_item(tag, uuid):
+    return pickle.dumps({'tag': tag, 'uuid': uuid})
+
+
+class TestArthurQueue(unittest.TestCase):
+    """Unit tests for ArthurQueue class"""
+
+    def setUp(self):
+        self.conn = MockRedis()
+        for i in range(5):
+            self.conn.rpush(Q_STORAGE_ITEMS, arthur_item('git', i), arthur_item('gerrit', i))
+
+    def test_items(self):
+        """Test the items of a tag are read in batches and the others moved to their list"""
+
+        queue = ArthurQueue(self.conn, 'git', batch_size=3)
+        uuids = [item['uuid'] for item in queue.items()]
+
+        self.assertListEqual(uuids, list(range(5)))
+        self.assertListEqual(self.conn.lists[Q_STORAGE_ITEMS], [])
+        self.assertListEqual(self.conn.lists[tag_queue('gerrit')], [arthur_item('gerrit', i) for i in range(5)])
+        self.assertEqual(len(self.conn.lists[processing_queue('git')]), 10)
+
+        queue.ack()
+        self.assertListEqual(self.conn.lists[processing_queue('git')], [])
+
+        # The items of other tags are read from their list
+        queue = ArthurQueue(self.conn, 'gerrit', batch_size=3)
+        uuids = [item['uuid'] for item in queue.items()]
+        self.assertListEqual(uuids, list(range(5)))
+
+    def test_requeue(self):
+        """Test the items not acknowledged are read again"""
+
+        queue = ArthurQueue(self.conn, 'git', batch_size=3)
+        items = queue.items()
+        self.assertEqual(next(items)['uuid'], 0)
+        self.assertEqual(next(items)['uuid'], 1)
+
+        # The upload failed, so the items are not acknowledged
+        self.conn.rpush(Q_STORAGE_ITEMS, arthur_item('git', 5))
+        queue = ArthurQueue(self.conn, 'git', batch_size=3)
+        uuids = [item['uuid'] for item in queue.items()]
+        queue.ack()
+
+        self.assertListEqual(uuids, list(range(6)))
+        self.assertListEqual(self.conn.lists[processing_queue('git')], [])
+        self.assertListEqual(self.conn.lists[tag_queue('git')], [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
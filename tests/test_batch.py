@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import collections
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.batch import BatchScheduler, FeedJob, load_jobs
+
+
+class TestBatch(unittest.TestCase):
+    """Unit tests for the feeding of several repositories in a process"""
+
+    def setUp(self):
+        self.tmp_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+
+    def tearDown(self):
+        os.remove(self.tmp_file.name)
+
+    def write_jobs(self, data):
+        with self.tmp_file as f:
+            json.dump(data, f)
+
+    def test_host(self):
+        """Test the host of the jobs"""
+
+        self.assertEqual(FeedJob('git', ['https://github.com/chaoss/grimoirelab-elk']).host, 'github.com')
+        self.assertEqual(FeedJob('github', ['--owner', 'chaoss', '--repository', 'grimoirelab']).host, 'github')
+
+    def test_load_jobs(self):
+        """Test the jobs are read from a list"""
+
+        self.write_jobs([{"backend": "git", "backend_args": ["https://example.com/a.git"], "project": "A"},
+                         {"backend_args": ["https://example.com/b.git"], "index": "git_b"}])
+
+        jobs = load_jobs(self.tmp_file.name, 'git', 'git_raw', 'git_enriched')
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0].backend, 'git')
+        self.assertListEqual(jobs[0].backend_args, ["https://example.com/a.git"])
+        self.assertEqual(jobs[0].index, 'git_raw')
+        self.assertEqual(jobs[0].index_enrich, 'git_enriched')
+        self.assertEqual(jobs[0].project, 'A')
+        self.assertEqual(jobs[1].backend, 'git')
+        self.assertEqual(jobs[1].index, 'git_b')
+        self.assertIsNone(jobs[1].project)
+
+    def test_load_jobs_projects(self):
+        """Test the jobs are read from a projects.json file"""
+
+        self.write_jobs({"A": {"git": ["https://example.com/a.git", "https://example.com/b.git"],
+                               "mbox": ["list /tmp/list"]},
+                         "B": {"git": ["https://example.com/c.git --filter-raw=data.tag:x"]}})
+
+        jobs = load_jobs(self.tmp_file.name, 'git', 'git_raw', 'git_enriched')
+        self.assertListEqual([(job.backend_args, job.project) for job in jobs],
+                             [(["https://example.com/a.git"], "A"), (["https://example.com/b.git"], "A")])
+        self.assertEqual(jobs[0].index, 'git_raw')
+
+    def test_run(self):
+        """Test the jobs are run within the limits of workers and hosts"""
+
+        jobs = [FeedJob('git', ['https://%s.com/%i.git' % (host, i)]) for host in ['a', 'b', 'c'] for i in range(4)]
+        jobs.append(FeedJob('git', ['https://a.com/fail.git']))
+        jobs.append(FeedJob('git', ['https://b.com/error.git']))
+
+        lock = threading.Lock()
+        running = collections.Counter()
+        max_running = collections.Counter()
+        done = []
+
+        def run_job(job):
+            with lock:
+                running[job.host] += 1
+                running['all'] += 1
+                for key in running:
+                    max_running[key] = max(max_running[key], running[key])
+            time.sleep(0.01)
+            with lock:
+                running[job.host] -= 1
+                running['all'] -= 1
+            if 'fail' in job.backend_args[0]:
+                raise RuntimeError("Can't fetch")
+            if 'error' in job.backend_args[0]:
+                return False
+            done.append(job)
+
+        failed = BatchScheduler(workers=4, host_workers=2).run(jobs, run_job)
+
+        self.assertEqual(failed, 2)
+        self.assertEqual(len(done), 12)
+        self.assertLessEqual(max_running['all'], 4)
+        for host in ['a.com', 'b.com', 'c.com']:
+            self.assertLessEqual(max_running[host], 2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import sys
+import threading
+import time
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elastic import ElasticSearch, ScrollContext
+from grimoire_elk.elastic_items import ElasticItems
+from grimoire_elk.enriched.utils import prefetch
+
+ES6_URL = 'http://es6.com'
+ES7_URL = 'http://es7.com'
+
+BODY_ES6 = '{"version": {"number": "6.1.0"}, "tagline": "You Know, for Search"}'
+BODY_ES7 = '{"version": {"number": "7.10.0"}, "tagline": "You Know, for Search"}'
+
+# Items in the index: (timestamp, uuid) sorted as ES would do it
+ITEMS = [(1000 + i // 3, "uuid%02d" % i) for i in range(10)]
+
+search_queries = []  # queries of the search requests received
+undated = []  # uuids of the items with no incremental date in the scroll
+
+
+def search_callback(request, uri, headers):
+    """Reply to a search_after query with the next items"""
+
+    query = json.loads(request.body.decode('utf-8'))
+    search_queries.append(query)
+
+    items = ITEMS
+    if 'search_after' in query:
+        after = tuple(query['search_after'][:2])
+        items = [item for item in items if item > after]
+    elif 'query' in query:
+        # Resume filter built from the cursor
+        resume = query['query']['bool']['must'][-1]['bool']['should']
+        after = (resume[0]['range']['metadata__timestamp']['gt'],
+                 resume[1]['bool']['must'][1]['range']['uuid']['gt'])
+        items = [item for item in items if item > after]
+
+    hits = []
+    for pos, item in enumerate(items[:query['size']]):
+        sort = list(item)
+        if 'pit' in query:
+            sort.append(pos)
+        hits.append({"_source": {"uuid": item[1]}, "sort": sort})
+
+    body = {"hits": {"total": len(ITEMS), "hits": hits}}
+    if 'pit' in query:
+        body['pit_id'] = query['pit']['id']
+
+    return 200, headers, json.dumps(body)
+
+
+def scroll_callback(request, uri, headers):
+    """Reply to the pages of a sliced scroll, returning one item per page"""
+
+    query = json.loads(request.body.decode('utf-8'))
+
+    if 'scroll_id' in query:
+        slice_id, nslices, pos = [int(value) for value in query['scroll_id'].split('-')]
+    elif 'scroll' in request.querystring:
+        _slice = query.get('slice', {"id": 0, "max": 1})
+        slice_id, nslices, pos = _slice['id'], _slice['max'], 0
+    else:
+        return search_callback(request, uri, headers)
+
+    search_queries.append(query)
+
+    # Items are spread in the slices by their position in the index
+    items = [item for pos, item in enumerate(ITEMS) if pos % nslices == slice_id]
+    hits = [{"_source": {"uuid": item[1]}, "sort": [None if item[1] in undated else item[0]]}
+            for item in items[pos:pos + 1]]
+
+    body = {"_scroll_id": "%i-%i-%i" % (slice_id, nslices, pos + 1),
+            "hits": {"total": len(items), "hits": hits}}
+
+    return 200, headers, json.dumps(body)
+
+
+class MockedElasticItems(ElasticItems):
+    """ElasticItems not linked to any connector"""
+
+    def get_repository_filter_raw(self, term=False):
+        return {}
+
+
+class MockedSlicedElasticItems(MockedElasticItems):
+    """MockedElasticItems serializing the requests of the slices,
+    httpretty is not thread safe"""
+
+    lock = threading.Lock()
+
+    def get_elastic_items(self, elastic_scroll_id=None, _filter=None, _slice=None, _source=None):
+        with self.lock:
+            return super().get_elastic_items(elastic_scroll_id, _filter=_filter, _slice=_slice,
+                                             _source=_source)
+
+
+class TestElasticItems(unittest.TestCase):
+    """Unit tests for ElasticItems class"""
+
+    def setUp(self):
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, ES6_URL, body=BODY_ES6)
+        httpretty.register_uri(httpretty.GET, ES6_URL + '/test', body='{}')
+        httpretty.register_uri(httpretty.POST, ES6_URL + '/test/_search', body=scroll_callback)
+        httpretty.register_uri(httpretty.POST, ES6_URL + '/_search/scroll', body=scroll_callback)
+        httpretty.register_uri(httpretty.DELETE, ES6_URL + '/_search/scroll', body='{"succeeded": true}')
+        httpretty.register_uri(httpretty.GET, ES7_URL, body=BODY_ES7)
+        httpretty.register_uri(httpretty.GET, ES7_URL + '/test', body='{}')
+        httpretty.register_uri(httpretty.POST, ES7_URL + '/test/_pit', body='{"id": "pit-1"}')
+        httpretty.register_uri(httpretty.DELETE, ES7_URL + '/_pit', body='{"succeeded": true}')
+        httpretty.register_uri(httpretty.POST, ES7_URL + '/_search', body=search_callback)
+
+        del search_queries[:]
+        del undated[:]
+
+    def tearDown(self):
+        httpretty.disable()
+
+    def __get_elastic_items(self, url):
+        eitems = MockedElasticItems(None)
+        eitems.elastic = ElasticSearch(url, 'test')
+        eitems.scroll_size = 4
+        eitems.use_search_after = True
+        return eitems
+
+    def test_fetch_search_after(self):
+        """Test fetching items with search_after"""
+
+        eitems = self.__get_elastic_items(ES6_URL)
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS])
+        self.assertListEqual(eitems.cursor, [1003, 'uuid09'])
+        self.assertEqual(len(search_queries), 4)
+        self.assertNotIn('pit', search_queries[0])
+        self.assertNotIn('_source', search_queries[0])
+
+    def test_fetch_source(self):
+        """Test fetching only some fields of the items"""
+
+        eitems = self.__get_elastic_items(ES6_URL)
+
+        uuids = [item['uuid'] for item in eitems.fetch(_source=['uuid', 'author_id'])]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS])
+        for query in search_queries:
+            self.assertListEqual(query['_source'], ['uuid', 'author_id'])
+
+    def test_fetch_search_after_pit(self):
+        """Test fetching items with search_after in a point in time"""
+
+        eitems = self.__get_elastic_items(ES7_URL)
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS])
+        self.assertDictEqual(search_queries[0]['pit'], {"id": "pit-1", "keep_alive": "10m"})
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+
+    def test_fetch_search_after_cursor(self):
+        """Test resuming the fetching from a cursor"""
+
+        eitems = self.__get_elastic_items(ES6_URL)
+
+        items = eitems.fetch()
+        for _ in range(5):
+            next(items)
+        items.close()
+        cursor = eitems.cursor
+        self.assertListEqual(cursor, [1001, 'uuid04'])
+
+        eitems = self.__get_elastic_items(ES6_URL)
+        eitems.set_cursor(cursor)
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS[5:]])
+
+    def test_fetch_search_after_twice(self):
+        """Test every fetching reads the items from the start or from the cursor set"""
+
+        eitems = self.__get_elastic_items(ES6_URL)
+
+        for _ in range(2):
+            uuids = [item['uuid'] for item in eitems.fetch()]
+            self.assertListEqual(uuids, [item[1] for item in ITEMS])
+            self.assertListEqual(eitems.cursor, [1003, 'uuid09'])
+
+        eitems.set_cursor([1001, 'uuid04'])
+        for _ in range(2):
+            uuids = [item['uuid'] for item in eitems.fetch()]
+            self.assertListEqual(uuids, [item[1] for item in ITEMS[5:]])
+
+    def test_fetch_sliced_undated(self):
+        """Test the items with no incremental date are merged after the others"""
+
+        eitems = MockedSlicedElasticItems(None)
+        eitems.elastic = ElasticSearch(ES6_URL, 'test')
+        eitems.perceval_backend = True
+        eitems.scroll_slices = 3
+        # The last items of the slices 0 and 2, as ElasticSearch sorts them
+        undated.extend(['uuid06', 'uuid08', 'uuid09'])
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(sorted(uuids[-3:]), undated)
+        dates = [int(uuid[4:]) // 3 for uuid in uuids[:-3]]
+        self.assertListEqual(dates, sorted(dates))
+
+    def test_filter_fields(self):
+        """Test filtering the items with some values in any of several fields"""
+
+        eitems = self.__get_elastic_items(ES6_URL)
+
+        _filter = {"name": ["author_uuid", "committer_uuid"], "value": ["uuid01", "uuid02"]}
+        filters = json.loads("[" + eitems.get_elastic_filters(_filter) + "]")
+
+        should = {"bool": {"should": [{"terms": {"author_uuid": ["uuid01", "uuid02"]}},
+                                      {"terms": {"committer_uuid": ["uuid01", "uuid02"]}}],
+                           "minimum_should_match": 1}}
+        self.assertListEqual(filters, [should])
+
+    def test_fetch_sliced(self):
+        """Test fetching items reading the slices of the scroll in parallel"""
+
+        eitems = MockedSlicedElasticItems(None)
+        eitems.elastic = ElasticSearch(ES6_URL, 'test')
+        eitems.perceval_backend = True
+        eitems.scroll_slices = 3
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(sorted(uuids), [item[1] for item in ITEMS])
+
+        # Items are merged in the order of the incremental date
+        dates = [int(uuid[4:]) // 3 for uuid in uuids]
+        self.assertListEqual(dates, sorted(dates))
+
+        slices = [query['slice'] for query in search_queries if 'slice' in query]
+        self.assertListEqual(sorted(slice['id'] for slice in slices), [0, 1, 2])
+        self.assertTrue(all(slice['max'] == 3 for slice in slices))
+        self.assertTrue(all('sort' in query for query in search_queries if 'slice' in query))
+        self.assertEqual(ScrollContext.get_open_scrolls(), 0)
+
+    def test_fetch_scroll_cleared(self):
+        """Test the scroll is cleared when all the items are read or the reading stops"""
+
+        eitems = MockedElasticItems(None)
+        eitems.elastic = ElasticSearch(ES6_URL, 'test')
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS])
+
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'DELETE')
+        self.assertDictEqual(json.loads(request.body.decode('utf-8')), {"scroll_id": ["0-1-11"]})
+        self.assertEqual(ScrollContext.get_open_scrolls(), 0)
+
+        items = eitems.fetch()
+        next(items)
+        self.assertEqual(ScrollContext.get_open_scrolls(), 1)
+        items.close()
+
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'DELETE')
+        self.assertDictEqual(json.loads(request.body.decode('utf-8')), {"scroll_id": ["0-1-1"]})
+        self.assertEqual(ScrollContext.get_open_scrolls(), 0)
+
+    def test_fetch_prefetch(self):
+        """Test fetching items reading the next pages in advance"""
+
+        eitems = self.__get_elastic_items(ES7_URL)
+        eitems.prefetch_pages = 2
+
+        uuids = [item['uuid'] for item in eitems.fetch()]
+        self.assertListEqual(uuids, [item[1] for item in ITEMS])
+        self.assertListEqual(eitems.cursor, [1003, 'uuid09'])
+        self.__wait_pit_closed()
+
+        # Stopping the reading closes the point in time
+        del search_queries[:]
+        eitems.set_cursor(None)
+        items = eitems.fetch()
+        next(items)
+        items.close()
+        self.__wait_pit_closed()
+        self.assertLess(len(search_queries), 4)
+
+    def __wait_pit_closed(self):
+        """Wait for the background thread reading the pages to close the PIT"""
+
+        for _ in range(50):
+            if httpretty.last_request().method == 'DELETE':
+                break
+            time.sleep(0.1)
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+
+    def test_prefetch(self):
+        """Test values and errors of an iterable read in advance"""
+
+        def numbers():
+            yield from range(10)
+            raise ValueError("end")
+
+        values = prefetch(numbers(), 3)
+        self.assertListEqual([next(values) for _ in range(10)], list(range(10)))
+        with self.assertRaises(ValueError):
+            next(values)
+
+        self.assertListEqual(list(prefetch(range(5), 0)), list(range(5)))
+
+    def test_prefetch_deadline(self):
+        """Test a timeout is raised waiting for values beyond the deadline"""
+
+        stop = threading.Event()
+
+        def stalled():
+            yield 1
+            stop.wait(5)
+            yield 2
+
+        values = prefetch(stalled(), 1, deadline=time.time() + 0.1)
+        self.assertEqual(next(values), 1)
+        with self.assertRaises(TimeoutError):
+            next(values)
+        stop.set()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
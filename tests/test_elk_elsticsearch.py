@@ -21,9 +21,15 @@
 #     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
 #
 
+import json
 import logging
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
+import zlib
 
 import httpretty
 
@@ -31,6 +37,105 @@ if '..' not in sys.path:
     sys.path.insert(0, '..')
 
 from grimoire_elk.elastic import ElasticSearch, ElasticConnectException
+from grimoire_elk.enriched import utils
+
+bulk_requests = []  # bodies of the bulk requests received
+es_requests = []  # method, path and body of the other requests recorded
+
+
+def record_callback(body):
+    """Callback replying with body and recording the requests in es_requests"""
+
+    def callback(request, uri, headers):
+        es_requests.append((request.method, request.path, request.body))
+        return 200, headers, body
+
+    return callback
+
+
+def bulk_callback(request, uri, headers):
+    """Reply to a bulk request with all its documents inserted"""
+
+    body = request.body
+    if request.headers.get('Content-Encoding', None) == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    bulk_requests.append(body)
+    lines = body.decode('utf-8').splitlines()
+    items = []
+    for line in lines[0::2]:
+        action, meta = list(json.loads(line).items())[0]
+        items.append({action: {"_id": meta['_id'], "status": 201}})
+    body = {"took": 1, "errors": False, "items": items}
+
+    return 200, headers, json.dumps(body)
+
+
+class ConcurrentElasticSearch(ElasticSearch):
+    """ElasticSearch with bulk requests which wait for each other, so
+    several are in flight at the same time. They are not sent to the
+    mocked server, httpretty is not thread safe"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.overlap = threading.Event()
+        self.lock = threading.Lock()
+
+    def safe_put_bulk(self, url, bulk_json):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.in_flight > 1:
+                self.overlap.set()
+
+        self.overlap.wait(5)
+
+        with self.lock:
+            self.in_flight -= 1
+
+        return len(bytes(bulk_json).splitlines()) // 2
+
+
+def bulk_errors_callback(request, uri, headers):
+    """Reply to a bulk request rejecting odd ids and failing id 4 mapping"""
+
+    bulk_requests.append(request.body)
+    lines = request.body.decode('utf-8').splitlines()
+    items = []
+    for line in lines[0::2]:
+        _id = json.loads(line)['index']['_id']
+        if _id == '4':
+            error = {"type": "mapper_parsing_exception", "reason": "failed to parse"}
+            items.append({"index": {"_id": _id, "status": 400, "error": error}})
+        elif int(_id) % 2 and len(bulk_requests) == 1:
+            error = {"type": "es_rejected_execution_exception", "reason": "rejected"}
+            items.append({"index": {"_id": _id, "status": 429, "error": error}})
+        else:
+            items.append({"index": {"_id": _id, "status": 201}})
+    body = {"took": 1, "errors": True, "items": items}
+
+    return 200, headers, json.dumps(body)
+
+
+def bulk_actions_callback(request, uri, headers):
+    """Reply to a bulk request with index and delete actions failing id 3"""
+
+    bulk_requests.append(request.body)
+    lines = iter(request.body.decode('utf-8').splitlines())
+    items = []
+    for line in lines:
+        op, action = list(json.loads(line).items())[0]
+        if op != 'delete':
+            next(lines)
+        if action['_id'] == '3':
+            error = {"type": "mapper_parsing_exception", "reason": "failed to parse"}
+            items.append({op: {"_id": action['_id'], "status": 400, "error": error}})
+        else:
+            items.append({op: {"_id": action['_id'], "status": 200}})
+    body = {"took": 1, "errors": True, "items": items}
+
+    return 200, headers, json.dumps(body)
 
 
 class TestElasticSearch(unittest.TestCase):
@@ -73,20 +178,39 @@ class TestElasticSearch(unittest.TestCase):
         self.url_es6 = 'http://es6.com'
         self.url_es6_err = 'http://es6_err.com'
 
+        del es_requests[:]
+
         httpretty.enable()
         httpretty.register_uri(httpretty.GET, self.url_es5,
                                body=self.body_es5)
         httpretty.register_uri(httpretty.GET, self.url_es5_err,
                                status=status_err)
         httpretty.register_uri(httpretty.GET, self.url_es6,
-                               body=self.body_es6)
+                               body=record_callback(self.body_es6))
         httpretty.register_uri(httpretty.GET, self.url_es6_err,
                                status=status_err)
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test',
+                               body=record_callback('{}'))
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test/items/_bulk',
+                               body=bulk_callback)
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test/_settings',
+                               body=record_callback('{"test": {"settings": {"index": {"refresh_interval": "5s"}}}}'))
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test/_settings',
+                               body=record_callback('{"acknowledged": true}'))
+        httpretty.register_uri(httpretty.POST, self.url_es6 + '/test/_refresh',
+                               body='{}')
 
     def tearDown(self):
 
         httpretty.disable()
 
+    @staticmethod
+    def settings_requests(method):
+        """Bodies of the requests to the settings of the test index"""
+
+        return [body for req_method, path, body in es_requests
+                if req_method == method and path == '/test/_settings']
+
     def test_check_instance(self):
         """Test _check_instance function"""
 
@@ -98,6 +222,351 @@ class TestElasticSearch(unittest.TestCase):
         with self.assertRaises(ElasticConnectException):
             major = ElasticSearch._check_instance(self.url_es6_err, False)
 
+    def test_bulk_upload(self):
+        """Test bulk_upload sends packs bounded by items and bytes"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        elastic.max_items_bulk = 3
+        items = [{"uuid": str(i), "data": "x" * 100} for i in range(10)]
+
+        del bulk_requests[:]
+        inserted = elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(inserted, 10)
+        self.assertEqual(len(bulk_requests), 4)
+
+        # A pack is sent before going beyond the bytes budget
+        elastic.max_bytes_bulk = 400
+        writer = elastic.get_bulk_writer()
+        for item in items:
+            writer.add(item, item['uuid'])
+        self.assertEqual(writer.total, 8)
+        self.assertEqual(writer.close(), 10)
+        self.assertEqual(len(bulk_requests), 4 + 5)
+        for body in bulk_requests[4:]:
+            self.assertLessEqual(len(body), 400)
+
+    def test_bulk_upload_update(self):
+        """Test bulk_upload sending partial updates of the documents"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        items = [{"uuid": str(i), "author_name": "John"} for i in range(3)]
+
+        del bulk_requests[:]
+        inserted = elastic.bulk_upload(items, 'uuid', update=True)
+        self.assertEqual(inserted, 3)
+
+        lines = bulk_requests[0].decode('utf-8').splitlines()
+        self.assertDictEqual(json.loads(lines[0]), {"update": {"_id": "0"}})
+        self.assertDictEqual(json.loads(lines[1]), {"doc": {"uuid": "0", "author_name": "John"}})
+
+    def test_bulk_upload_concurrent(self):
+        """Test bulk_upload with several bulk requests in flight"""
+
+        threads = threading.active_count()
+        elastic = ConcurrentElasticSearch(self.url_es6, 'test')
+        elastic.max_items_bulk = 3
+        elastic.bulk_workers = 3
+        items = [{"uuid": str(i)} for i in range(100)]
+
+        inserted = elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(inserted, 100)
+        self.assertGreater(elastic.max_in_flight, 1)
+        self.assertLessEqual(elastic.max_in_flight, 3)
+
+        # The threads are stopped once the packs are uploaded
+        self.assertIsNone(elastic.bulk_pool)
+        self.assertEqual(threading.active_count(), threads)
+
+        self.assertEqual(elastic.bulk_upload(items, 'uuid'), 100)
+        self.assertIsNone(elastic.bulk_pool)
+
+    def test_indexing_session(self):
+        """Test bulk requests do not force refresh in indexing sessions"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        items = [{"uuid": str(i)} for i in range(5)]
+
+        with elastic.indexing_session():
+            with elastic.indexing_session():
+                elastic.bulk_upload(items, 'uuid')
+                request = httpretty.last_request()
+                self.assertEqual(request.querystring, {})
+            self.assertFalse(elastic.bulk_refresh)
+
+        self.assertTrue(elastic.bulk_refresh)
+        self.assertEqual(httpretty.last_request().path, '/test/_refresh')
+
+        settings = [json.loads(body.decode('utf-8')) for body in self.settings_requests('PUT')]
+        self.assertEqual(settings[0], {"index": {"refresh_interval": "-1"}})
+        self.assertEqual(settings[-1], {"index": {"refresh_interval": "5s"}})
+
+        elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(httpretty.last_request().querystring, {'refresh': ['true']})
+
+    def test_indexing_session_shared(self):
+        """Test the refresh interval is restored after the sessions of all the objects"""
+
+        elastic1 = ElasticSearch(self.url_es6, 'test')
+        elastic2 = ElasticSearch(self.url_es6, 'test')
+
+        elastic1.start_indexing_session()
+        elastic2.start_indexing_session()
+        self.assertFalse(elastic2.bulk_refresh)
+        self.assertEqual(len(self.settings_requests('GET')), 1)
+        self.assertDictEqual(ElasticSearch.index_sessions,
+                             {elastic1.index_url: {'count': 2, 'refresh_interval': '5s'}})
+
+        elastic1.end_indexing_session()
+        self.assertTrue(elastic1.bulk_refresh)
+        self.assertEqual(json.loads(self.settings_requests('PUT')[-1].decode('utf-8')),
+                         {"index": {"refresh_interval": "-1"}})
+        self.assertEqual(httpretty.last_request().path, '/test/_refresh')
+
+        elastic2.end_indexing_session()
+        self.assertEqual(json.loads(self.settings_requests('PUT')[-1].decode('utf-8')),
+                         {"index": {"refresh_interval": "5s"}})
+        self.assertDictEqual(ElasticSearch.index_sessions, {})
+
+    def test_bulk_failed_items(self):
+        """Test rejected items are retried and failed ones go to dead letters"""
+
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test_errors',
+                               body='{}')
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test_errors/items/_bulk',
+                               body=bulk_errors_callback)
+
+        tmp_path = tempfile.mkdtemp(prefix='gelk_')
+        elastic = ElasticSearch(self.url_es6, 'test_errors')
+        elastic.bulk_retry_backoff = 0
+        elastic.dead_letter_path = tmp_path
+        items = [{"uuid": str(i)} for i in range(8)]
+
+        del bulk_requests[:]
+        inserted = elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(inserted, 7)
+        self.assertEqual(len(bulk_requests), 2)
+        self.assertEqual(len(bulk_requests[1].splitlines()), 8)
+
+        with open(os.path.join(tmp_path, 'test_errors.ndjson')) as fd:
+            lines = [json.loads(line) for line in fd.read().splitlines()]
+        self.assertEqual(lines, [{"index": {"_id": "4"}}, {"uuid": "4"}])
+
+        shutil.rmtree(tmp_path)
+
+    def test_bulk_failed_delete_items(self):
+        """Test the failed items are found in bulks with delete actions and replayed"""
+
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test_actions',
+                               body='{}')
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test_actions/items/_bulk',
+                               body=bulk_actions_callback)
+
+        tmp_path = tempfile.mkdtemp(prefix='gelk_')
+        elastic = ElasticSearch(self.url_es6, 'test_actions')
+        elastic.dead_letter_path = tmp_path
+        bulk_json = '{"delete": {"_id": "1"}}\n' \
+                    '{"index": {"_id": "2"}}\n{"uuid": "2"}\n' \
+                    '{"delete": {"_id": "0"}}\n' \
+                    '{"index": {"_id": "3"}}\n{"uuid": "3"}\n'
+
+        del bulk_requests[:]
+        inserted = elastic.safe_put_bulk(elastic.index_url + '/items/_bulk', bulk_json)
+        self.assertEqual(inserted, 3)
+
+        dead_letter_file = os.path.join(tmp_path, 'test_actions.ndjson')
+        with open(dead_letter_file) as fd:
+            lines = [json.loads(line) for line in fd.read().splitlines()]
+        self.assertEqual(lines, [{"index": {"_id": "3"}}, {"uuid": "3"}])
+
+        # The items failing again are kept in the dead letter file
+        with open(dead_letter_file, 'a') as fd:
+            fd.write('{"delete": {"_id": "4"}}\n')
+        self.assertEqual(elastic.replay_dead_letters(), 1)
+        self.assertEqual(bulk_requests[-1].decode('utf-8'),
+                         '{"index": {"_id": "3"}}\n{"uuid": "3"}\n{"delete": {"_id": "4"}}\n')
+        with open(dead_letter_file) as fd:
+            self.assertEqual(fd.read(), '{"index": {"_id": "3"}}\n{"uuid": "3"}\n')
+
+        # A single error is logged for all the failed items of a bulk
+        bulk_json = '{"delete": {"_id": "3"}}\n' \
+                    '{"index": {"_id": "3"}}\n{"uuid": "3"}\n' \
+                    '{"update": {"_id": "3"}}\n{"doc": {"uuid": "3"}}\n'
+        with self.assertLogs('grimoire_elk.elastic', level='ERROR') as logs:
+            self.assertEqual(elastic.safe_put_bulk(elastic.index_url + '/items/_bulk', bulk_json), 0)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Failed to insert 3 items", logs.output[0])
+        self.assertIn("mapper_parsing_exception", logs.output[0])
+
+        shutil.rmtree(tmp_path)
+
+    def test_bulk_upload_adaptive(self):
+        """Test the bulk size grows with fast requests and shrinks with rejections"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        elastic.adaptive_bulk = True
+        elastic.max_items_bulk = 10
+        elastic.bulk_size = 10
+        items = [{"uuid": str(i)} for i in range(100)]
+
+        del bulk_requests[:]
+        inserted = elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(inserted, 100)
+        self.assertLess(len(bulk_requests), 10)
+        self.assertGreater(elastic.get_bulk_size(), 10)
+
+        # The size is bounded by the bytes budget
+        elastic.max_bytes_bulk = 1000
+        elastic.bulk_upload(items, 'uuid')
+        last_bulk = bulk_requests[-1]
+        item_bytes = len(last_bulk) / (len(last_bulk.splitlines()) // 2)
+        self.assertLessEqual(elastic.get_bulk_size(), 1000 / item_bytes)
+
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test_errors',
+                               body='{}')
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test_errors/items/_bulk',
+                               body=bulk_errors_callback)
+
+        elastic = ElasticSearch(self.url_es6, 'test_errors')
+        elastic.adaptive_bulk = True
+        elastic.bulk_retry_backoff = 0
+        elastic.bulk_size = 40
+
+        del bulk_requests[:]
+        elastic.bulk_upload(items[:8], 'uuid')
+        self.assertEqual(elastic.get_bulk_size(), 20)
+
+    def test_bulk_upload_json_backends(self):
+        """Test the documents sent are the same with all the JSON libraries"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        items = [{"uuid": "1", "name": "Jos\u00e9", 2: None},
+                 {"uuid": "2", "big": 2 ** 70, "text": "\udc80"}]
+
+        docs = {}
+        for backend in [name for name in utils.JSON_BACKENDS if utils.JSON_BACKENDS[name]]:
+            utils.set_json_backend(backend)
+            del bulk_requests[:]
+            self.assertEqual(elastic.bulk_upload(items, 'uuid'), 2)
+            docs[backend] = [json.loads(line) for line in bulk_requests[0].decode('utf-8').splitlines()]
+        utils.set_json_backend()
+
+        self.assertEqual(docs['json'][0], {"index": {"_id": "1"}})
+        self.assertEqual(docs['json'][3]['big'], 2 ** 70)
+        for backend in docs:
+            self.assertEqual(docs[backend], docs['json'])
+
+        with self.assertRaises(ValueError):
+            utils.set_json_backend('simplejson')
+
+    def test_bulk_upload_gzip(self):
+        """Test bulk requests are compressed with gzip"""
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        elastic.requests.gzip_requests = True
+        items = [{"uuid": str(i), "data": "x" * 100} for i in range(50)]
+
+        del bulk_requests[:]
+        inserted = elastic.bulk_upload(items, 'uuid')
+        self.assertEqual(inserted, 50)
+
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(request.body), len(bulk_requests[0]) / 4)
+
+    def test_update_by_query(self):
+        """Test items are updated with a painless script"""
+
+        httpretty.register_uri(httpretty.POST, self.url_es6 + '/test/_update_by_query',
+                               body='{"updated": 3, "version_conflicts": 1, "failures": []}')
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        query = {"terms": {"author_uuid": ["aaaa"]}}
+        updated = elastic.update_by_query(query, "ctx._source.author_name = params.name", {"name": "Pepe"})
+        self.assertEqual(updated, 3)
+
+        request = httpretty.last_request()
+        self.assertDictEqual(request.querystring, {"conflicts": ["proceed"], "refresh": ["true"]})
+        body = json.loads(request.body.decode('utf-8'))
+        self.assertDictEqual(body['query'], query)
+        self.assertDictEqual(body['script'], {"source": "ctx._source.author_name = params.name",
+                                              "lang": "painless", "params": {"name": "Pepe"}})
+
+    def test_metadata(self):
+        """Test the metadata of the index is read and updated"""
+
+        mapping = {"test_v1": {"mappings": {"items": {"_meta": {"version": 1},
+                                                      "properties": {}}}}}
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/test/_mapping',
+                               body=json.dumps(mapping))
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/test/items/_mapping',
+                               body='{"acknowledged": true}')
+
+        elastic = ElasticSearch(self.url_es6, 'test')
+        self.assertDictEqual(elastic.get_metadata(), {"version": 1})
+
+        elastic.set_metadata({"checkpoint": "2019-01-01T00:00:00"})
+        request = httpretty.last_request()
+        self.assertEqual(request.method, 'PUT')
+        self.assertDictEqual(json.loads(request.body.decode('utf-8')),
+                             {"_meta": {"version": 1, "checkpoint": "2019-01-01T00:00:00"}})
+
+    def test_shared_connections(self):
+        """Test the ES instance and the index are checked once when connections are shared"""
+
+        class SharedElasticSearch(ElasticSearch):
+            shared_connections = True
+            shared_sessions = {}
+            shared_majors = {}
+            shared_indexes = set()
+
+        elastic = SharedElasticSearch(self.url_es6, 'test')
+        nrequests = len(es_requests)
+        elastic2 = SharedElasticSearch(self.url_es6, 'test')
+
+        self.assertEqual(len(es_requests), nrequests)
+        self.assertEqual(elastic2.major, '6')
+        self.assertIs(elastic2.requests, elastic.requests)
+
+        # Not shared by default
+        elastic = ElasticSearch(self.url_es6, 'test')
+        self.assertIsNot(elastic.requests, elastic2.requests)
+        self.assertEqual(len(es_requests), nrequests + 2)
+
+    def test_shared_connections_clean(self):
+        """Test a shared index is cleaned once, keeping the items of all the objects"""
+
+        class SharedElasticSearch(ElasticSearch):
+            shared_connections = True
+            shared_sessions = {}
+            shared_majors = {}
+            shared_indexes = set()
+
+        docs = set()
+        deletes = []
+
+        def delete_callback(request, uri, headers):
+            deletes.append(request.path)
+            docs.clear()
+            return 200, headers, '{"acknowledged": true}'
+
+        def store_callback(request, uri, headers):
+            lines = request.body.decode('utf-8').splitlines()
+            docs.update(json.loads(line)['index']['_id'] for line in lines[0::2])
+            return bulk_callback(request, uri, headers)
+
+        httpretty.register_uri(httpretty.GET, self.url_es6 + '/shared', body='{}')
+        httpretty.register_uri(httpretty.DELETE, self.url_es6 + '/shared', body=delete_callback)
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/shared', body='{"acknowledged": true}')
+        httpretty.register_uri(httpretty.PUT, self.url_es6 + '/shared/items/_bulk', body=store_callback)
+
+        for job in ['a', 'b']:
+            elastic = SharedElasticSearch(self.url_es6, 'shared', clean=True)
+            items = [{"id": job + str(i)} for i in range(3)]
+            self.assertEqual(elastic.bulk_upload(items, 'id'), 3)
+
+        self.assertSetEqual(docs, {'a0', 'a1', 'a2', 'b0', 'b1', 'b2'})
+        self.assertListEqual(deletes, ['/shared'])
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
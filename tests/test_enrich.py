@@ -22,15 +22,19 @@
 #
 
 import configparser
+import os
 import requests
 import sys
+import threading
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from grimoire_elk.enriched.enrich import (Enrich,
                                           DEMOGRAPHICS_ALIAS,
                                           HEADER_JSON,
                                           logger)
+from grimoire_elk.enriched.sortinghat_gelk import SortingHat
+from sortinghat import utils as sh_utils
 from sortinghat.db.model import UniqueIdentity, Profile
 from grimoire_elk.utils import get_connectors, get_elastic
 
@@ -40,6 +44,32 @@ sys.path.insert(0, '..')
 CONFIG_FILE = 'tests.conf'
 
 
+class ProcessEnrich(Enrich):
+    """Enricher adding the process which enriched each item"""
+
+    def get_rich_item(self, item):
+        return {"uuid": item["uuid"], "pid": os.getpid()}
+
+    def get_rich_events(self, item):
+        for event in range(2):
+            yield {"uuid": item["uuid"], "event": event}
+
+
+class IdentityEnrich(Enrich):
+    """Enricher with the author and the committer of the items as identities"""
+
+    roles = ['author', 'committer']
+
+    def get_field_author(self):
+        return 'author'
+
+    def get_connector_name(self):
+        return 'test'
+
+    def get_sh_identity(self, item, identity_field=None):
+        return {'name': item['data'][identity_field], 'email': None, 'username': None}
+
+
 class TestEnrich(unittest.TestCase):
 
     def setUp(self):
@@ -57,6 +87,155 @@ class TestEnrich(unittest.TestCase):
             "author_bot": False
         }
 
+    def test_map_raw_items(self):
+        """Test raw items are enriched in this process by default"""
+
+        enrich = ProcessEnrich()
+        items = [{"uuid": str(i)} for i in range(5)]
+
+        results = list(enrich.map_raw_items('get_rich_item', items))
+        self.assertListEqual([item for item, _ in results], items)
+        self.assertListEqual([rich_item['uuid'] for _, rich_item in results], [item['uuid'] for item in items])
+        self.assertTrue(all(rich_item['pid'] == os.getpid() for _, rich_item in results))
+
+    def test_map_raw_items_workers(self):
+        """Test raw items are enriched in worker processes keeping their order"""
+
+        enrich = ProcessEnrich()
+        enrich.enrich_workers = 3
+        enrich.enrich_chunk_size = 2
+        items = [{"uuid": str(i)} for i in range(11)]
+
+        results = list(enrich.map_raw_items('get_rich_item', iter(items)))
+        self.assertListEqual([item for item, _ in results], items)
+        self.assertListEqual([rich_item['uuid'] for _, rich_item in results], [item['uuid'] for item in items])
+        self.assertTrue(all(rich_item['pid'] != os.getpid() for _, rich_item in results))
+
+        # Generators are returned as lists by the workers
+        results = list(enrich.map_raw_items('get_rich_events', items[:2]))
+        self.assertListEqual(results[1][1], [{"uuid": "1", "event": 0}, {"uuid": "1", "event": 1}])
+
+    def test_map_raw_items_threads(self):
+        """Test raw items are enriched in this process when other threads are running"""
+
+        enrich = ProcessEnrich()
+        enrich.enrich_workers = 3
+        items = [{"uuid": str(i)} for i in range(5)]
+
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            results = list(enrich.map_raw_items('get_rich_item', iter(items)))
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertListEqual([item for item, _ in results], items)
+        self.assertTrue(all(rich_item['pid'] == os.getpid() for _, rich_item in results))
+
+    def test_resolve_sh_identities(self):
+        """Test the SortingHat data of the identities of the items is resolved in batch"""
+
+        enrich = IdentityEnrich()
+        enrich.sortinghat = True
+        items = [{"data": {"author": "pepe", "committer": "juan"}},
+                 {"data": {"author": "juan"}}]
+
+        pepe_id = sh_utils.uuid('test', name='pepe')
+        juan_id = sh_utils.uuid('test', name='juan')
+        uidentity = UniqueIdentity(uuid='aaaaa')
+        batch = ({pepe_id: 'aaaaa'}, {'aaaaa': uidentity}, {'aaaaa': []})
+
+        with patch.object(SortingHat, 'get_identities_batch', return_value=batch) as get_batch:
+            enrich.resolve_sh_identities(items)
+            self.assertEqual(sorted(get_batch.call_args[0][1]), sorted([pepe_id, juan_id]))
+
+        # Identities resolved don't need any query
+        identity = enrich.get_sh_identity(items[0], 'author')
+        self.assertDictEqual(enrich.get_sh_ids(identity, 'test'), {"id": pepe_id, "uuid": 'aaaaa'})
+        self.assertEqual(enrich.get_unique_identity('aaaaa'), uidentity)
+        self.assertEqual(enrich.get_enrollments('aaaaa'), [])
+        self.assertEqual(enrich.get_uuid_from_id(pepe_id), 'aaaaa')
+
+        # Identities not found are looked up one by one
+        self.assertNotIn(((('name', 'juan'), ('email', None), ('username', None)), 'test'),
+                         enrich.sh_batch_ids)
+
+    def test_resolve_sh_identities_empty(self):
+        """Test the identities with no name, email and username are skipped"""
+
+        enrich = IdentityEnrich()
+        enrich.sortinghat = True
+        items = [{"data": {"author": "pepe", "committer": ""}},
+                 {"data": {"author": None}}]
+
+        pepe_id = sh_utils.uuid('test', name='pepe')
+        batch = ({pepe_id: 'aaaaa'}, {'aaaaa': UniqueIdentity(uuid='aaaaa')}, {'aaaaa': []})
+
+        with patch.object(SortingHat, 'get_identities_batch', return_value=batch) as get_batch:
+            enrich.resolve_sh_identities(items)
+            self.assertListEqual(list(get_batch.call_args[0][1]), [pepe_id])
+
+        identity = enrich.get_sh_identity(items[0], 'committer')
+        self.assertDictEqual(enrich.get_sh_ids(identity, 'test'), {"id": None, "uuid": None})
+
+    def test_get_uuids_sh_fields(self):
+        """Test the SH fields of some unique identities are read from SortingHat"""
+
+        enrich = IdentityEnrich()
+        enrich.sortinghat = True
+
+        uidentity = UniqueIdentity(uuid='aaaaa')
+        uidentity.profile = Profile(name='Pepe', email='pepe@example.com', gender=None, is_bot=True)
+        batch = ({'pepe-id': 'aaaaa'}, {'aaaaa': uidentity, 'bbbbb': UniqueIdentity(uuid='bbbbb')},
+                 {'aaaaa': [], 'bbbbb': []})
+
+        with patch.object(SortingHat, 'get_identities_batch', return_value=batch) as get_batch:
+            id_uuids, uuids_fields, enrollments = enrich.get_uuids_sh_fields(['pepe-id'], ['bbbbb'])
+            get_batch.assert_called_with(enrich.sh_db, ['pepe-id'], extra_uuids=['bbbbb'])
+
+        self.assertDictEqual(id_uuids, {'pepe-id': 'aaaaa'})
+        self.assertDictEqual(uuids_fields['aaaaa'], {"_name": 'Pepe', "_user_name": '',
+                                                     "_domain": 'example.com', "_gender": 'Unknown',
+                                                     "_gender_acc": 0, "_bot": True})
+        self.assertDictEqual(uuids_fields['bbbbb'], {"_name": '', "_user_name": '', "_domain": '',
+                                                     "_gender": 'Unknown', "_gender_acc": 0, "_bot": False})
+        self.assertDictEqual(enrollments, {'aaaaa': [], 'bbbbb': []})
+
+    def test_get_enrich_metadata(self):
+        """Test the metadata of the enriched items is reused within the interval"""
+
+        metadata = self._enrich.get_enrich_metadata()
+        self.assertEqual(metadata['metadata__gelk_backend_name'], 'Enrich')
+        self.assertEqual(metadata['metadata__enrich_run_id'], Enrich.run_id)
+        self.assertIsNotNone(Enrich.run_id)
+        self.assertIs(self._enrich.get_enrich_metadata(), metadata)
+
+        # The date is updated once the interval is over
+        self._enrich.enrich_metadata_time -= self._enrich.enriched_on_interval
+        new_metadata = self._enrich.get_enrich_metadata()
+        self.assertIsNot(new_metadata, metadata)
+        self.assertGreaterEqual(new_metadata['metadata__enriched_on'], metadata['metadata__enriched_on'])
+        self.assertEqual(Enrich().get_enrich_metadata()['metadata__enrich_run_id'], Enrich.run_id)
+
+    def test_find_item_project(self):
+        """Test the project of an origin which is part of a repository is found once"""
+
+        enrich = IdentityEnrich()
+        enrich.prjs_map = {'test': {'https://example.com/a': 'A', 'https://example.com/b.git': 'B'}}
+
+        self.assertEqual(enrich.find_item_project({'origin': 'https://example.com/a'}), 'A')
+        self.assertEqual(enrich.find_item_project({'origin': 'https://example.com/b'}), 'B')
+        self.assertIsNone(enrich.find_item_project({'origin': 'https://example.com/c'}))
+
+        # The repositories are not searched again for the same origin
+        enrich.prjs_map['test'].clear()
+        self.assertEqual(enrich.find_item_project({'origin': 'https://example.com/b'}), 'B')
+
+        enrich.prjs_map = {'test': {'https://example.com/b': 'C'}}
+        self.assertEqual(enrich.find_item_project({'origin': 'https://example.com/b'}), 'C')
+
     def test_get_profile_sh(self):
         """Test whether a profile from sortinghat model is correctly retrieved as a dict"""
 
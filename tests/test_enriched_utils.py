@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import datetime
+import json
+import logging
+import sys
+import unittest
+
+from dateutil import parser, tz
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.enriched import utils
+from grimoire_elk.enriched.utils import get_time_diff_days, json_dumps, parse_date
+
+
+class TestEnrichedUtils(unittest.TestCase):
+    """Unit tests for the utils of the enrichers"""
+
+    def test_parse_date(self):
+        """Test dates are parsed as dateutil does"""
+
+        dates = ['2019-01-01', '2019-01-01T10:20', '2019-01-01T10:20:30', '2019-01-01 10:20:30',
+                 '2019-01-01T10:20:30.123', '2019-01-01T10:20:30.1234567', '2019-01-01T10:20:30+0200',
+                 '2019-01-01T10:20:30-05:30', '2019-01-01T10:20:30.5+01:00',
+                 'Tue, 1 Jan 2019 10:20:30 +0100', 'Tue, 01 Jan 2019 10:20:30 GMT']
+
+        for date in dates:
+            self.assertEqual(parse_date(date), parser.parse(date))
+            self.assertEqual(parse_date(date).utcoffset(), parser.parse(date).utcoffset())
+
+        self.assertEqual(parse_date('2019-01-01T10:20:30Z'),
+                         datetime.datetime(2019, 1, 1, 10, 20, 30, tzinfo=tz.tzutc()))
+        self.assertEqual(parse_date('2019-01-01T10:20:30+00:00').isoformat(), '2019-01-01T10:20:30+00:00')
+
+        date = datetime.datetime(2019, 1, 1)
+        self.assertIs(parse_date(date), date)
+
+        with self.assertRaises(ValueError):
+            parse_date('2019-02-30T00:00:00')
+        with self.assertRaises(ValueError):
+            parse_date('not a date')
+
+    def test_get_time_diff_days(self):
+        """Test the days between two dates"""
+
+        self.assertEqual(get_time_diff_days('2019-01-01T00:00:00', '2019-01-02T12:00:00+00:00'), 1.5)
+        self.assertEqual(get_time_diff_days(datetime.datetime(2019, 1, 1), '2019-01-01T06:00:00'), 0.25)
+        self.assertIsNone(get_time_diff_days(None, '2019-01-01'))
+
+    def test_json_dumps(self):
+        """Test dates and floats are encoded the same with all the JSON libraries"""
+
+        item = {"date": datetime.datetime(2019, 1, 1, 10, 20, 30, 123),
+                "date_tz": datetime.datetime(2019, 1, 1, 10, 20, 30, tzinfo=tz.tzutc()),
+                "date_offset": parse_date('2019-01-01T10:20:30-05:30'),
+                "day": datetime.date(2019, 1, 1),
+                "floats": [0.1, 1e16, 1e-7, -0.0, 123456789.123456789],
+                "invalid": [float('nan'), float('inf'), (float('-inf'),)],
+                "big": 2 ** 70}
+
+        docs = {}
+        for backend in [name for name in utils.JSON_BACKENDS if utils.JSON_BACKENDS[name]]:
+            utils.set_json_backend(backend)
+            docs[backend] = json.loads(json_dumps(item).decode('utf-8'))
+        utils.set_json_backend()
+
+        expected = {"date": "2019-01-01T10:20:30.000123",
+                    "date_tz": "2019-01-01T10:20:30+00:00",
+                    "date_offset": "2019-01-01T10:20:30-05:30",
+                    "day": "2019-01-01",
+                    "floats": [0.1, 1e16, 1e-7, -0.0, 123456789.123456789],
+                    "invalid": [None, None, [None]],
+                    "big": 2 ** 70}
+        for backend in docs:
+            self.assertDictEqual(docs[backend], expected)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.enriched.identities_cache import (EnrollmentsIndex,
+                                                    IdentitiesCache,
+                                                    CachedEnrollment,
+                                                    CachedOrganization,
+                                                    CachedProfile,
+                                                    CachedUniqueIdentity)
+
+
+def sh_data(uuid, org_name='Bitergia'):
+    """SortingHat data of a unique identity with an identity and an enrollment"""
+
+    profile = CachedProfile(uuid.title(), uuid + '@example.com', 'female', 100, False)
+    uidentity = CachedUniqueIdentity(uuid, profile)
+    enrollment = CachedEnrollment(datetime.datetime(1900, 1, 1), datetime.datetime(2100, 1, 1),
+                                  CachedOrganization(org_name))
+
+    return {uuid + '-id': uuid}, {uuid: uidentity}, {uuid: [enrollment]}
+
+
+class TestIdentitiesCache(unittest.TestCase):
+    """Unit tests for IdentitiesCache class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='identities_cache_')
+        self.path = os.path.join(self.tmp_path, 'identities.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_add(self):
+        """Test the data of the identities is stored between runs"""
+
+        cache = IdentitiesCache(self.path)
+        uuids, uidentities, enrollments = sh_data('pepe')
+        cache.add(uuids, uidentities, enrollments)
+
+        cache = IdentitiesCache(self.path)
+        self.assertDictEqual(cache.get_uuids(['pepe-id', 'juan-id']), uuids)
+
+        cached_uidentities, cached_enrollments = cache.get_uidentities(['pepe', 'juan'])
+        self.assertDictEqual(cached_uidentities, uidentities)
+        self.assertDictEqual(cached_enrollments, enrollments)
+        self.assertEqual(cached_uidentities['pepe'].profile.name, 'Pepe')
+        self.assertEqual(cached_enrollments['pepe'][0].organization.name, 'Bitergia')
+
+    def test_add_no_profile(self):
+        """Test unique identities without profile are stored"""
+
+        cache = IdentitiesCache(self.path)
+        uidentity = CachedUniqueIdentity('pepe', None)
+        cache.add({'pepe-id': 'pepe'}, {'pepe': uidentity}, {})
+
+        uidentities, enrollments = cache.get_uidentities(['pepe'])
+        self.assertIsNone(uidentities['pepe'].profile)
+        self.assertListEqual(enrollments['pepe'], [])
+
+    def test_evict(self):
+        """Test the least recently used identities are removed"""
+
+        cache = IdentitiesCache(self.path, max_entries=2)
+        cache.add(*sh_data('pepe'))
+        cache.add(*sh_data('juan'))
+        cache.get_uuids(['pepe-id'])
+        cache.get_uidentities(['pepe'])
+        cache.add(*sh_data('ana'))
+
+        self.assertDictEqual(cache.get_uuids(['pepe-id', 'juan-id', 'ana-id']),
+                             {'pepe-id': 'pepe', 'ana-id': 'ana'})
+        uidentities, _ = cache.get_uidentities(['pepe', 'juan', 'ana'])
+        self.assertListEqual(sorted(uidentities), ['ana', 'pepe'])
+
+    @patch('grimoire_elk.enriched.sortinghat_gelk.SortingHat.get_modified_identities')
+    def test_sync(self, get_modified):
+        """Test the identities modified in SortingHat are removed"""
+
+        date = datetime.datetime(2019, 1, 1)
+
+        # The entries of an unknown date are removed
+        cache = IdentitiesCache(self.path)
+        cache.add(*sh_data('pepe'))
+        get_modified.return_value = ([], [], date)
+        cache.sync(None)
+        self.assertDictEqual(cache.get_uuids(['pepe-id']), {})
+        get_modified.assert_called_with(None, None)
+
+        cache.add(*sh_data('pepe'))
+        cache.add(*sh_data('juan'))
+        cache.add(*sh_data('ana'))
+        get_modified.return_value = (['juan-id'], ['ana'], date + datetime.timedelta(days=1))
+        cache.sync(None)
+        get_modified.assert_called_with(None, date)
+
+        self.assertDictEqual(cache.get_uuids(['pepe-id', 'juan-id', 'ana-id']), {'pepe-id': 'pepe'})
+        uidentities, _ = cache.get_uidentities(['pepe', 'juan', 'ana'])
+        self.assertListEqual(sorted(uidentities), ['juan', 'pepe'])
+
+        cache.sync(None)
+        get_modified.assert_called_with(None, date + datetime.timedelta(days=1))
+
+
+class TestEnrollmentsIndex(unittest.TestCase):
+    """Unit tests for EnrollmentsIndex class"""
+
+    def test_find(self):
+        """Test the organization of the first enrollment including a date is found"""
+
+        def enrollment(start, end, name):
+            return CachedEnrollment(datetime.datetime(start, 1, 1), datetime.datetime(end, 1, 1),
+                                    CachedOrganization(name))
+
+        # Sorted by organization, as SortingHat does, and overlapping
+        enrollments = [enrollment(2004, 2006, 'A'), enrollment(2018, 2020, 'B'),
+                       enrollment(2008, 2015, 'C'), enrollment(2000, 2010, 'D'),
+                       enrollment(2005, 2009, 'E')]
+        index = EnrollmentsIndex(enrollments)
+
+        for year in range(1995, 2025):
+            date = datetime.datetime(year, 1, 1)
+            expected = None
+            for enroll in enrollments:
+                if enroll.start <= date <= enroll.end:
+                    expected = enroll.organization.name
+                    break
+            self.assertEqual(index.find(date), expected)
+
+        self.assertEqual(index.find(datetime.datetime(2005, 1, 1)), 'A')
+        self.assertEqual(index.find(datetime.datetime(2009, 1, 1)), 'C')
+        self.assertEqual(index.find(None), 'A')
+        self.assertIsNone(EnrollmentsIndex([]).find(datetime.datetime(2000, 1, 1)))
+        self.assertIsNone(EnrollmentsIndex([]).find(None))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -34,6 +34,7 @@ if '..' not in sys.path:
 
 from grimoire_elk.utils import get_connectors
 from grimoire_elk.enriched.sortinghat_gelk import SortingHat
+from sortinghat import api
 
 CONFIG_FILE = 'tests.conf'
 DB_SORTINGHAT = "test_sh"
@@ -123,3 +124,67 @@ class TestLoadIdentities(unittest.TestCase):
     def test_load_identities(self):
 
         self._test_load_identities()
+
+    def test_add_identities_bulk(self):
+        """Test identities already in SortingHat are not added again"""
+
+        sh_db = self.enrich_backend.sh_db
+        identities = create_fake_identities()
+        identities[0]['company'] = 'Bulk Company'
+        identities[1]['company'] = 'Bulk Company'
+
+        SortingHat.add_identities(sh_db, identities + identities[:5], 'github')
+        ids = [identity.id for uidentity in api.unique_identities(sh_db) for identity in uidentity.identities]
+        nids = len(ids)
+
+        SortingHat.add_identities(sh_db, identities, 'github')
+        ids = [identity.id for uidentity in api.unique_identities(sh_db) for identity in uidentity.identities]
+        self.assertEqual(len(ids), nids)
+        self.assertEqual(len(set(ids)), nids)
+
+        uuid = SortingHat.add_identity(sh_db, identities[0], 'github')
+        enrollments = api.enrollments(sh_db, uuid)
+        self.assertEqual(len(enrollments), 1)
+        self.assertEqual(enrollments[0].organization.name, 'Bulk Company')
+        self.assertEqual(api.unique_identities(sh_db, uuid)[0].profile.name, identities[0]['name'])
+
+    def test_add_identities_empty(self):
+        """Test identities with no data are skipped and empty profile fields stored as None"""
+
+        sh_db = self.enrich_backend.sh_db
+        username = ''.join(random.choice(string.ascii_lowercase) for _ in range(15))
+        identities = [{'username': '', 'email': '', 'name': ''},
+                      {'username': None, 'email': None, 'name': None},
+                      {'username': username, 'email': '', 'name': ''}]
+
+        SortingHat.add_identities(sh_db, identities, 'github')
+
+        uidentities = [uidentity for uidentity in api.unique_identities(sh_db)
+                       if any(identity.username == username for identity in uidentity.identities)]
+        self.assertEqual(len(uidentities), 1)
+        self.assertEqual(uidentities[0].profile.name, username)
+        self.assertIsNone(uidentities[0].profile.email)
+
+    def test_get_identities_batch_enrollments(self):
+        """Test the enrollments of several identities are sorted as api.enrollments does"""
+
+        sh_db = self.enrich_backend.sh_db
+        identities = create_fake_identities()[:2]
+        uuids = [SortingHat.add_identity(sh_db, identity, 'github') for identity in identities]
+
+        periods = [('Zeta Company', 2000, 2010), ('Alpha Company', 2004, 2006), ('Beta Company', 1990, 2020)]
+        for uuid in uuids:
+            for org, start, end in periods:
+                try:
+                    api.add_organization(sh_db, org)
+                except Exception:
+                    pass
+                api.add_enrollment(sh_db, uuid, org, datetime.datetime(start, 1, 1), datetime.datetime(end, 1, 1))
+
+        _, _, enrollments = SortingHat.get_identities_batch(sh_db, [], uuids)
+        for uuid in uuids:
+            expected = [(enrollment.organization.name, enrollment.start, enrollment.end)
+                        for enrollment in api.enrollments(sh_db, uuid)]
+            batch = [(enrollment.organization.name, enrollment.start, enrollment.end)
+                     for enrollment in enrollments[uuid]]
+            self.assertListEqual(batch, expected)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk import get_identities_filters, refresh_identities_by_query
+
+
+def get_uuids_sh_fields(sh_ids, uuids):
+    """SortingHat data with a unique identity for each uuid and id"""
+
+    id_uuids = {sh_id: 'uuid-' + sh_id for sh_id in sh_ids}
+    uuids_fields = {uuid: {"_name": uuid} for uuid in list(uuids) + list(id_uuids.values())}
+    return id_uuids, uuids_fields, {}
+
+
+class TestRefreshIdentities(unittest.TestCase):
+    """Unit tests for the refresh of the identities modified in SortingHat"""
+
+    def setUp(self):
+        self.enrich_backend = MagicMock()
+        self.enrich_backend.roles = ['author']
+        self.enrich_backend.get_field_author.return_value = 'author'
+        self.enrich_backend.get_field_date.return_value = 'grimoire_creation_date'
+        self.enrich_backend.get_uuids_sh_fields.side_effect = get_uuids_sh_fields
+        self.enrich_backend.elastic.update_by_query.side_effect = lambda query, script, params: len(params['identities'])
+        self.enrich_backend.elastic.max_items_clause = 2
+        self.enrich_backend.get_fields_uuid.return_value = ['author_uuid']
+
+    @patch('grimoire_elk.elk.UPDATE_BY_QUERY_UUIDS', 2)
+    @patch('grimoire_elk.elk.BULK_CHUNK_SIZE', 3)
+    def test_refresh_identities_by_query(self):
+        """Test SortingHat and Elasticsearch are queried in chunks"""
+
+        sh_ids = ['id%i' % i for i in range(4)]
+        uuids = ['uuid-id0', 'uuid1', 'uuid2']
+
+        total = refresh_identities_by_query(self.enrich_backend, sh_ids, uuids)
+
+        calls = [call[0] for call in self.enrich_backend.get_uuids_sh_fields.call_args_list]
+        self.assertListEqual(calls, [(['id0', 'id1', 'id2'], []), (['id3'], []), ([], ['uuid1', 'uuid2'])])
+
+        for call in self.enrich_backend.elastic.update_by_query.call_args_list:
+            self.assertLessEqual(len(call[0][2]['identities']), 2)
+        self.assertEqual(total, 6)
+
+    def test_get_identities_filters(self):
+        """Test the values of the filters are split in chunks"""
+
+        filters = get_identities_filters(self.enrich_backend, ['id0', 'id1', 'id2'], ['uuid0'])
+        self.assertListEqual(filters, [{"name": ['author_uuid'], "value": ['uuid0']},
+                                       {"name": ['author_id'], "value": ['id0', 'id1']},
+                                       {"name": ['author_id'], "value": ['id2']}])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -27,19 +27,32 @@ import logging
 from datetime import datetime
 from os import sys
 
+from grimoire_elk.batch import BatchScheduler, load_jobs
 from grimoire_elk.elk import feed_backend, enrich_backend
 from grimoire_elk.elastic import ElasticSearch
 from grimoire_elk.elastic_items import ElasticItems
+from grimoire_elk.enriched.enrich import Enrich
+from grimoire_elk.raw.elastic import ElasticOcean
+from grimoire_elk.enriched.utils import set_json_backend
+from grimoire_elk.errors import FeedTimeoutError
 from grimoire_elk.utils import get_params, config_logging
 
 
-if __name__ == '__main__':
+def replay_dead_letters(url, index):
+    """ Send again the items failed in previous runs to an index """
 
-    app_init = datetime.now()
+    if not index:
+        return
 
-    args = get_params()
+    inserted = ElasticSearch(url, index).replay_dead_letters()
+    logging.info("%i dead letter items replayed to %s", inserted, index)
 
-    config_logging(args.debug)
+
+def run_backend(args, backend, backend_args, index, index_enrich, project):
+    """ Feed and enrich the data of a backend with the p2o params in args.
+
+    :returns: True if there were no errors
+    """
 
     url = args.elastic_url
 
@@ -47,50 +60,125 @@ if __name__ == '__main__':
     if args.fetch_cache:
         clean = True
 
+    feed_error = None
+    enrich_error = None
+
+    if not args.enrich_only:
+        feed_error = feed_backend(url, clean, args.fetch_cache,
+                                  backend, backend_args,
+                                  index, index_enrich, project,
+                                  args.arthur)
+        logging.info("Backend feed completed")
+
+        if args.bulk_replay_dead_letters:
+            replay_dead_letters(url, index)
+
+        if isinstance(feed_error, FeedTimeoutError):
+            logging.error("Feed of %s %s timed out, not enriched", backend, " ".join(backend_args))
+            return False
+
+    studies_args = None
+    if args.studies_list:
+        # Convert the list to the expected format in enrich_backend method
+        studies_args = []
+
+        for study in args.studies_list:
+            studies_args.append({"name": study,
+                                 "type": study,
+                                 "params": {}
+                                 })
+
+    if args.enrich or args.enrich_only:
+        unaffiliated_group = None
+        enrich_error = enrich_backend(url, clean, backend, backend_args,
+                                      index, index_enrich,
+                                      args.db_projects_map, args.json_projects_map,
+                                      args.db_sortinghat,
+                                      args.no_incremental, args.only_identities,
+                                      args.github_token,
+                                      args.studies, args.only_studies,
+                                      args.elastic_url_enrich, args.events_enrich,
+                                      args.db_user, args.db_password, args.db_host,
+                                      args.refresh_projects, args.refresh_identities,
+                                      args.author_id, args.author_uuid,
+                                      args.filter_raw, args.filters_raw_prefix,
+                                      args.jenkins_rename_file, unaffiliated_group,
+                                      args.pair_programming, studies_args,
+                                      refresh_identities_incremental=args.refresh_identities_incremental,
+                                      identities_by_query=args.refresh_identities_by_query)
+        logging.info("Enrich backend completed")
+
+        if args.bulk_replay_dead_letters:
+            replay_dead_letters(args.elastic_url_enrich or url, index_enrich)
+    elif args.events_enrich:
+        logging.info("Enrich option is needed for events_enrich")
+
+    return not (feed_error or enrich_error)
+
+
+if __name__ == '__main__':
+
+    app_init = datetime.now()
+    failed = 0
+
+    args = get_params()
+
+    config_logging(args.debug)
+
     try:
         if args.backend:
             # Configure elastic bulk size and scrolling
             if args.bulk_size:
                 ElasticSearch.max_items_bulk = args.bulk_size
+            if args.bulk_adaptive:
+                ElasticSearch.adaptive_bulk = True
+            if args.bulk_size_min:
+                ElasticSearch.adaptive_bulk_min = args.bulk_size_min
+            if args.bulk_size_max:
+                ElasticSearch.adaptive_bulk_max = args.bulk_size_max
+            if args.bulk_bytes:
+                ElasticSearch.max_bytes_bulk = args.bulk_bytes
+            if args.bulk_workers:
+                ElasticSearch.bulk_workers = args.bulk_workers
+            if args.bulk_dead_letter:
+                ElasticSearch.dead_letter_path = args.bulk_dead_letter
+            if args.json_library:
+                set_json_backend(args.json_library)
+            if args.gzip_requests:
+                ElasticSearch.gzip_requests = True
+                ElasticItems.gzip_requests = True
             if args.scroll_size:
                 ElasticItems.scroll_size = args.scroll_size
-            if not args.enrich_only:
-                feed_backend(url, clean, args.fetch_cache,
-                             args.backend, args.backend_args,
-                             args.index, args.index_enrich, args.project,
-                             args.arthur)
-                logging.info("Backend feed completed")
-
-            studies_args = None
-            if args.studies_list:
-                # Convert the list to the expected format in enrich_backend method
-                studies_args = []
-
-                for study in args.studies_list:
-                    studies_args.append({"name": study,
-                                         "type": study,
-                                         "params": {}
-                                         })
-
-            if args.enrich or args.enrich_only:
-                unaffiliated_group = None
-                enrich_backend(url, clean, args.backend, args.backend_args,
-                               args.index, args.index_enrich,
-                               args.db_projects_map, args.json_projects_map,
-                               args.db_sortinghat,
-                               args.no_incremental, args.only_identities,
-                               args.github_token,
-                               args.studies, args.only_studies,
-                               args.elastic_url_enrich, args.events_enrich,
-                               args.db_user, args.db_password, args.db_host,
-                               args.refresh_projects, args.refresh_identities,
-                               args.author_id, args.author_uuid,
-                               args.filter_raw, args.filters_raw_prefix,
-                               args.jenkins_rename_file, unaffiliated_group,
-                               args.pair_programming, studies_args)
-                logging.info("Enrich backend completed")
-            elif args.events_enrich:
-                logging.info("Enrich option is needed for events_enrich")
+            if args.scroll_slices:
+                ElasticItems.scroll_slices = args.scroll_slices
+            if args.prefetch_pages:
+                ElasticItems.prefetch_pages = args.prefetch_pages
+            if args.feed_queue_size:
+                ElasticOcean.feed_queue_size = args.feed_queue_size
+            if args.feed_timeout:
+                ElasticOcean.feed_timeout = args.feed_timeout
+            if args.enrich_workers:
+                Enrich.enrich_workers = args.enrich_workers
+            if args.enrich_run_id:
+                Enrich.run_id = args.enrich_run_id
+            if args.sh_cache:
+                Enrich.sh_cache_path = args.sh_cache
+            if args.sh_cache_size:
+                Enrich.sh_cache_size = args.sh_cache_size
+            if args.search_after:
+                ElasticItems.use_search_after = True
+            if args.batch:
+                # Several repositories fed in this process, sharing the connections
+                ElasticSearch.shared_connections = True
+                ElasticSearch.pool_size = max(ElasticSearch.pool_size,
+                                              args.batch_workers * ElasticSearch.bulk_workers)
+                jobs = load_jobs(args.batch, args.backend, args.index, args.index_enrich)
+                scheduler = BatchScheduler(args.batch_workers, args.batch_host_workers)
+                failed = scheduler.run(jobs, lambda job: run_backend(args, job.backend, job.backend_args,
+                                                                     job.index, job.index_enrich, job.project))
+            else:
+                run_backend(args, args.backend, args.backend_args,
+                            args.index, args.index_enrich, args.project)
         else:
             logging.error("You must configure a backend")
 
@@ -101,3 +189,7 @@ if __name__ == '__main__':
     total_time_min = (datetime.now() - app_init).total_seconds() / 60
 
     logging.info("Finished in %.2f min" % (total_time_min))
+
+    if failed:
+        logging.error("%i jobs failed", failed)
+        sys.exit(1)